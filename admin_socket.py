@@ -0,0 +1,378 @@
+######################################################
+#
+# Local admin socket for live introspection of a
+#   running GATT server
+#
+# A Unix-domain stream socket served from the GObject
+#   main loop (no extra thread).  Clients send one command
+#   per line and get one JSON object per line back:
+#
+#   status      -> everything below in one object
+#   tree        -> the GATT object tree with notifying state
+#   stats       -> event counters, backlog depth, latencies and
+#                  connected devices
+#   flush       -> send the pick backlog to subscribed clients
+#   log on|off  -> turn stdout logging on or off
+#   help        -> list the commands
+#
+# Answering a command only reads counters that are already
+#   maintained, so polling every second is cheap.  Replies are
+#   buffered and written as the client's socket takes them,
+#   however large they are
+#
+# Usage from a shell on the Pi:
+#   python admin_socket.py status
+#   socat - UNIX-CONNECT:/run/ble-stp.sock
+#
+#####################################################
+
+import argparse
+import inspect
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+
+ADMIN_SOCKET_PATH = '/run/ble-stp.sock'
+
+# Clients that send more than this without a newline are dropped
+MAX_COMMAND_BYTES = 1024
+
+# Clients with more than this of their replies unread are dropped
+MAX_REPLY_BACKLOG_BYTES = 1024 * 1024
+
+
+class _DropOutput(object):
+    """Stands in for sys.stdout while logging is off: nothing to close,
+        so a thread still holding it can keep writing
+    """
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class AdminServer(object):
+    """Serves the admin socket from the GObject main loop
+
+        Arguments:
+            path: Filepath of the Unix socket
+            app: The GATT Application being served
+            journal: PickJournal, or None
+            gpio_thread: The GPIO polling thread, or None
+            gpio_status: GpioThreadStatus updated by the GPIO thread, or None
+            registrations: Dict of BlueZ registration name -> status string
+            watchdog: LoopWatchdog, or None
+            presence: DevicePresence, or None
+    """
+
+    def __init__(self, path, app, journal=None, gpio_thread=None,
+                 gpio_status=None, registrations=None, watchdog=None,
+                 presence=None):
+        self.path = path
+        self.app = app
+        self.journal = journal
+        self.gpio_thread = gpio_thread
+        self.gpio_status = gpio_status
+        self.registrations = registrations if registrations is not None else {}
+        self.watchdog = watchdog
+        self.presence = presence
+        self.started_at = time.time()
+
+        self._sock = None
+        self._watch_id = None
+        self._clients = {}
+        self._stdout = sys.stdout
+        self._quiet = _DropOutput()
+
+        self.commands = {
+                'status': self.status,
+                'tree': self.tree,
+                'stats': self.stats,
+                'flush': self.flush,
+                'log': self.log,
+                'help': self.help,
+        }
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(4)
+        self._sock.setblocking(False)
+        self._watch_id = GObject.io_add_watch(self._sock.fileno(), GObject.IO_IN,
+                                              self._on_accept)
+        print('Admin socket listening on ' + self.path)
+
+    def stop(self):
+        for client in list(self._clients.values()):
+            self._close_client(client)
+        if self._watch_id is not None:
+            GObject.source_remove(self._watch_id)
+            self._watch_id = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.log('on')
+
+    ###########################
+    # Main loop callbacks     #
+    ###########################
+    def _on_accept(self, fd, condition):
+        try:
+            conn, _ = self._sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return True
+        conn.setblocking(False)
+        # Replies not written yet go to out, written from write_watch_id
+        client = { 'sock': conn, 'buffer': b'', 'out': bytearray(),
+                   'write_watch_id': None }
+        client['watch_id'] = GObject.io_add_watch(
+                conn.fileno(), GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                self._on_client_data, client)
+        self._clients[conn.fileno()] = client
+        return True
+
+    def _on_client_data(self, fd, condition, client):
+        try:
+            data = client['sock'].recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            data = b''
+
+        if not data:
+            client['watch_id'] = None
+            self._close_client(client)
+            return False
+
+        client['buffer'] += data
+        while b'\n' in client['buffer']:
+            line, client['buffer'] = client['buffer'].split(b'\n', 1)
+            reply = json.dumps(self.handle_command(line.decode('utf-8', 'replace')))
+            if not self._send(client, reply.encode('utf-8') + b'\n'):
+                return False
+
+        if len(client['buffer']) > MAX_COMMAND_BYTES:
+            client['watch_id'] = None
+            self._close_client(client)
+            return False
+        return True
+
+    def _send(self, client, data):
+        """Queue data for client and write what its socket takes now
+
+            Returns False if the client was dropped
+        """
+        client['out'] += data
+        if len(client['out']) > MAX_REPLY_BACKLOG_BYTES:
+            # Client is not reading its replies, don't let it grow without bound
+            print('Admin client dropped with %d bytes of replies unread' % len(client['out']))
+            self._close_client(client)
+            return False
+        if client['write_watch_id'] is not None:
+            return True
+        if not self._write(client):
+            return False
+        if client['out']:
+            client['write_watch_id'] = GObject.io_add_watch(
+                    client['sock'].fileno(), GObject.IO_OUT | GObject.IO_HUP | GObject.IO_ERR,
+                    self._on_client_writable, client)
+        return True
+
+    def _write(self, client):
+        """Write as much of client's replies as its socket takes
+
+            Returns False if the client was dropped
+        """
+        try:
+            sent = client['sock'].send(client['out'])
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            self._close_client(client)
+            return False
+        del client['out'][:sent]
+        return True
+
+    def _on_client_writable(self, fd, condition, client):
+        if not (condition & GObject.IO_OUT):
+            client['write_watch_id'] = None
+            self._close_client(client)
+            return False
+        if not self._write(client):
+            return False
+        if client['out']:
+            return True
+        client['write_watch_id'] = None
+        return False
+
+    def _close_client(self, client):
+        """Drop client, removing its watches (a callback returning False
+            clears its own first)
+        """
+        for key in ('watch_id', 'write_watch_id'):
+            if client[key] is not None:
+                GObject.source_remove(client[key])
+                client[key] = None
+        self._clients.pop(client['sock'].fileno(), None)
+        client['sock'].close()
+
+    ###########################
+    # Commands                #
+    ###########################
+    def handle_command(self, line):
+        """Run one command line and return the reply (a dict)"""
+        words = line.split()
+        if not words:
+            words = ['status']
+        command = self.commands.get(words[0])
+        if command is None:
+            return { 'error': 'unknown command: ' + words[0] }
+        try:
+            inspect.signature(command).bind(*words[1:])
+        except TypeError:
+            return { 'error': 'bad arguments for ' + words[0] }
+        try:
+            return command(*words[1:])
+        except Exception as e:
+            # A bug, not the client's fault: log it and say so
+            print('Admin command %r failed' % line)
+            traceback.print_exc(file=sys.stdout)
+            return { 'error': '%s failed: %s: %s' % (words[0], type(e).__name__, e) }
+
+    def status(self):
+        reply = { 'time': time.time(), 'uptime_sec': time.time() - self.started_at }
+        reply.update(self.tree())
+        reply.update(self.stats())
+        return reply
+
+    def tree(self):
+        services = []
+        for service in self.app.services:
+            chrcs = []
+            for chrc in service.get_characteristics():
+                chrcs.append({
+                        'path': chrc.path,
+                        'uuid': chrc.uuid,
+                        'flags': list(chrc.flags),
+                        'notifying': bool(getattr(chrc, 'notifying', False)),
+                        'descriptors': [desc.path for desc in chrc.get_descriptors()],
+                })
+            services.append({
+                    'path': service.path,
+                    'uuid': service.uuid,
+                    'characteristics': chrcs,
+            })
+        return { 'services': services }
+
+    def stats(self):
+        counters = {}
+        for service in self.app.services:
+            for chrc in service.get_characteristics():
+                counters[chrc.path] = {
+                        'emitted': chrc.emitted_count,
+                        'suppressed': chrc.suppressed_count,
+                }
+                if hasattr(chrc, 'delivery_stats'):
+                    counters[chrc.path].update(chrc.delivery_stats())
+                if hasattr(chrc, 'handlers'):
+                    counters[chrc.path]['handlers'] = chrc.handlers.as_dict()
+        reply = {
+                'characteristics': counters,
+                'registrations': dict(self.registrations),
+                'logging': sys.stdout is self._stdout,
+        }
+
+        if self.journal is not None:
+            reply['journal'] = {
+                    'backlog': self.journal.pending_count(),
+                    'inserted': self.journal.inserted_count,
+                    'acked': self.journal.acked_count,
+                    'commits': self.journal.commit_count,
+                    'failed_commits': self.journal.failed_commit_count,
+                    'uncommitted': self.journal.uncommitted_count(),
+                    'compacted': self.journal.compacted_count,
+            }
+
+        gpio = {}
+        if self.gpio_thread is not None:
+            gpio['alive'] = self.gpio_thread.is_alive()
+        if self.gpio_status is not None:
+            gpio.update(self.gpio_status.as_dict())
+        if gpio:
+            reply['gpio'] = gpio
+
+        if self.watchdog is not None:
+            reply['main_loop'] = self.watchdog.as_dict()
+
+        if self.presence is not None:
+            reply['devices'] = self.presence.as_dict()
+
+        return reply
+
+    def flush(self):
+        sent = 0
+        for service in self.app.services:
+            for chrc in service.get_characteristics():
+                if hasattr(chrc, 'flush_backlog'):
+                    before = chrc.emitted_count
+                    chrc.flush_backlog()
+                    sent += chrc.emitted_count - before
+        return { 'flushed': sent }
+
+    def log(self, state=None):
+        """Turn logging (everything we print to stdout) on or off"""
+        if state not in ('on', 'off'):
+            return { 'error': 'usage: log on|off' }
+        # Only swapped, never closed: the GPIO and worker threads may
+        #   be in the middle of printing to either
+        sys.stdout = self._stdout if state == 'on' else self._quiet
+        return { 'logging': state == 'on' }
+
+    def help(self):
+        return { 'commands': sorted(self.commands) }
+
+
+###############################
+#     Command line client     #
+###############################
+def main(path, command):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    client.sendall(command.encode('utf-8') + b'\n')
+
+    reply = b''
+    while not reply.endswith(b'\n'):
+        data = client.recv(65536)
+        if not data:
+            break
+        reply += data
+    client.close()
+
+    print(json.dumps(json.loads(reply.decode('utf-8')), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default=ADMIN_SOCKET_PATH,
+                        help="admin socket path (default: %s)" % ADMIN_SOCKET_PATH)
+    parser.add_argument('command', nargs='*', default=['status'],
+                        help="command to send (default: status)")
+    args = parser.parse_args()
+
+    main(args.socket, ' '.join(args.command))
@@ -0,0 +1,538 @@
+######################################################
+#
+# Analog IR sensing pipeline
+#
+# The binary IR beam on pin 17 is fooled by grass and
+#   sunlight.  This samples the IR receiver's analog level
+#   instead (an MCP3008 SPI ADC in production, a synthetic
+#   generator for tests and benchmarks) at kHz rates into
+#   a preallocated NumPy block buffer, and classifies fixed
+#   windows of each block with vectorized features:
+#
+#   mean         low while the beam is blocked
+#   variance     high for flicker (grass, leaves, sunlight)
+#   edge energy  sum of squared sample-to-sample differences,
+#                high for flicker
+#
+# A pick is a run of "blocked" windows lasting between
+#   MIN_PRESS_SEC and MAX_PRESS_SEC; accepted picks are passed
+#   to on_pick with their duration.  AnalogPressSource makes
+#   the detector the source of the pick pipeline (see
+#   pick_pipeline.py), whose stages store and deliver them
+#
+# A block is read from the ADC in one burst: a single
+#   SPI_IOC_MESSAGE ioctl with one 3-byte transfer per sample,
+#   chip select toggled and the sample period waited out by
+#   the kernel between them, instead of a Python xfer2() call
+#   and time.sleep() per sample
+#
+# The detector thread is throttled so it never uses more
+#   than cpu_budget of the CPU.  Its own CPU time is measured
+#   (getrusage of the thread), so acquisition counts against
+#   the budget as well as classification.  Throttling leaves
+#   a gap in the samples rather than exceeding the budget
+#
+# Run this file directly to benchmark throughput in
+#   samples/second on synthetic data:
+#     python analog_sensing.py --seconds 600
+#   or, on the Pi, to measure the real CPU share of reading
+#   and classifying the ADC at the sample rate:
+#     python analog_sensing.py --spi --seconds 60
+#
+#####################################################
+
+import argparse
+import collections
+import ctypes
+import fcntl
+import resource
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from pick_pipeline import PickEvent
+
+
+SAMPLE_RATE_HZ = 4000
+BLOCK_SIZE = 256
+WINDOW_SIZE = 64
+
+# ADC counts (10-bit MCP3008): high while the receiver sees the beam
+BLOCKED_LEVEL = 400
+MAX_BLOCKED_VARIANCE = 2500.0
+MAX_BLOCKED_EDGE_ENERGY = 64 * 400.0
+
+MIN_PRESS_SEC = 0.15
+MAX_PRESS_SEC = 10.0
+
+CPU_BUDGET = 0.2
+
+SPI_SPEED_HZ = 1350000
+
+# Samples per SPI_IOC_MESSAGE: the ioctl's size field limits a
+#   message to 511 transfers, spidev's buffer (4096 bytes) to 1365
+MAX_BURST = 256
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('The analog sensing pipeline needs numpy (see requirements.txt)')
+
+
+def thread_cpu_sec():
+    """CPU time, user and system, used by the calling thread so far"""
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _SpiIocTransfer(ctypes.Structure):
+    """struct spi_ioc_transfer of linux/spi/spidev.h"""
+
+    _fields_ = [('tx_buf', ctypes.c_uint64),
+                ('rx_buf', ctypes.c_uint64),
+                ('len', ctypes.c_uint32),
+                ('speed_hz', ctypes.c_uint32),
+                ('delay_usecs', ctypes.c_uint16),
+                ('bits_per_word', ctypes.c_uint8),
+                ('cs_change', ctypes.c_uint8),
+                ('tx_nbits', ctypes.c_uint8),
+                ('rx_nbits', ctypes.c_uint8),
+                ('word_delay_usecs', ctypes.c_uint8),
+                ('pad', ctypes.c_uint8)]
+
+
+def _spi_ioc_message(count):
+    """SPI_IOC_MESSAGE(count), i.e. _IOW('k', 0, char[count * 32])"""
+    return (1 << 30) | ((count * ctypes.sizeof(_SpiIocTransfer)) << 16) | (ord('k') << 8)
+
+
+class SpiAdcSource(object):
+    """Reads one channel of an MCP3008 ADC over SPI, a burst of up to
+        MAX_BURST samples per system call
+
+        The kernel paces the samples of a burst (delay_usecs), so the
+        sample clock only slips by the time spent between bursts;
+        rate_measured_hz is the rate the last burst actually ran at
+
+        Arguments:
+            channel: ADC channel the IR receiver is wired to
+            rate_hz: Sample rate
+            bus, device: SPI bus and chip select
+    """
+
+    # Bytes per sample: start bit, single-ended mode and channel,
+    #   then the 10-bit result clocked out
+    FRAME = 3
+
+    def __init__(self, channel=0, rate_hz=SAMPLE_RATE_HZ, bus=0, device=0):
+        _require_numpy()
+        import spidev
+        self.rate_hz = rate_hz
+        self.rate_measured_hz = None
+        self._spi = spidev.SpiDev()
+        self._spi.open(bus, device)
+        self._spi.max_speed_hz = SPI_SPEED_HZ
+        self._fd = self._spi.fileno()
+
+        # Everything a burst touches is allocated once here
+        self._tx = (ctypes.c_uint8 * (MAX_BURST * self.FRAME))(
+                *([1, (8 + channel) << 4, 0] * MAX_BURST))
+        self._rx = (ctypes.c_uint8 * (MAX_BURST * self.FRAME))()
+        self._replies = np.frombuffer(self._rx, dtype=np.uint8).reshape(MAX_BURST, self.FRAME)
+        self._levels = np.empty(MAX_BURST, dtype=np.uint16)
+
+        # Wait out the rest of the sample period after each transfer
+        transfer_usec = self.FRAME * 8 * 1e6 / SPI_SPEED_HZ
+        delay_usec = max(0, int(round(1e6 / rate_hz - transfer_usec)))
+        self._transfers = (_SpiIocTransfer * MAX_BURST)()
+        tx_address = ctypes.addressof(self._tx)
+        rx_address = ctypes.addressof(self._rx)
+        for i, transfer in enumerate(self._transfers):
+            transfer.tx_buf = tx_address + i * self.FRAME
+            transfer.rx_buf = rx_address + i * self.FRAME
+            transfer.len = self.FRAME
+            transfer.speed_hz = SPI_SPEED_HZ
+            transfer.delay_usecs = delay_usec
+            # The MCP3008 converts once per chip select
+            transfer.cs_change = 1
+        self._requests = {}
+
+    def _burst(self, count):
+        """Run the first count transfers in one SPI_IOC_MESSAGE"""
+        request = self._requests.get(count)
+        if request is None:
+            request = self._requests[count] = _spi_ioc_message(count)
+        last = self._transfers[count - 1]
+        # Chip select is released at the end of the message anyway,
+        #   cs_change on the last transfer would keep it asserted
+        last.cs_change = 0
+        try:
+            fcntl.ioctl(self._fd, request, ctypes.addressof(self._transfers))
+        finally:
+            last.cs_change = 1
+
+    def read_block(self, out):
+        """Fill out (a NumPy array) with consecutive samples"""
+        started = time.time()
+        replies = self._replies
+        levels = self._levels
+        for start in range(0, len(out), MAX_BURST):
+            count = min(MAX_BURST, len(out) - start)
+            self._burst(count)
+            np.bitwise_and(replies[:count, 1], 3, out=levels[:count])
+            np.left_shift(levels[:count], 8, out=levels[:count])
+            np.bitwise_or(levels[:count], replies[:count, 2], out=levels[:count])
+            out[start:start + count] = levels[:count]
+        elapsed = time.time() - started
+        if elapsed > 0:
+            self.rate_measured_hz = len(out) / elapsed
+
+    def close(self):
+        self._spi.close()
+
+
+class SyntheticSource(object):
+    """Generates a realistic analog IR level with picks and flicker
+
+        Arguments:
+            rate_hz: Sample rate
+            picks_per_sec: Average rate of real picks
+            flickers_per_sec: Average rate of grass/sunlight flicker
+            realtime: Pace read_block() to rate_hz (False = as fast as possible)
+            seed: Random seed
+    """
+
+    BASELINE = 800.0
+    BLOCKED = 100.0
+    NOISE = 8.0
+
+    def __init__(self, rate_hz=SAMPLE_RATE_HZ, picks_per_sec=0.2, flickers_per_sec=2.0,
+                 realtime=True, seed=490):
+        _require_numpy()
+        self.rate_hz = rate_hz
+        self.picks_per_sec = picks_per_sec
+        self.flickers_per_sec = flickers_per_sec
+        self.realtime = realtime
+        self.injected_picks = 0
+        self._rng = np.random.RandomState(seed)
+        self._position = 0
+        self._scheduled_until = 0
+        self._events = []
+        self._started = None
+
+    def _schedule(self, until):
+        # Pick and flicker events as (start sample, end sample, is_pick)
+        while self._scheduled_until < until:
+            rate = self.picks_per_sec + self.flickers_per_sec
+            start = self._scheduled_until + int(self._rng.exponential(1.0 / rate) * self.rate_hz)
+            if self._rng.random_sample() < self.picks_per_sec / rate:
+                length = int(self._rng.uniform(0.3, 1.2) * self.rate_hz)
+                self._events.append((start, start + length, True))
+                self.injected_picks += 1
+            else:
+                length = int(self._rng.uniform(0.002, 0.008) * self.rate_hz)
+                self._events.append((start, start + length, False))
+            self._scheduled_until = start + length + 1
+
+    def read_block(self, out):
+        start = self._position
+        end = start + len(out)
+        self._schedule(end)
+
+        out[:] = self._rng.normal(self.BASELINE, self.NOISE, len(out))
+        for event_start, event_end, is_pick in self._events:
+            if event_start >= end:
+                break
+            lo = max(event_start, start) - start
+            hi = min(event_end, end) - start
+            if is_pick:
+                out[lo:hi] = self.BLOCKED
+            else:
+                # Flicker: the beam is blocked on and off every other sample
+                out[lo:hi:2] = self.BLOCKED
+        self._events = [event for event in self._events if event[1] > end]
+        self._position = end
+
+        if self.realtime:
+            if self._started is None:
+                self._started = time.time()
+            delay = self._started + end / float(self.rate_hz) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+class AnalogPickDetector(object):
+    """Streams blocks from source, classifies windows and reports picks
+
+        Arguments:
+            source: SpiAdcSource, SyntheticSource or anything with read_block(out)
+            on_pick: Called with the duration in milliseconds of every
+                accepted pick
+            block_size: Samples per block (a multiple of window_size)
+            window_size: Samples per classified window
+            cpu_budget: Largest fraction of the CPU the thread calling
+                run() may use, reading the source included
+    """
+
+    def __init__(self, source, on_pick, block_size=BLOCK_SIZE, window_size=WINDOW_SIZE,
+                 cpu_budget=CPU_BUDGET):
+        _require_numpy()
+        if block_size % window_size:
+            raise ValueError('block_size must be a multiple of window_size')
+        self.source = source
+        self.on_pick = on_pick
+        self.window_size = window_size
+        self.cpu_budget = cpu_budget
+        self.window_sec = window_size / float(source.rate_hz)
+
+        # Everything the hot path touches is allocated once here
+        windows = block_size // window_size
+        self._block = np.empty(block_size, dtype=np.float32)
+        self._windows = self._block.reshape(windows, window_size)
+        self._means = np.empty(windows, dtype=np.float32)
+        self._variances = np.empty(windows, dtype=np.float32)
+        self._diffs = np.empty((windows, window_size - 1), dtype=np.float32)
+        self._edge_energy = np.empty(windows, dtype=np.float32)
+        self._blocked = np.empty(windows, dtype=bool)
+        self._scratch = np.empty(windows, dtype=bool)
+
+        self.samples = 0
+        self.picks = 0
+        self.rejected = 0
+        # Classification only, and everything the thread running run()
+        #   used (acquisition included)
+        self.processing_sec = 0.0
+        self.cpu_sec = 0.0
+        self.run_sec = 0.0
+        self.throttled_sec = 0.0
+        self.throttle_count = 0
+        self._blocked_windows = 0
+        self._running = False
+        # Thread CPU and wall time at the end of the last step()
+        self._cpu_mark = None
+        self._wall_mark = None
+
+    def process_block(self):
+        """Read and classify one block"""
+        self.source.read_block(self._block)
+        started = time.time()
+
+        windows = self._windows
+        np.mean(windows, axis=1, out=self._means)
+        np.var(windows, axis=1, out=self._variances)
+        np.subtract(windows[:, 1:], windows[:, :-1], out=self._diffs)
+        np.square(self._diffs, out=self._diffs)
+        np.sum(self._diffs, axis=1, out=self._edge_energy)
+
+        np.less(self._means, BLOCKED_LEVEL, out=self._blocked)
+        np.less(self._variances, MAX_BLOCKED_VARIANCE, out=self._scratch)
+        np.logical_and(self._blocked, self._scratch, out=self._blocked)
+        np.less(self._edge_energy, MAX_BLOCKED_EDGE_ENERGY, out=self._scratch)
+        np.logical_and(self._blocked, self._scratch, out=self._blocked)
+
+        for blocked in self._blocked:
+            if blocked:
+                self._blocked_windows += 1
+            elif self._blocked_windows:
+                self._end_press(self._blocked_windows * self.window_sec)
+                self._blocked_windows = 0
+
+        self.samples += len(self._block)
+        elapsed = time.time() - started
+        self.processing_sec += elapsed
+        return elapsed
+
+    def _end_press(self, duration):
+        if MIN_PRESS_SEC <= duration <= MAX_PRESS_SEC:
+            self.picks += 1
+            self.on_pick(int(round(duration * 1000)))
+        else:
+            self.rejected += 1
+
+    def step(self, status=None):
+        """Process one block, then sleep as long as it takes to stay
+            inside the CPU budget
+
+            Arguments:
+                status: GpioThreadStatus to keep up to date, or None
+        """
+        if self._wall_mark is None:
+            self._cpu_mark = thread_cpu_sec()
+            self._wall_mark = time.time()
+
+        self.process_block()
+        if status is not None:
+            status.heartbeat = time.monotonic()
+            status.presses = self.picks
+
+        # Stay inside the CPU budget: the block's CPU time, reading
+        #   it included, against the wall time it took
+        block_cpu = thread_cpu_sec() - self._cpu_mark
+        block_wall = time.time() - self._wall_mark
+        idle = block_cpu / self.cpu_budget - block_wall
+        if idle > 0.0005:
+            self.throttled_sec += idle
+            self.throttle_count += 1
+            time.sleep(idle)
+        self.cpu_sec += block_cpu
+        self._cpu_mark = thread_cpu_sec()
+        now = time.time()
+        self.run_sec += now - self._wall_mark
+        self._wall_mark = now
+
+    def run(self, status=None):
+        """Process blocks until stop() is called
+
+            Arguments:
+                status: GpioThreadStatus to keep up to date, or None
+        """
+        self._running = True
+        if status is not None:
+            status.state = 'waiting'
+        try:
+            while self._running:
+                self.step(status)
+        finally:
+            if status is not None:
+                status.state = 'stopped'
+            self.source.close()
+
+    def stop(self):
+        self._running = False
+
+    def cpu_share(self):
+        """Fraction of one core run() has used, reading the source included"""
+        return self.cpu_sec / self.run_sec if self.run_sec else 0.0
+
+
+class AnalogPressSource(object):
+    """Source of the pick pipeline: picks classified from the IR
+        receiver's analog level
+
+        The detector has merged and filtered the presses already, so
+        the events are picks, pressed_at and released_at worked back
+        from the duration and the end of the block it ended in
+
+        Arguments:
+            source: SpiAdcSource, SyntheticSource or anything with read_block(out)
+            status: GpioThreadStatus to keep up to date, or None
+            monotonic: Clock the picks are timed with (the pipeline's)
+            block_size, window_size, cpu_budget: See AnalogPickDetector
+    """
+
+    # Longest read() processes blocks without a pick before
+    #   returning None
+    READ_TIMEOUT_SEC = 0.5
+
+    def __init__(self, source, status=None, monotonic=time.monotonic,
+                 block_size=BLOCK_SIZE, window_size=WINDOW_SIZE, cpu_budget=CPU_BUDGET):
+        self.status = status
+        self.monotonic = monotonic
+        self.detector = AnalogPickDetector(source, self._picked, block_size,
+                                           window_size, cpu_budget)
+        self._picks = collections.deque()
+
+    def _picked(self, duration_ms):
+        released_at = self.monotonic()
+        self._picks.append(PickEvent(released_at, released_at - duration_ms / 1000.0,
+                                     released_at, duration_ms))
+        if self.status is not None:
+            self.status.last_press_time = time.time()
+
+    def read(self, timeout=None):
+        """Process blocks until a pick is accepted, or timeout seconds
+            (at most READ_TIMEOUT_SEC) have passed, and return it as a
+            PickEvent, or None
+        """
+        if timeout is None or timeout > self.READ_TIMEOUT_SEC:
+            timeout = self.READ_TIMEOUT_SEC
+        deadline = self.monotonic() + timeout
+        while not self._picks:
+            self.detector.step(self.status)
+            if self.monotonic() >= deadline:
+                break
+        if not self._picks:
+            return None
+        # A block can end more than one pick
+        event = self._picks.popleft()
+        event.started_at = self.monotonic()
+        return event
+
+    def close(self):
+        self.detector.source.close()
+
+
+###############################
+#          Benchmark          #
+###############################
+def measure_spi(seconds, rate_hz, block_size, window_size):
+    """Run the detector on the real ADC and report the CPU it needs"""
+    source = SpiAdcSource(rate_hz=rate_hz)
+    detector = AnalogPickDetector(source, lambda duration_ms: None, block_size,
+                                  window_size, cpu_budget=1.0)
+    stopper = threading.Timer(seconds, detector.stop)
+    stopper.start()
+    detector.run()
+
+    print('%d samples in %.1f s, %.0f samples/s (%d Hz requested, last burst at %.0f Hz)' % (
+            detector.samples, detector.run_sec, detector.samples / detector.run_sec,
+            rate_hz, source.rate_measured_hz or 0))
+    print('CPU: %.1f%% of one core, reading included (classification %.1f%%, budget %.0f%%)' % (
+            100 * detector.cpu_share(), 100 * detector.processing_sec / detector.run_sec,
+            100 * CPU_BUDGET))
+
+
+def main(seconds, rate_hz, block_size, window_size):
+    source = SyntheticSource(rate_hz, realtime=False)
+    detector = AnalogPickDetector(source, lambda duration_ms: None, block_size,
+                                  window_size)
+
+    blocks = int(seconds * rate_hz) // block_size
+    started = time.time()
+    cpu = thread_cpu_sec()
+    for _ in range(blocks):
+        detector.process_block()
+    elapsed = time.time() - started
+    cpu = thread_cpu_sec() - cpu
+
+    print('%d samples (%.0f s at %d Hz) in %.2f s' % (
+            detector.samples, seconds, rate_hz, elapsed))
+    print('Throughput (including synthetic source): %.0f samples/s' % (
+            detector.samples / elapsed))
+    print('Throughput (classification only): %.0f samples/s' % (
+            detector.samples / detector.processing_sec))
+    print('CPU needed at %d Hz: %.1f%% of one core for classification, %.1f%% '
+          'with the synthetic source (budget %.0f%%, python analog_sensing.py --spi '
+          'measures the ADC)' % (
+            rate_hz, 100.0 * detector.processing_sec / seconds, 100.0 * cpu / seconds,
+            100 * CPU_BUDGET))
+    print('Picks: %d injected, %d detected, %d rejected runs' % (
+            source.injected_picks, detector.picks, detector.rejected))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', default=600, type=float,
+                        help="seconds of synthetic signal to process (default: 600)")
+    parser.add_argument('--rate', default=SAMPLE_RATE_HZ, type=int,
+                        help="sample rate in Hz (default: %d)" % SAMPLE_RATE_HZ)
+    parser.add_argument('--block-size', default=BLOCK_SIZE, type=int,
+                        help="samples per block (default: %d)" % BLOCK_SIZE)
+    parser.add_argument('--window-size', default=WINDOW_SIZE, type=int,
+                        help="samples per window (default: %d)" % WINDOW_SIZE)
+    parser.add_argument('--spi', action='store_true',
+                        help="read the MCP3008 for --seconds in real time and report " +
+                        "the CPU share instead (on the Pi)")
+    args = parser.parse_args()
+
+    if args.spi:
+        measure_spi(args.seconds, args.rate, args.block_size, args.window_size)
+    else:
+        main(args.seconds, args.rate, args.block_size, args.window_size)
@@ -6,9 +6,12 @@ import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
+import sys
 import time
 import threading
 
+from dbus_cache import CachedDispatchObject
+
 try:
     from gi.repository import GObject  # python3
 except ImportError:
@@ -44,11 +47,11 @@ class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
 
-class Advertisement(dbus.service.Object):
+class Advertisement(CachedDispatchObject):
     PATH_BASE = '/org/bluez/example/advertisement'
 
     def __init__(self, bus, index, advertising_type):
-        self.path = self.PATH_BASE + str(index)
+        self.path = sys.intern(self.PATH_BASE + str(index))
         self.bus = bus
         self.ad_type = advertising_type
         self.service_uuids = None
@@ -2,16 +2,21 @@ import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
+import dbus.types
 
-import array
 try:
   from gi.repository import GObject
 except ImportError:
   import gobject as GObject
+import concurrent.futures
+import socket
 import sys
+import threading
 
 from random import randint
 
+from dbus_cache import CachedDispatchObject
+
 mainloop = None
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
@@ -38,18 +43,151 @@ class InvalidValueLengthException(dbus.exceptions.DBusException):
 class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
+class InProgressException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InProgress'
+
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+
+def dbus_bytes(value):
+    """
+    Return value (bytes, bytearray or a list of ints) as a dbus.ByteArray,
+    which dbus-python marshals as one 'ay' block instead of one dbus.Byte
+    object per byte.
+    """
+    if isinstance(value, dbus.ByteArray):
+        return value
+    if isinstance(value, bytes):
+        return dbus.ByteArray(value)
+    return dbus.ByteArray(bytes(bytearray(value)))
+
 
-class Application(dbus.service.Object):
+class LongWriteBuffer(object):
+    """
+    Reassembles long writes (WriteValue with an 'offset' option) and prepared
+    (reliable) writes of one attribute into a bytearray of max_length bytes
+    allocated once, and hands each complete value to on_commit(value) as bytes.
+
+    BlueZ queues prepared writes itself and, once the client executes them,
+    calls WriteValue for them fragment by fragment with increasing offsets,
+    each after replying to the one before.  Nothing marks the last fragment,
+    so a value is committed at the first of these boundaries:
+      - a write BlueZ reports as a whole one ('type' option "request" or
+        "command")
+      - the length declared_length(value) reads from the value's first bytes
+        (a function returning None while it cannot tell yet), if given
+      - a fragment shorter than a full one (MTU - 5 bytes, with the 'mtu'
+        option), which can only be the last
+      - the next write at offset 0, which starts a new value
+
+    Limitation: from BlueZ versions without the 'type' and 'mtu' options, and
+    for values without a declared length whose last fragment happens to be
+    full, only the next write or COMMIT_TIMEOUT_MS without any (a backstop, the
+    client may be gone) commits the value.  Readers of the committed value
+    never see half of a write either way.
+    """
+
+    COMMIT_TIMEOUT_MS = 2000
+
+    # Prepare Write Request header: opcode, handle and offset
+    PREPARE_WRITE_OVERHEAD = 5
+
+    def __init__(self, max_length, on_commit, value=b'', declared_length=None):
+        self.max_length = max_length
+        self.on_commit = on_commit
+        self.declared_length = declared_length
+        self._buf = bytearray(max_length)
+        # Length of the value in _buf, committed or being written
+        self._length = 0
+        # Timeout committing the value being written, None once committed
+        self._commit_id = None
+        self.fragment_count = 0
+        self.commit_count = 0
+        self.timeout_commit_count = 0
+        self.set(value)
+
+    def set(self, value):
+        """Replace the value (e.g. the initial one) without calling on_commit"""
+        if len(value) > self.max_length:
+            raise InvalidValueLengthException()
+        self._buf[:len(value)] = value
+        self._length = len(value)
+
+    def write(self, value, options):
+        """Apply one WriteValue call (must run on the main loop)"""
+        offset = int(options.get('offset', 0))
+        end = offset + len(value)
+        # Fragments continue the value, they may not leave a gap
+        if offset > self._length:
+            raise InvalidOffsetException()
+        if end > self.max_length:
+            raise InvalidValueLengthException()
+        if options.get('prepare-authorize', False):
+            # BlueZ asks before queueing a prepared write, the data comes later
+            return
+
+        if offset == 0 and self._commit_id is not None:
+            # A new value starts, so the last one is complete
+            self._commit()
+
+        self._buf[offset:end] = value
+        self._length = end
+        self.fragment_count += 1
+        if self._complete(value, options):
+            self._commit()
+            return
+
+        if self._commit_id is not None:
+            GObject.source_remove(self._commit_id)
+        self._commit_id = GObject.timeout_add(self.COMMIT_TIMEOUT_MS,
+                                              self._on_commit_timeout)
+
+    def _complete(self, value, options):
+        if str(options.get('type', '')) in ('request', 'command'):
+            return True
+        if self.declared_length is not None:
+            view = memoryview(self._buf)[:self._length]
+            try:
+                length = self.declared_length(view)
+            finally:
+                view.release()
+            if length is not None and self._length >= length:
+                return True
+        mtu = options.get('mtu')
+        return mtu is not None and len(value) < int(mtu) - self.PREPARE_WRITE_OVERHEAD
+
+    def _on_commit_timeout(self):
+        print('Long write not continued for %d ms, committing %d bytes' % (
+                self.COMMIT_TIMEOUT_MS, self._length))
+        self._commit_id = None
+        self.timeout_commit_count += 1
+        self._commit()
+        return False
+
+    def _commit(self):
+        if self._commit_id is not None:
+            GObject.source_remove(self._commit_id)
+            self._commit_id = None
+        self.commit_count += 1
+        self.on_commit(bytes(self._buf[:self._length]))
+
+
+class Application(CachedDispatchObject):
     """
     org.bluez.GattApplication1 interface implementation
+
+    With include_demo_services=False the demo Heart Rate, Battery and Test
+    services below are left out (they export ten objects and run timers).
     """
-    def __init__(self, bus):
+    def __init__(self, bus, include_demo_services=True):
         self.path = '/'
         self.services = []
         dbus.service.Object.__init__(self, bus, self.path)
-        self.add_service(HeartRateService(bus, 0))
-        self.add_service(BatteryService(bus, 1))
-        self.add_service(TestService(bus, 2))
+        if include_demo_services:
+            self.add_service(HeartRateService(bus, 0))
+            self.add_service(BatteryService(bus, 1))
+            self.add_service(TestService(bus, 2))
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -74,16 +212,18 @@ class Application(dbus.service.Object):
         return response
 
 
-class Service(dbus.service.Object):
+class Service(CachedDispatchObject):
     """
     org.bluez.GattService1 interface implementation
     """
     PATH_BASE = '/org/bluez/example/service'
 
     def __init__(self, bus, index, uuid, primary):
-        self.path = self.PATH_BASE + str(index)
+        # Paths and UUIDs are interned, the same strings end up as keys
+        # and values of every GetManagedObjects reply
+        self.path = sys.intern(self.PATH_BASE + str(index))
         self.bus = bus
-        self.uuid = uuid
+        self.uuid = sys.intern(uuid)
         self.primary = primary
         self.characteristics = []
         dbus.service.Object.__init__(self, bus, self.path)
@@ -124,30 +264,81 @@ class Service(dbus.service.Object):
         return self.get_properties()[GATT_SERVICE_IFACE]
 
 
-class Characteristic(dbus.service.Object):
+class Characteristic(CachedDispatchObject):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Values passed to update_value() go through a small value store: a value
+    identical to the last one emitted is suppressed, and if coalesce_ms > 0
+    all updates within that many milliseconds are folded into one
+    PropertiesChanged carrying the latest value.
+
+    Characteristics with acquire_notify = True also offer AcquireNotify: BlueZ
+    then hands us a socket and notify_value() writes values straight to it
+    instead of sending a PropertiesChanged signal per value through dbus-daemon
+    and bluetoothd.
     """
-    def __init__(self, bus, index, uuid, flags, service):
-        self.path = service.path + '/char' + str(index)
+
+    # Set to True in subclasses that notify/indicate to offer AcquireNotify
+    acquire_notify = False
+
+    # ATT_MTU until BlueZ tells us the negotiated one
+    DEFAULT_MTU = 23
+
+    # Longest we block writing to an AcquireNotify socket BlueZ is not draining
+    NOTIFY_SEND_TIMEOUT_SEC = 0.05
+
+    # Set in subclasses that accept writes: WriteValue then reassembles long
+    # and prepared writes of up to this many bytes (see LongWriteBuffer) and
+    # calls value_written(value) with every complete value
+    MAX_VALUE_LENGTH = None
+
+    # Set in subclasses whose values start with their own length: a function
+    # of the bytes written so far (a memoryview) returning the whole value's
+    # length, or None if they do not tell yet (see LongWriteBuffer)
+    declared_length = None
+
+    def __init__(self, bus, index, uuid, flags, service, coalesce_ms=0):
+        self.path = sys.intern(service.path + '/char' + str(index))
         self.bus = bus
-        self.uuid = uuid
+        self.uuid = sys.intern(uuid)
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.notifying = False
+        self.coalesce_ms = coalesce_ms
+        self.long_write = None
+        if self.MAX_VALUE_LENGTH is not None:
+            self.long_write = LongWriteBuffer(self.MAX_VALUE_LENGTH, self.value_written,
+                                              declared_length=self.declared_length)
+
+        # Value store (updates may come from threads other than the main loop)
+        self.emitted_count = 0
+        self.suppressed_count = 0
+        self._value = None
+        self._last_emitted_value = None
+        self._coalesce_pending = False
+        self._value_lock = threading.Lock()
+
+        # AcquireNotify socket and the MTU BlueZ gave us with it
+        self._notify_sock = None
+        self._notify_watch_id = None
+        self.mtu = self.DEFAULT_MTU
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
+        properties = {
+                'Service': self.service.get_path(),
+                'UUID': self.uuid,
+                'Flags': self.flags,
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
         }
+        if self.acquire_notify:
+            # Its presence tells BlueZ we implement AcquireNotify
+            properties['NotifyAcquired'] = dbus.Boolean(self._notify_sock is not None)
+        return { GATT_CHRC_IFACE: properties }
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -180,10 +371,22 @@ class Characteristic(dbus.service.Object):
         print('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
+    # byte_arrays=True hands subclasses the written value as a
+    # dbus.ByteArray (bytes) instead of a list of dbus.Byte
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True)
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise NotSupportedException()
+        if self.long_write is None:
+            print('Default WriteValue called, returning error')
+            raise NotSupportedException()
+        self.long_write.write(value, options)
+
+    def value_written(self, value):
+        """
+        Called with every complete value written (bytes), with MAX_VALUE_LENGTH
+        set.
+        """
+        pass
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
@@ -195,22 +398,173 @@ class Characteristic(dbus.service.Object):
         print('Default StopNotify called, returning error')
         raise NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.acquire_notify:
+            print('Default AcquireNotify called, returning error')
+            raise NotSupportedException()
+        if self._notify_sock is not None:
+            raise NotPermittedException()
+
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.settimeout(self.NOTIFY_SEND_TIMEOUT_SEC)
+        self.mtu = int(options.get('mtu', self.DEFAULT_MTU))
+        self._notify_sock = ours
+        # BlueZ closes its end once the client unsubscribes
+        self._notify_watch_id = GObject.io_add_watch(
+                ours.fileno(), GObject.IO_HUP | GObject.IO_ERR,
+                self._on_notify_sock_closed)
+        print('Notifications acquired, MTU %d' % self.mtu)
+
+        # UnixFd duplicates the descriptor, so our copy can be closed
+        fd = dbus.types.UnixFd(theirs.fileno())
+        theirs.close()
+
+        self.StartNotify()
+        return fd, dbus.UInt16(self.mtu)
+
+    def notify_acquired(self):
+        return self._notify_sock is not None
+
+    def _on_notify_sock_closed(self, fd, condition):
+        self._notify_watch_id = None
+        self._release_notify_sock()
+        return False
+
+    def _release_notify_sock(self):
+        sock = self._notify_sock
+        self._notify_sock = None
+        if sock is not None:
+            self._close_notify_sock(sock)
+
+    def _close_notify_sock(self, sock):
+        if self._notify_watch_id is not None:
+            GObject.source_remove(self._notify_watch_id)
+            self._notify_watch_id = None
+        sock.close()
+        print('Acquired notifications released')
+        if self.notifying:
+            self.StopNotify()
+        return False
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def Confirm(self):
+        print('Default Confirm called, returning error')
+        raise NotSupportedException()
+
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
 
+    def notify_value(self, value):
+        """
+        Send value (bytes, bytearray or a list of ints) to clients: written to
+        the AcquireNotify socket if BlueZ gave us one, otherwise emitted as the
+        new Value in PropertiesChanged.
+
+        One ATT notification or indication carries at most MTU - 3 bytes, a
+        longer value raises ValueError rather than reaching clients cut short.
+        """
+        sock = self._notify_sock
+        if sock is not None:
+            value = bytes(bytearray(value))
+            if len(value) > self.mtu - 3:
+                raise ValueError('%d byte value does not fit in one notification '
+                                 'at MTU %d' % (len(value), self.mtu))
+            try:
+                sock.send(value)
+                return
+            except (IOError, OSError) as e:
+                print('Writing to acquired notification socket failed, ' +
+                      'falling back to PropertiesChanged')
+                print(e)
+                # Stop using the socket now, clean up from the main loop
+                self._notify_sock = None
+                GObject.idle_add(self._close_notify_sock, sock)
+
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': dbus_bytes(value) }, [])
+
+    def get_value(self):
+        """
+        Return the value last passed to update_value() (as bytes), or None.
+        """
+        return self._value
+
+    def update_value(self, value, force=False):
+        """
+        Store value as the current value and, while notifying, emit it to
+        clients unless it is identical to the last value emitted. With
+        force=True the value is emitted even if it did not change (e.g. to
+        send the current value to a new subscriber).
+
+        Returns True if a PropertiesChanged was emitted right away.
+        """
+        value = bytes(bytearray(value))
+        with self._value_lock:
+            self._value = value
+            if not self.notifying:
+                return False
+
+            if force:
+                self._last_emitted_value = None
+
+            if self.coalesce_ms > 0:
+                if self._coalesce_pending:
+                    # The update waiting for the window is replaced by this one
+                    self.suppressed_count += 1
+                else:
+                    self._coalesce_pending = True
+                    GObject.timeout_add(self.coalesce_ms, self._flush_coalesced_value)
+                return False
+
+            if not self._should_emit(value):
+                return False
+
+        self.notify_value(value)
+        return True
+
+    def _should_emit(self, value):
+        # Must be called with _value_lock held
+        if value == self._last_emitted_value:
+            self.suppressed_count += 1
+            return False
+        self._last_emitted_value = value
+        self.emitted_count += 1
+        return True
+
+    def _flush_coalesced_value(self):
+        with self._value_lock:
+            self._coalesce_pending = False
+            value = self._value
+            emit = self.notifying and self._should_emit(value)
+        if emit:
+            self.notify_value(value)
+        # Only run once
+        return False
+
 
-class Descriptor(dbus.service.Object):
+class Descriptor(CachedDispatchObject):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
+
+    # Long and prepared writes, as for Characteristic
+    MAX_VALUE_LENGTH = None
+    declared_length = None
+
     def __init__(self, bus, index, uuid, flags, characteristic):
-        self.path = characteristic.path + '/desc' + str(index)
+        self.path = sys.intern(characteristic.path + '/desc' + str(index))
         self.bus = bus
-        self.uuid = uuid
+        self.uuid = sys.intern(uuid)
         self.flags = flags
         self.chrc = characteristic
+        self.long_write = None
+        if self.MAX_VALUE_LENGTH is not None:
+            self.long_write = LongWriteBuffer(self.MAX_VALUE_LENGTH, self.value_written,
+                                              declared_length=self.declared_length)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -241,9 +595,203 @@ class Descriptor(dbus.service.Object):
         print ('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True)
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        if self.long_write is None:
+            print('Default WriteValue called, returning error')
+            raise NotSupportedException()
+        self.long_write.write(value, options)
+
+    def value_written(self, value):
+        pass
+
+
+# Worker threads shared by every AsyncCharacteristic and AsyncDescriptor
+HANDLER_POOL_SIZE = 2
+_handler_pool = None
+
+
+def _get_handler_pool():
+    global _handler_pool
+    if _handler_pool is None:
+        _handler_pool = concurrent.futures.ThreadPoolExecutor(
+                HANDLER_POOL_SIZE, thread_name_prefix='gatt-handler')
+    return _handler_pool
+
+
+class _AsyncCall(object):
+    __slots__ = ('reply_handler', 'error_handler', 'timeout_id', 'done')
+
+    def __init__(self, reply_handler, error_handler):
+        self.reply_handler = reply_handler
+        self.error_handler = error_handler
+        self.timeout_id = None
+        self.done = False
+
+
+class AsyncHandlers(object):
+    """
+    Runs D-Bus method handlers in the shared worker pool and sends their reply
+    from the main loop once they return (for methods declared with
+    async_callbacks).
+
+    At most max_concurrent calls run or wait for a worker at once, further
+    calls are refused with InProgress.  A call still running after timeout_ms
+    gets a Failed error; its worker cannot be stopped, so it keeps counting
+    against max_concurrent until it returns.
+    """
+
+    def __init__(self, timeout_ms, max_concurrent):
+        self.timeout_ms = timeout_ms
+        self.max_concurrent = max_concurrent
+        # Only touched on the main loop
+        self.active = 0
+        self.call_count = 0
+        self.refused_count = 0
+        self.timeout_count = 0
+        self.error_count = 0
+
+    def run(self, handler, reply_handler, error_handler):
+        """
+        Call handler() in a worker, then reply_handler(*its return value) or
+        error_handler(exception raised) on the main loop.
+        """
+        if self.active >= self.max_concurrent:
+            self.refused_count += 1
+            error_handler(InProgressException())
+            return
+        self.active += 1
+        self.call_count += 1
+        call = _AsyncCall(reply_handler, error_handler)
+        call.timeout_id = GObject.timeout_add(self.timeout_ms, self._on_timeout, call)
+        _get_handler_pool().submit(self._work, handler, call)
+
+    def _work(self, handler, call):
+        try:
+            result, error = handler(), None
+        except dbus.exceptions.DBusException as e:
+            result, error = None, e
+        except Exception as e:
+            print('Handler failed')
+            print(e)
+            result, error = None, FailedException(str(e))
+        GObject.idle_add(self._finish, call, result, error)
+
+    def _finish(self, call, result, error):
+        self.active -= 1
+        if not call.done:
+            call.done = True
+            GObject.source_remove(call.timeout_id)
+            if error is not None:
+                self.error_count += 1
+                call.error_handler(error)
+            else:
+                call.reply_handler(*result)
+        return False
+
+    def _on_timeout(self, call):
+        call.done = True
+        self.timeout_count += 1
+        call.error_handler(FailedException('Timed out'))
+        return False
+
+    def as_dict(self):
+        return {
+                'active': self.active,
+                'calls': self.call_count,
+                'refused': self.refused_count,
+                'timeouts': self.timeout_count,
+                'errors': self.error_count,
+        }
+
+
+class AsyncCharacteristic(Characteristic):
+    """
+    Characteristic whose ReadValue and WriteValue run in a worker thread, so
+    slow reads and writes (storage, heavier encoding) do not hold up the main
+    loop and with it all other BlueZ traffic.
+
+    Subclasses implement read_value(options) and write_value(value, options)
+    instead of ReadValue and WriteValue.  Both run in a worker thread.
+    """
+
+    # Longest a read or write may take before BlueZ gets an error
+    HANDLER_TIMEOUT_MS = 2000
+    # Reads and writes of one characteristic in progress at once
+    MAX_CONCURRENT_HANDLERS = 2
+
+    def __init__(self, bus, index, uuid, flags, service, coalesce_ms=0):
+        Characteristic.__init__(self, bus, index, uuid, flags, service, coalesce_ms)
+        self.handlers = AsyncHandlers(self.HANDLER_TIMEOUT_MS,
+                                      self.MAX_CONCURRENT_HANDLERS)
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='ay',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def ReadValue(self, options, reply_handler, error_handler):
+        def read():
+            return (dbus_bytes(self.read_value(options)),)
+        self.handlers.run(read, reply_handler, error_handler)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        def write():
+            self.write_value(value, options)
+            return ()
+        self.handlers.run(write, reply_handler, error_handler)
+
+    def read_value(self, options):
+        print('Default read_value called, returning error')
+        raise NotSupportedException()
+
+    def write_value(self, value, options):
+        print('Default write_value called, returning error')
+        raise NotSupportedException()
+
+
+class AsyncDescriptor(Descriptor):
+    """
+    Descriptor whose ReadValue and WriteValue run in a worker thread (see
+    AsyncCharacteristic).  Subclasses implement read_value(options) and
+    write_value(value, options).
+    """
+
+    HANDLER_TIMEOUT_MS = 2000
+    MAX_CONCURRENT_HANDLERS = 2
+
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        Descriptor.__init__(self, bus, index, uuid, flags, characteristic)
+        self.handlers = AsyncHandlers(self.HANDLER_TIMEOUT_MS,
+                                      self.MAX_CONCURRENT_HANDLERS)
+
+    @dbus.service.method(GATT_DESC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='ay',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def ReadValue(self, options, reply_handler, error_handler):
+        def read():
+            return (dbus_bytes(self.read_value(options)),)
+        self.handlers.run(read, reply_handler, error_handler)
+
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True,
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        def write():
+            self.write_value(value, options)
+            return ()
+        self.handlers.run(write, reply_handler, error_handler)
+
+    def read_value(self, options):
+        print('Default read_value called, returning error')
+        raise NotSupportedException()
+
+    def write_value(self, value, options):
+        print('Default write_value called, returning error')
         raise NotSupportedException()
 
 
@@ -276,15 +824,15 @@ class HeartRateMeasurementChrc(Characteristic):
         self.hr_ee_count = 0
 
     def hr_msrmt_cb(self):
-        value = []
-        value.append(dbus.Byte(0x06))
+        value = bytearray()
+        value.append(0x06)
 
-        value.append(dbus.Byte(randint(90, 130)))
+        value.append(randint(90, 130))
 
         if self.hr_ee_count % 10 == 0:
-            value[0] = dbus.Byte(value[0] | 0x08)
-            value.append(dbus.Byte(self.service.energy_expended & 0xff))
-            value.append(dbus.Byte((self.service.energy_expended >> 8) & 0xff))
+            value[0] = value[0] | 0x08
+            value.append(self.service.energy_expended & 0xff)
+            value.append((self.service.energy_expended >> 8) & 0xff)
 
         self.service.energy_expended = \
                 min(0xffff, self.service.energy_expended + 1)
@@ -292,7 +840,7 @@ class HeartRateMeasurementChrc(Characteristic):
 
         print('Updating value: ' + repr(value))
 
-        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
+        self.update_value(value)
 
         return self.notifying
 
@@ -333,7 +881,7 @@ class BodySensorLocationChrc(Characteristic):
 
     def ReadValue(self, options):
         # Return 'Chest' as the sensor location.
-        return [ 0x01 ]
+        return b'\x01'
 
 class HeartRateControlPointChrc(Characteristic):
     HR_CTRL_PT_UUID = '00002a39-0000-1000-8000-00805f9b34fb'
@@ -391,12 +939,12 @@ class BatteryLevelCharacteristic(Characteristic):
         self.battery_lvl = 100
         GObject.timeout_add(5000, self.drain_battery)
 
-    def notify_battery_level(self):
+    def notify_battery_level(self, force=False):
         if not self.notifying:
             return
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                { 'Value': [dbus.Byte(self.battery_lvl)] }, [])
+        # An empty battery keeps "draining" to 0, which the value store
+        #   suppresses instead of re-sending every 5 seconds
+        self.update_value(bytearray([self.battery_lvl]), force)
 
     def drain_battery(self):
         if not self.notifying:
@@ -411,7 +959,7 @@ class BatteryLevelCharacteristic(Characteristic):
 
     def ReadValue(self, options):
         print('Battery Level read: ' + repr(self.battery_lvl))
-        return [dbus.Byte(self.battery_lvl)]
+        return bytes(bytearray([self.battery_lvl]))
 
     def StartNotify(self):
         if self.notifying:
@@ -419,7 +967,7 @@ class BatteryLevelCharacteristic(Characteristic):
             return
 
         self.notifying = True
-        self.notify_battery_level()
+        self.notify_battery_level(force=True)
 
     def StopNotify(self):
         if not self.notifying:
@@ -445,28 +993,32 @@ class TestService(Service):
 
 class TestCharacteristic(Characteristic):
     """
-    Dummy test characteristic. Allows writing arbitrary bytes to its value, and
-    contains "extended properties", as well as a test descriptor.
+    Dummy test characteristic. Allows writing arbitrary bytes to its value,
+    including long and reliable writes, and contains "extended properties",
+    as well as a test descriptor.
 
     """
     TEST_CHRC_UUID = '12345678-1234-5678-1234-56789abcdef1'
 
+    # The longest attribute value ATT allows
+    MAX_VALUE_LENGTH = 512
+
     def __init__(self, bus, index, service):
         Characteristic.__init__(
                 self, bus, index,
                 self.TEST_CHRC_UUID,
-                ['read', 'write', 'writable-auxiliaries'],
+                ['read', 'write', 'reliable-write', 'writable-auxiliaries'],
                 service)
-        self.value = []
+        self.value = b''
         self.add_descriptor(TestDescriptor(bus, 0, self))
         self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 1, self))
 
     def ReadValue(self, options):
         print('TestCharacteristic Read: ' + repr(self.value))
-        return self.value
+        return self.value[int(options.get('offset', 0)):]
 
-    def WriteValue(self, value, options):
+    def value_written(self, value):
         print('TestCharacteristic Write: ' + repr(value))
         self.value = value
 
@@ -486,9 +1038,7 @@ class TestDescriptor(Descriptor):
                 characteristic)
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        return b'Test'
 
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
@@ -498,22 +1048,27 @@ class CharacteristicUserDescriptionDescriptor(Descriptor):
     """
     CUD_UUID = '2901'
 
+    MAX_VALUE_LENGTH = 512
+
     def __init__(self, bus, index, characteristic):
         self.writable = 'writable-auxiliaries' in characteristic.flags
-        self.value = array.array('B', b'This is a characteristic for testing')
-        self.value = self.value.tolist()
+        self.value = b'This is a characteristic for testing'
         Descriptor.__init__(
                 self, bus, index,
                 self.CUD_UUID,
                 ['read', 'write'],
                 characteristic)
+        self.long_write.set(self.value)
 
     def ReadValue(self, options):
-        return self.value
+        return self.value[int(options.get('offset', 0)):]
 
     def WriteValue(self, value, options):
         if not self.writable:
             raise NotPermittedException()
+        Descriptor.WriteValue(self, value, options)
+
+    def value_written(self, value):
         self.value = value
 
 class TestEncryptCharacteristic(Characteristic):
@@ -529,7 +1084,7 @@ class TestEncryptCharacteristic(Characteristic):
                 self.TEST_CHRC_UUID,
                 ['encrypt-read', 'encrypt-write'],
                 service)
-        self.value = []
+        self.value = b''
         self.add_descriptor(TestEncryptDescriptor(bus, 2, self))
         self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 3, self))
@@ -557,9 +1112,7 @@ class TestEncryptDescriptor(Descriptor):
                 characteristic)
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        return b'Test'
 
 
 class TestSecureCharacteristic(Characteristic):
@@ -575,7 +1128,7 @@ class TestSecureCharacteristic(Characteristic):
                 self.TEST_CHRC_UUID,
                 ['secure-read', 'secure-write'],
                 service)
-        self.value = []
+        self.value = b''
         self.add_descriptor(TestSecureDescriptor(bus, 2, self))
         self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 3, self))
@@ -604,9 +1157,7 @@ class TestSecureDescriptor(Descriptor):
                 characteristic)
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        return b'Test'
 
 def register_app_cb():
     print('GATT application registered')
@@ -0,0 +1,192 @@
+######################################################
+#
+# Builds stp.pyz, a self-contained zipapp of the GATT
+#   server for ble-stp.service
+#
+# Booting through start_server.sh costs seconds on the
+#   Pi's SD card: conda activation, then compiling every
+#   .py file whose __pycache__ entry is missing or stale.
+#   The zipapp holds the server (as stp_server) and every
+#   module of this repo it imports as bytecode compiled
+#   ahead of time with optimize=2 (no asserts, no
+#   docstrings), and systemd starts it with the
+#   environment's interpreter directly
+#
+# The bytecode only loads in the Python version that built
+#   it, so build with the interpreter that runs the service:
+#     /home/pi/berryconda3/envs/smart-trash-picker/bin/python build_zipapp.py
+#   and rebuild after every pull
+#
+# Import-time report: which modules dominate startup
+#     python build_zipapp.py --import-report
+#   uses -X importtime on Python 3.7+, and an __import__
+#   hook printing the same format on older versions
+#
+#####################################################
+
+import argparse
+import ast
+import os
+import py_compile
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = 'my-gatt-server.py'
+SERVER_MODULE = 'stp_server'
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, 'stp.pyz')
+
+MAIN_PY = '''import runpy
+runpy.run_module(%r, run_name='__main__', alter_sys=True)
+''' % SERVER_MODULE
+
+
+def _local_imports(path):
+    """Names of the modules of this repo imported anywhere in path
+        (including imports inside functions)
+    """
+    with open(path) as source:
+        tree = ast.parse(source.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    return set(name for name in names
+               if os.path.isfile(os.path.join(REPO_DIR, name + '.py')))
+
+
+def find_modules():
+    """Return {module name: source path} for the server and everything
+        of this repo it imports
+    """
+    modules = { SERVER_MODULE: os.path.join(REPO_DIR, SERVER_SCRIPT) }
+    todo = [SERVER_MODULE]
+    while todo:
+        for name in _local_imports(modules[todo.pop()]):
+            if name not in modules:
+                modules[name] = os.path.join(REPO_DIR, name + '.py')
+                todo.append(name)
+    return modules
+
+
+def build(output, interpreter):
+    modules = find_modules()
+    tmp_dir = tempfile.mkdtemp(prefix='stp-zipapp-')
+    tmp_output = output + '.tmp'
+    with zipfile.ZipFile(tmp_output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(modules):
+            # zipimport loads name.pyc from the archive root (no __pycache__)
+            compiled = os.path.join(tmp_dir, name + '.pyc')
+            py_compile.compile(modules[name], cfile=compiled, dfile=name + '.py',
+                               doraise=True, optimize=2)
+            archive.write(compiled, name + '.pyc')
+            os.unlink(compiled)
+        archive.writestr('__main__.py', MAIN_PY)
+    os.rmdir(tmp_dir)
+
+    # Prepend the interpreter line, like zipapp does
+    with open(output, 'wb') as pyz, open(tmp_output, 'rb') as archive:
+        pyz.write(b'#!' + interpreter.encode('utf-8') + b'\n')
+        pyz.write(archive.read())
+    os.unlink(tmp_output)
+    os.chmod(output, 0o755)
+
+    print('Built %s (%d modules, %d KiB) for %s' % (
+            output, len(modules), os.path.getsize(output) // 1024, interpreter))
+    return modules
+
+
+###############################
+#     Import-time report      #
+###############################
+def _trace_imports(pyz):
+    """Import the server from pyz, printing -X importtime style lines
+        ("import time: self [us] | cumulative | imported package")
+        to stderr.  For Pythons without -X importtime
+    """
+    import builtins
+
+    original_import = builtins.__import__
+    # Time spent in nested imports, one entry per import in progress
+    child_time = []
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+        child_time.append(0.0)
+        started = time.perf_counter()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - started
+            children = child_time.pop()
+            if child_time:
+                child_time[-1] += cumulative
+            sys.stderr.write('import time: %9d | %10d | %s%s\n' % (
+                    (cumulative - children) * 1e6, cumulative * 1e6,
+                    '  ' * len(child_time), name))
+
+    sys.path.insert(0, pyz)
+    builtins.__import__ = timed_import
+    try:
+        __import__(SERVER_MODULE)
+    finally:
+        builtins.__import__ = original_import
+
+
+def import_report(pyz, top):
+    code = 'import sys; sys.path.insert(0, %r); import %s' % (pyz, SERVER_MODULE)
+    if sys.version_info >= (3, 7):
+        command = [sys.executable, '-X', 'importtime', '-c', code]
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '--trace-imports', pyz]
+
+    started = time.time()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.time() - started
+
+    modules = []
+    for line in result.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), int(cumulative_us), name.rstrip()))
+    if result.returncode != 0:
+        print(result.stderr.decode('utf-8', 'replace'))
+
+    # Top level imports are the ones that are not indented
+    total_us = sum(cumulative for _, cumulative, name in modules
+                   if not name.startswith('  '))
+    print('Importing %s from %s: %.0f ms (%.0f ms including interpreter startup)' % (
+            SERVER_MODULE, pyz, total_us / 1000.0, elapsed * 1000))
+    print('%10s %12s  %s' % ('self ms', 'cumulative', 'module'))
+    for self_us, cumulative_us, name in sorted(modules, reverse=True)[:top]:
+        print('%10.1f %12.1f  %s' % (self_us / 1000.0, cumulative_us / 1000.0,
+                                     name.strip()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help="zipapp to write (default: %s)" % DEFAULT_OUTPUT)
+    parser.add_argument('--python', default=sys.executable,
+                        help="interpreter for the #! line (default: this one)")
+    parser.add_argument('--import-report', action='store_true',
+                        help="after building, report which imports dominate startup")
+    parser.add_argument('--top', default=20, type=int,
+                        help="modules listed in the import report (default: 20)")
+    parser.add_argument('--trace-imports', metavar='PYZ', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.trace_imports:
+        _trace_imports(args.trace_imports)
+    else:
+        build(args.output, args.python)
+        if args.import_report:
+            import_report(args.output, args.top)
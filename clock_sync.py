@@ -0,0 +1,211 @@
+######################################################
+#
+# Wall clock time for picks, from the phone's clock
+#
+# The Pi Zero has no RTC and usually no network in the
+#   field, so its system clock is wherever fake-hwclock
+#   left it.  The phone writes the Current Time
+#   characteristic (0x2A2B, Current Time Service 0x1805)
+#   when it connects, and ClockSync keeps the offset from
+#   time.monotonic() to the phone's wall clock, plus the
+#   drift of our clock against the phone's once the writes
+#   span MIN_DRIFT_SPAN_SEC.  Picks are stamped through
+#   to_wall(), so their times are right however late they
+#   are delivered
+#
+# The Current Time value is local time.  If the phone also
+#   writes Local Time Information (0x2A0F) its time zone is
+#   used, otherwise the Pi's own time zone
+#
+# Current Time format (little endian, 10 bytes):
+#   uint16 year, uint8 month, uint8 day,
+#   uint8 hours, uint8 minutes, uint8 seconds,
+#   uint8 day_of_week    -> 1 = Monday .. 7, 0 = unknown
+#   uint8 fractions256   -> 1/256 seconds
+#   uint8 adjust_reason  -> bit field, ignored
+#
+# Local Time Information format (2 bytes):
+#   int8 time_zone       -> offset from UTC in 15 minutes
+#   uint8 dst_offset     -> 0, 2, 4 or 8 (15 minutes), 255 unknown
+#
+#####################################################
+
+import calendar
+import collections
+import struct
+import time
+
+
+# A write this far off our estimate is a clock change on the phone
+#   (or a new phone), not drift: start over from it
+STEP_THRESHOLD_SEC = 60.0
+
+# Only estimate drift from writes at least this far apart, writes
+#   only have a 1/256 second resolution and arrive with BLE latency
+MIN_DRIFT_SPAN_SEC = 600.0
+
+# A crystal without temperature compensation is within this
+MAX_DRIFT = 500e-6
+
+MAX_SAMPLES = 16
+
+_CURRENT_TIME = struct.Struct('<HBBBBBBBB')
+_LOCAL_TIME_INFO = struct.Struct('<bB')
+
+TIME_ZONE_UNKNOWN = -128
+DST_OFFSET_UNKNOWN = 255
+
+
+def parse_current_time(value, utc_offset=None):
+    """Unix time of a Current Time value
+
+        Arguments:
+            value: The 10 byte value (bytes)
+            utc_offset: Seconds local time is ahead of UTC, or None
+                to use the Pi's time zone
+
+        Raises ValueError for a malformed value
+    """
+    if len(value) < _CURRENT_TIME.size:
+        raise ValueError('Current Time is %d bytes' % len(value))
+    year, month, day, hours, minutes, seconds, _, fractions256, _ = \
+            _CURRENT_TIME.unpack_from(value)
+    if not (1582 <= year <= 9999 and 1 <= month <= 12 and 1 <= day <= 31 and
+            hours < 24 and minutes < 60 and seconds < 60):
+        raise ValueError('Current Time out of range')
+    fields = (year, month, day, hours, minutes, seconds)
+    if utc_offset is None:
+        wall = time.mktime(fields + (0, 0, -1))
+    else:
+        wall = calendar.timegm(fields) - utc_offset
+    return wall + fractions256 / 256.0
+
+
+def pack_current_time(wall, utc_offset=None):
+    """The Current Time value (bytes) of Unix time wall"""
+    if utc_offset is None:
+        local = time.localtime(wall)
+    else:
+        local = time.gmtime(wall + utc_offset)
+    fractions256 = int((wall % 1) * 256)
+    return _CURRENT_TIME.pack(local.tm_year, local.tm_mon, local.tm_mday,
+                              local.tm_hour, local.tm_min, local.tm_sec,
+                              local.tm_wday + 1, fractions256, 0)
+
+
+def pack_local_time_info(utc_offset):
+    """The Local Time Information value (bytes) of utc_offset (seconds or None)"""
+    if utc_offset is None:
+        return _LOCAL_TIME_INFO.pack(TIME_ZONE_UNKNOWN, DST_OFFSET_UNKNOWN)
+    # The DST offset is already part of utc_offset
+    return _LOCAL_TIME_INFO.pack(int(utc_offset // (15 * 60)), 0)
+
+
+def parse_local_time_info(value):
+    """Seconds local time is ahead of UTC, or None if the phone does not know
+
+        Raises ValueError for a malformed value
+    """
+    if len(value) != _LOCAL_TIME_INFO.size:
+        raise ValueError('Local Time Information is %d bytes' % len(value))
+    time_zone, dst_offset = _LOCAL_TIME_INFO.unpack(value)
+    if time_zone == TIME_ZONE_UNKNOWN:
+        return None
+    if dst_offset == DST_OFFSET_UNKNOWN:
+        dst_offset = 0
+    return (time_zone + dst_offset) * 15 * 60
+
+
+class ClockSync(object):
+    """Maps time.monotonic() to the phone's wall clock
+
+        sync() is called from the main loop, to_wall() and now() from
+        any thread.  The estimate is one tuple that sync() replaces,
+        so readers never see half of an update
+
+        Listeners define clock_synced(clock), called on the main loop
+        after every sync
+    """
+
+    def __init__(self):
+        # (wall, monotonic) of recent writes, oldest first
+        self._samples = collections.deque(maxlen=MAX_SAMPLES)
+        # (wall, monotonic, drift) of the latest write, or None
+        self._estimate = None
+        self._listeners = []
+        # Seconds local time is ahead of UTC, from Local Time Information
+        self.utc_offset = None
+        self.sync_count = 0
+        self.step_count = 0
+        self.last_error = None
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    @property
+    def synced(self):
+        return self._estimate is not None
+
+    def to_wall(self, monotonic):
+        """Unix time at time.monotonic() value monotonic
+
+            Before the first sync this is the system clock's time
+        """
+        estimate = self._estimate
+        if estimate is None:
+            return monotonic + (time.time() - time.monotonic())
+        wall, at, drift = estimate
+        return wall + (monotonic - at) * (1.0 + drift)
+
+    def now(self):
+        return self.to_wall(time.monotonic())
+
+    def sync(self, wall, monotonic=None):
+        """The phone's clock read wall (Unix time) at monotonic (now if None)"""
+        if monotonic is None:
+            monotonic = time.monotonic()
+
+        if self._estimate is not None:
+            self.last_error = wall - self.to_wall(monotonic)
+            if abs(self.last_error) > STEP_THRESHOLD_SEC:
+                print('Phone clock is %.1f s off our estimate, starting over' %
+                      self.last_error)
+                self._samples.clear()
+                self.step_count += 1
+        self._samples.append((wall, monotonic))
+        self._estimate = (wall, monotonic, self._drift())
+        self.sync_count += 1
+
+        for listener in self._listeners:
+            listener.clock_synced(self)
+
+    def _drift(self):
+        """Least squares slope of (wall - monotonic) over monotonic"""
+        if len(self._samples) < 2 or \
+                self._samples[-1][1] - self._samples[0][1] < MIN_DRIFT_SPAN_SEC:
+            return 0.0
+        base_wall, base_mono = self._samples[0]
+        points = [(mono - base_mono, (wall - base_wall) - (mono - base_mono))
+                  for wall, mono in self._samples]
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        variance = sum((x - mean_x) ** 2 for x, _ in points)
+        if variance == 0:
+            return 0.0
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+        return max(-MAX_DRIFT, min(MAX_DRIFT, slope))
+
+    def as_dict(self):
+        estimate = self._estimate
+        now = time.monotonic()
+        return {
+                'synced': estimate is not None,
+                'syncs': self.sync_count,
+                'steps': self.step_count,
+                'last_sync_age_sec': now - estimate[1] if estimate else None,
+                'drift_ppm': estimate[2] * 1e6 if estimate else None,
+                'last_error_sec': self.last_error,
+                # How far the system clock is from the phone's
+                'system_clock_error_sec': time.time() - self.to_wall(now),
+                'utc_offset': self.utc_offset,
+        }
@@ -0,0 +1,162 @@
+######################################################
+#
+# Per-class caches for dbus-python's object dispatch
+#
+# For every incoming call dbus.service.Object walks the
+#   class's MRO to find the @dbus.service.method handler
+#   (dbus.service._method_lookup), and every Introspect
+#   call rebuilds the interface XML from the method
+#   decorators.  Both only depend on the class, and BlueZ
+#   introspects and calls every object of our GATT tree
+#   when the application is registered
+#
+# Objects derived from CachedDispatchObject (the GATT and
+#   advertisement base classes) get both computed once per
+#   class.  Importing this module replaces
+#   dbus.service._method_lookup with a wrapper that caches
+#   lookups for those objects and leaves every other object
+#   alone.  Classes are not changed at runtime, so a cached
+#   entry never goes stale (instance attributes are not
+#   part of the lookup)
+#
+# Set enabled = False to compare against dbus-python's own
+#   behaviour (see gatt_benchmarks.py registration)
+#
+# The lookup is also where the sampling profiler times our
+#   D-Bus methods: while method_timer is set, a call of one
+#   of timed_methods is handed a wrapper that reports how
+#   long it took, until its reply for async_callbacks
+#   methods, whose work finishes in a worker thread (see
+#   sampling_profiler.py)
+#
+#####################################################
+
+import time
+
+import _dbus_bindings
+import dbus
+import dbus.service
+
+
+enabled = True
+
+# Called as method_timer(method name, seconds) once a call of one of
+#   timed_methods on a CachedDispatchObject is done, if not None
+method_timer = None
+timed_methods = frozenset()
+
+# (class, method name, interface) -> (candidate method, parent method)
+_method_cache = {}
+# class -> introspection XML of the class's interfaces
+_introspection_cache = {}
+
+_uncached_method_lookup = dbus.service._method_lookup
+
+
+def clear():
+    """Forget everything cached so far"""
+    _method_cache.clear()
+    _introspection_cache.clear()
+
+
+def _method_lookup(self, method_name, dbus_interface):
+    if not isinstance(self, CachedDispatchObject):
+        return _uncached_method_lookup(self, method_name, dbus_interface)
+
+    if enabled:
+        key = (self.__class__, method_name, dbus_interface)
+        methods = _method_cache.get(key)
+        if methods is None:
+            # Unknown methods raise here and are not cached
+            methods = _uncached_method_lookup(self, method_name, dbus_interface)
+            _method_cache[key] = methods
+    else:
+        methods = _uncached_method_lookup(self, method_name, dbus_interface)
+
+    timer = method_timer
+    if timer is not None and method_name in timed_methods:
+        candidate, parent = methods
+        return _timed(candidate, parent, method_name, timer), parent
+    return methods
+
+dbus.service._method_lookup = _method_lookup
+
+
+def _timed(method, parent, method_name, timer):
+    """method, calling timer once it has returned, or once it has
+        replied if parent declares async_callbacks
+    """
+    def timed_method(self, *args, **keywords):
+        started = time.time()
+
+        def done():
+            timer(method_name, time.time() - started)
+
+        if not parent._dbus_async_callbacks:
+            try:
+                return method(self, *args, **keywords)
+            finally:
+                done()
+
+        reply_keyword, error_keyword = parent._dbus_async_callbacks
+        reply_handler = keywords[reply_keyword]
+        error_handler = keywords[error_keyword]
+
+        def timed_reply(*retval):
+            done()
+            reply_handler(*retval)
+
+        def timed_error(exception):
+            done()
+            error_handler(exception)
+
+        keywords[reply_keyword] = timed_reply
+        keywords[error_keyword] = timed_error
+        try:
+            return method(self, *args, **keywords)
+        except Exception:
+            # dbus-python replies with the error itself
+            done()
+            raise
+
+    return timed_method
+
+
+def _interfaces_xml(cls):
+    """The <interface> elements of dbus.service.Object.Introspect for cls"""
+    interfaces = cls._dbus_class_table[cls.__module__ + '.' + cls.__name__]
+    xml = []
+    for name, funcs in interfaces.items():
+        xml.append('  <interface name="%s">\n' % name)
+        for func in funcs.values():
+            if getattr(func, '_dbus_is_method', False):
+                xml.append(cls._reflect_on_method(func))
+            elif getattr(func, '_dbus_is_signal', False):
+                xml.append(cls._reflect_on_signal(func))
+        xml.append('  </interface>\n')
+    return ''.join(xml)
+
+
+class CachedDispatchObject(dbus.service.Object):
+    """dbus.service.Object with method lookups and introspection XML
+        cached per class
+    """
+
+    @dbus.service.method(dbus.INTROSPECTABLE_IFACE, in_signature='', out_signature='s',
+                         path_keyword='object_path', connection_keyword='connection')
+    def Introspect(self, object_path, connection):
+        if not enabled:
+            return dbus.service.Object.Introspect(self, object_path, connection)
+
+        cls = self.__class__
+        interfaces = _introspection_cache.get(cls)
+        if interfaces is None:
+            interfaces = _introspection_cache[cls] = _interfaces_xml(cls)
+
+        # Only the path and the children depend on the object
+        xml = [_dbus_bindings.DBUS_INTROSPECT_1_0_XML_DOCTYPE_DECL_NODE,
+               '<node name="%s">\n' % object_path, interfaces]
+        for name in connection.list_exported_child_objects(object_path):
+            xml.append('  <node name="%s"/>\n' % name)
+        xml.append('</node>\n')
+        return ''.join(xml)
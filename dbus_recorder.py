@@ -0,0 +1,446 @@
+######################################################
+#
+# D-Bus traffic recorder and replayer
+#
+# Recording (python my-gatt-server.py --record FILE)
+#   captures every method call BlueZ makes on our objects
+#   (Application, Services, Characteristics, Descriptors,
+#   Advertisement) and every signal we emit, with the time
+#   since recording started, to a compact binary file
+#
+# Replaying (python dbus_recorder.py replay FILE) builds
+#   the same GATT application and advertisement on a
+#   private dbus-daemon (see private_bus.py) and sends the
+#   recorded calls to it again, at the original pace or as
+#   fast as possible, timing each reply.  Recordings of
+#   field problems become our regression benchmarks
+#
+# File format (little endian):
+#   b'STPDBUS1'
+#   then one record per message:
+#     uint8  kind         -> 'C' incoming call, 'S' outgoing signal
+#     double time         -> seconds since recording started
+#     str    path, interface, member, signature
+#     uint16 arg count, then each arg as an encoded value
+#   str is a uint16 length and UTF-8 bytes.  A value is a
+#   uint8 type tag (see _encode) and uint8 variant level
+#   followed by its data, so dbus types survive the trip
+#
+#####################################################
+
+import argparse
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+import dbus
+import dbus.lowlevel
+import dbus.mainloop.glib
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from latency_stats import LatencyRecorder
+
+
+MAGIC = b'STPDBUS1'
+
+CALL = b'C'
+SIGNAL = b'S'
+
+_RECORD_HEADER = struct.Struct('<cd')
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+
+# (tag, dbus type, struct) for the fixed size types, checked in order
+_FIXED_TYPES = (
+        (b'b', dbus.Boolean, struct.Struct('<B')),
+        (b'y', dbus.Byte, struct.Struct('<B')),
+        (b'n', dbus.Int16, struct.Struct('<h')),
+        (b'q', dbus.UInt16, struct.Struct('<H')),
+        (b'i', dbus.Int32, struct.Struct('<i')),
+        (b'u', dbus.UInt32, struct.Struct('<I')),
+        (b'x', dbus.Int64, struct.Struct('<q')),
+        (b't', dbus.UInt64, struct.Struct('<Q')),
+        (b'd', dbus.Double, _F64),
+)
+_FIXED_BY_TAG = dict((tag, (dbus_type, packer)) for tag, dbus_type, packer in _FIXED_TYPES)
+
+_STRING_TYPES = (
+        (b'o', dbus.ObjectPath),
+        (b'g', dbus.Signature),
+        (b's', dbus.String),
+)
+_STRING_BY_TAG = dict(_STRING_TYPES)
+
+
+###############################
+#          Encoding           #
+###############################
+def _write_str(out, text):
+    data = text.encode('utf-8')
+    out.write(_U16.pack(len(data)))
+    out.write(data)
+
+
+def _read_str(data, offset):
+    length, = _U16.unpack_from(data, offset)
+    offset += _U16.size
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def _encode(out, value):
+    variant_level = getattr(value, 'variant_level', 0)
+    for tag, dbus_type, packer in _FIXED_TYPES:
+        if isinstance(value, dbus_type):
+            out.write(tag + _U8.pack(variant_level))
+            out.write(packer.pack(value))
+            return
+    for tag, dbus_type in _STRING_TYPES:
+        if isinstance(value, dbus_type):
+            out.write(tag + _U8.pack(variant_level))
+            _write_str(out, value)
+            return
+
+    if isinstance(value, bool):
+        out.write(b'B\x00' + _U8.pack(value))
+    elif isinstance(value, int):
+        out.write(b'I\x00' + _I64.pack(value))
+    elif isinstance(value, float):
+        out.write(b'F\x00' + _F64.pack(value))
+    elif isinstance(value, str):
+        out.write(b'S\x00')
+        _write_str(out, value)
+    elif isinstance(value, bytes):
+        # dbus.ByteArray, and 'ay' received with byte_arrays=True
+        out.write(b'A' + _U8.pack(variant_level) + _U32.pack(len(value)))
+        out.write(value)
+    elif isinstance(value, dict):
+        out.write(b'e' + _U8.pack(variant_level))
+        _write_str(out, getattr(value, 'signature', None) or '')
+        out.write(_U32.pack(len(value)))
+        for key, item in value.items():
+            _encode(out, key)
+            _encode(out, item)
+    elif isinstance(value, tuple):
+        out.write(b'r' + _U8.pack(variant_level) + _U32.pack(len(value)))
+        for item in value:
+            _encode(out, item)
+    elif isinstance(value, list):
+        out.write(b'a' + _U8.pack(variant_level))
+        _write_str(out, getattr(value, 'signature', None) or '')
+        out.write(_U32.pack(len(value)))
+        for item in value:
+            _encode(out, item)
+    else:
+        # e.g. dbus.types.UnixFd, which cannot be replayed anyway
+        out.write(b'N\x00')
+
+
+def _decode(data, offset):
+    """Return (value, offset after it)"""
+    tag = data[offset:offset + 1]
+    variant_level = data[offset + 1]
+    offset += 2
+
+    fixed = _FIXED_BY_TAG.get(tag)
+    if fixed is not None:
+        dbus_type, packer = fixed
+        value, = packer.unpack_from(data, offset)
+        return dbus_type(value, variant_level=variant_level), offset + packer.size
+    string_type = _STRING_BY_TAG.get(tag)
+    if string_type is not None:
+        text, offset = _read_str(data, offset)
+        return string_type(text, variant_level=variant_level), offset
+
+    if tag == b'B':
+        return bool(data[offset]), offset + 1
+    if tag == b'I':
+        return _I64.unpack_from(data, offset)[0], offset + _I64.size
+    if tag == b'F':
+        return _F64.unpack_from(data, offset)[0], offset + _F64.size
+    if tag == b'S':
+        return _read_str(data, offset)
+    if tag == b'A':
+        length, = _U32.unpack_from(data, offset)
+        offset += _U32.size
+        return (dbus.ByteArray(data[offset:offset + length], variant_level=variant_level),
+                offset + length)
+    if tag == b'e':
+        signature, offset = _read_str(data, offset)
+        count, = _U32.unpack_from(data, offset)
+        offset += _U32.size
+        items = {}
+        for _ in range(count):
+            key, offset = _decode(data, offset)
+            items[key], offset = _decode(data, offset)
+        return dbus.Dictionary(items, signature=signature or None,
+                               variant_level=variant_level), offset
+    if tag == b'r':
+        count, = _U32.unpack_from(data, offset)
+        offset += _U32.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return dbus.Struct(items, variant_level=variant_level), offset
+    if tag == b'a':
+        signature, offset = _read_str(data, offset)
+        count, = _U32.unpack_from(data, offset)
+        offset += _U32.size
+        items = []
+        for _ in range(count):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return dbus.Array(items, signature=signature or None,
+                          variant_level=variant_level), offset
+    if tag == b'N':
+        return None, offset
+    raise ValueError('Unknown value tag %r' % tag)
+
+
+class Record(object):
+    """One recorded message"""
+
+    def __init__(self, kind, when, path, interface, member, signature, args):
+        self.kind = kind
+        self.time = when
+        self.path = path
+        self.interface = interface
+        self.member = member
+        self.signature = signature
+        self.args = args
+
+    def encode(self):
+        out = io.BytesIO()
+        out.write(_RECORD_HEADER.pack(self.kind, self.time))
+        for text in (self.path, self.interface, self.member, self.signature):
+            _write_str(out, text or '')
+        out.write(_U16.pack(len(self.args)))
+        for arg in self.args:
+            _encode(out, arg)
+        return out.getvalue()
+
+    @classmethod
+    def decode(cls, data, offset):
+        """Return (record, offset after it)"""
+        kind, when = _RECORD_HEADER.unpack_from(data, offset)
+        offset += _RECORD_HEADER.size
+        texts = []
+        for _ in range(4):
+            text, offset = _read_str(data, offset)
+            texts.append(text)
+        count, = _U16.unpack_from(data, offset)
+        offset += _U16.size
+        args = []
+        for _ in range(count):
+            arg, offset = _decode(data, offset)
+            args.append(arg)
+        return cls(kind, when, *(texts + [args])), offset
+
+
+def read_recording(path):
+    """Return the list of Records in the recording at path"""
+    with open(path, 'rb') as recording:
+        data = recording.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(path + ' is not a D-Bus recording')
+    records = []
+    offset = len(MAGIC)
+    while offset < len(data):
+        record, offset = Record.decode(data, offset)
+        records.append(record)
+    return records
+
+
+###############################
+#          Recording          #
+###############################
+class DbusRecorder(object):
+    """Records method calls to and signals from bus's exported objects
+
+        Incoming calls are seen through a message filter.  Outgoing
+        signals are seen by wrapping the connection's send_message,
+        which dbus-python also uses for emitting signals
+
+        Arguments:
+            bus: The connection our objects are exported on
+            path: File the recording is written to
+    """
+
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.path = path
+        self.call_count = 0
+        self.signal_count = 0
+        self._file = None
+        self._started = None
+        self._send_message = None
+        self._unique_name = None
+        # Signals can be emitted from the GPIO thread
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._file = open(self.path, 'wb')
+        self._file.write(MAGIC)
+        self._started = time.time()
+        self._unique_name = self.bus.get_unique_name()
+        self.bus.add_message_filter(self._on_message)
+        self._send_message = self.bus.send_message
+        self.bus.send_message = self._recording_send_message
+        print('Recording D-Bus traffic to ' + self.path)
+
+    def stop(self):
+        if self._file is None:
+            return
+        self.bus.remove_message_filter(self._on_message)
+        del self.bus.send_message
+        with self._lock:
+            self._file.close()
+            self._file = None
+        print('Recorded %d calls and %d signals' % (self.call_count, self.signal_count))
+
+    def _on_message(self, bus, message):
+        if message.get_type() == dbus.lowlevel.MESSAGE_TYPE_METHOD_CALL and \
+                message.get_destination() == self._unique_name:
+            self._write(CALL, message)
+            self.call_count += 1
+        return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+    def _recording_send_message(self, message):
+        if message.get_type() == dbus.lowlevel.MESSAGE_TYPE_SIGNAL:
+            self._write(SIGNAL, message)
+            self.signal_count += 1
+        return self._send_message(message)
+
+    def _write(self, kind, message):
+        record = Record(kind, time.time() - self._started, message.get_path(),
+                        message.get_interface(), message.get_member(),
+                        message.get_signature(),
+                        message.get_args_list(byte_arrays=True))
+        data = record.encode()
+        with self._lock:
+            if self._file is not None:
+                self._file.write(data)
+
+
+###############################
+#          Replaying          #
+###############################
+def replay(path, max_speed=False, timeout=5.0):
+    """Replay the calls in the recording at path against a fresh server
+        on a private bus.  Returns the reply latencies per method
+        (a dict of 'Interface.Member' -> LatencyRecorder) and the
+        number of calls that returned an error
+    """
+    # Imported here so dump works without dbus-daemon or the server's imports
+    from private_bus import PrivateBus
+    from pick_journal import PickJournal
+    from soak_harness import load_server_module
+
+    records = read_recording(path)
+    calls = [record for record in records if record.kind == CALL]
+    signals = len(records) - len(calls)
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    if hasattr(GObject, 'threads_init'):
+        GObject.threads_init()
+
+    server = load_server_module()
+    private_bus = PrivateBus()
+    tmp_dir = tempfile.mkdtemp(prefix='stp-replay-')
+    journal = PickJournal(os.path.join(tmp_dir, 'picks.db'))
+    mainloop = GObject.MainLoop()
+    try:
+        # The server side: the same objects my-gatt-server.py exports
+        server_bus = private_bus.connect()
+        app = server.SmartTrashPickerApplication(server_bus, journal)
+        advertisement = server.SmartTrashPickerAdvertisement(server_bus, 0)
+        loop_thread = threading.Thread(target=mainloop.run, name='replay-mainloop')
+        loop_thread.daemon = True
+        loop_thread.start()
+
+        # The BlueZ side: blocking calls from a second connection
+        client_bus = private_bus.connect()
+        destination = server_bus.get_unique_name()
+
+        latencies = {}
+        errors = 0
+        started = time.time()
+        for record in calls:
+            if not max_speed:
+                delay = started + record.time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            name = '%s.%s' % (record.interface, record.member)
+            recorder = latencies.get(name)
+            if recorder is None:
+                recorder = latencies[name] = LatencyRecorder(max(256, len(calls)))
+            sent_at = time.time()
+            try:
+                client_bus.call_blocking(destination, record.path,
+                                         record.interface or None,
+                                         record.member, record.signature,
+                                         record.args, timeout=timeout)
+            except dbus.exceptions.DBusException as e:
+                # Errors BlueZ got in the field are part of the recording too
+                errors += 1
+                print('%s on %s: %s' % (name, record.path, e.get_dbus_name()))
+            recorder.add(time.time() - sent_at)
+        elapsed = time.time() - started
+
+        print('Replayed %d calls (recording also has %d signals) in %.3f s' % (
+                len(calls), signals, elapsed))
+        app.remove_from_connection()
+        advertisement.remove_from_connection()
+        return latencies, errors
+    finally:
+        mainloop.quit()
+        journal.close()
+        private_bus.close()
+        shutil.rmtree(tmp_dir)
+
+
+def dump(path):
+    for record in read_recording(path):
+        print('%10.6f %s %s %s.%s (%s) %r' % (
+                record.time, record.kind.decode('ascii'), record.path,
+                record.interface, record.member, record.signature, record.args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    replay_parser = subparsers.add_parser('replay',
+            help="replay a recording against a server on a private bus")
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('--max-speed', action='store_true',
+                               help="send calls back to back instead of at " +
+                               "their recorded times")
+    replay_parser.add_argument('--timeout', default=5.0, type=float,
+                               help="seconds to wait for each reply (default: 5)")
+
+    dump_parser = subparsers.add_parser('dump', help="print a recording")
+    dump_parser.add_argument('recording')
+
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        latencies, errors = replay(args.recording, args.max_speed, args.timeout)
+        for name in sorted(latencies):
+            print('%-50s %s' % (name, latencies[name].percentiles()))
+        print('%d calls returned errors' % errors)
+    elif args.command == 'dump':
+        dump(args.recording)
+    else:
+        parser.print_help()
@@ -0,0 +1,210 @@
+######################################################
+#
+# Which phones are connected, from BlueZ's point of view
+#
+# BlueZ exports an org.bluez.Device1 object per remote
+#   device and reports its Connected and ServicesResolved
+#   properties through PropertiesChanged.  DevicePresence
+#   follows those signals (plus the devices already
+#   connected when it starts) and tells its listeners when
+#   a device connects, is ready for GATT traffic
+#   (ServicesResolved) and disconnects
+#
+# It also keeps per-device subscription state.  BlueZ
+#   calls StartNotify when the first device subscribes and
+#   StopNotify when the last one unsubscribes, without
+#   saying which device it was, so a StartNotify counts for
+#   every device connected at the time and a disconnect
+#   only ends the subscription of the device that left
+#
+#####################################################
+
+import sys
+import time
+
+import dbus
+
+from ble_advertisement import BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE
+
+
+DEVICE_IFACE = 'org.bluez.Device1'
+
+
+class Device(object):
+    """What we know about one remote device
+
+        Arguments:
+            path: The device's BlueZ object path
+    """
+
+    __slots__ = ('path', 'address', 'paired', 'connected', 'services_resolved',
+                 'subscribed', 'ever_subscribed', 'connected_at', 'connections')
+
+    def __init__(self, path):
+        self.path = sys.intern(path)
+        self.address = None
+        self.paired = False
+        self.connected = False
+        self.services_resolved = False
+        self.subscribed = False
+        # Has subscribed at some point since we started
+        self.ever_subscribed = False
+        self.connected_at = None
+        self.connections = 0
+
+    @property
+    def ready(self):
+        return self.connected and self.services_resolved
+
+    @property
+    def known(self):
+        """A phone we have delivered to before (bonded, or subscribed since we started)"""
+        return self.paired or self.ever_subscribed
+
+    def as_dict(self):
+        return {
+                'address': self.address,
+                'paired': self.paired,
+                'connected': self.connected,
+                'services_resolved': self.services_resolved,
+                'subscribed': self.subscribed,
+                'connected_at': self.connected_at,
+                'connections': self.connections,
+        }
+
+
+class DevicePresence(object):
+    """Tracks connected devices from Device1 property changes
+
+        Listeners may define any of
+            device_connected(device)
+            device_ready(device)
+            device_disconnected(device)
+        which are called on the main loop
+
+        Arguments:
+            bus: The system bus, or None if updates are fed to update()
+                by hand (e.g. by the soak harness's mock BlueZ)
+            adapter: Only track devices of this adapter (object path), or None
+    """
+
+    def __init__(self, bus, adapter=None):
+        self.bus = bus
+        self.adapter = adapter
+        self.devices = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def start(self):
+        """Subscribe to BlueZ's signals and look up already connected devices"""
+        self.bus.add_signal_receiver(self._on_properties_changed,
+                                     dbus_interface=DBUS_PROP_IFACE,
+                                     signal_name='PropertiesChanged',
+                                     arg0=DEVICE_IFACE,
+                                     path_keyword='path')
+        self.bus.add_signal_receiver(self._on_interfaces_removed,
+                                     dbus_interface=DBUS_OM_IFACE,
+                                     signal_name='InterfacesRemoved')
+
+        remote_om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, '/'),
+                                   DBUS_OM_IFACE)
+        remote_om.GetManagedObjects(reply_handler=self._on_managed_objects,
+                                    error_handler=self._on_managed_objects_error)
+
+    ###########################
+    # BlueZ signals           #
+    ###########################
+    def _on_managed_objects(self, objects):
+        for path, interfaces in objects.items():
+            if DEVICE_IFACE in interfaces:
+                self.update(path, interfaces[DEVICE_IFACE])
+
+    def _on_managed_objects_error(self, error):
+        print('Could not look up connected devices')
+        print(error)
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=None):
+        if interface == DEVICE_IFACE:
+            self.update(path, changed)
+
+    def _on_interfaces_removed(self, path, interfaces):
+        if DEVICE_IFACE not in interfaces:
+            return
+        device = self.devices.pop(str(path), None)
+        if device is not None and device.connected:
+            self._disconnected(device)
+
+    ###########################
+    # State                   #
+    ###########################
+    def update(self, path, properties):
+        """Apply Device1 property values (a dict) reported for path"""
+        path = str(path)
+        if self.adapter is not None and not path.startswith(self.adapter + '/'):
+            return
+
+        device = self.devices.get(path)
+        if device is None:
+            if not properties.get('Connected', False):
+                # Only keep devices that have connected to us
+                return
+            device = self.devices[path] = Device(path)
+
+        was_connected = device.connected
+        was_ready = device.ready
+        if 'Address' in properties:
+            device.address = str(properties['Address'])
+        if 'Paired' in properties:
+            device.paired = bool(properties['Paired'])
+        if 'Connected' in properties:
+            device.connected = bool(properties['Connected'])
+        if 'ServicesResolved' in properties:
+            device.services_resolved = bool(properties['ServicesResolved'])
+
+        if device.connected and not was_connected:
+            device.connected_at = time.time()
+            device.connections += 1
+            print('Device %s connected' % (device.address or device.path))
+            self._emit('device_connected', device)
+        if device.ready and not was_ready:
+            self._emit('device_ready', device)
+        if was_connected and not device.connected:
+            device.services_resolved = False
+            self._disconnected(device)
+
+    def _disconnected(self, device):
+        # Listeners still see whether the device was subscribed
+        print('Device %s disconnected' % (device.address or device.path))
+        self._emit('device_disconnected', device)
+        device.subscribed = False
+
+    def _emit(self, name, device):
+        for listener in self._listeners:
+            callback = getattr(listener, name, None)
+            if callback is not None:
+                callback(device)
+
+    def connected(self):
+        return [device for device in self.devices.values() if device.connected]
+
+    def any_connected(self):
+        return any(device.connected for device in self.devices.values())
+
+    def subscribe_connected(self):
+        """StartNotify: every connected device counts as subscribed"""
+        for device in self.connected():
+            device.subscribed = True
+            device.ever_subscribed = True
+
+    def unsubscribe_all(self):
+        """StopNotify: no device is subscribed any more"""
+        for device in self.devices.values():
+            device.subscribed = False
+
+    def any_subscribed(self):
+        return any(device.subscribed for device in self.connected())
+
+    def as_dict(self):
+        return dict((path, device.as_dict()) for path, device in self.devices.items())
@@ -0,0 +1,381 @@
+######################################################
+#
+# Edge capture in a separate process
+#
+# On the single-core Pi Zero the GPIO thread shares the GIL
+#   with D-Bus marshalling on the main loop, so an edge can
+#   sit unhandled while a large GetManagedObjects reply is
+#   built.  With EdgeCaptureProcess, gpio_poll_thread() runs
+#   in a forked process instead and hands picks to the GATT
+#   process through:
+#
+#   EventRing  a single-producer single-consumer ring of pick
+#              records in an anonymous shared mmap
+#   a pipe     one byte per pick wakes the GObject main loop,
+#              which drains the ring and calls
+#              notify_trash_grabbed()
+#
+# The ring's head is only written by the producer and its
+#   tail only by the consumer.  A record is written before
+#   the head that publishes it, and the consumer only looks
+#   at the head after being woken through the pipe.  A full
+#   ring makes the producer wait for the main loop to drain
+#   it: picks are never dropped
+#
+# The process is forked before the GATT process starts any
+#   thread (journal writer, GPS reader, GPIO watchdog...):
+#   a thread holding a lock (stdout's, the allocator's) at
+#   fork time would leave it locked forever in the child.
+#   The child only runs the GPIO pipeline and writes to the
+#   ring and the pipe; it never touches the D-Bus
+#   connection it inherits.  If it dies, the pipe reports
+#   EOF, the main loop stops watching it, and the GPIO side
+#   counts as hung, so the systemd watchdog restarts us
+#
+# Run this file directly to benchmark edge-to-queue latency
+#   under synthetic D-Bus load with a thread and a process:
+#     python edge_capture.py --edges 200 --load-ms 40
+#
+#####################################################
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from latency_stats import LatencyRecorder
+from loop_watchdog import heartbeat_age_sec
+from pick_pipeline import NotifyStage
+
+
+# Ring header, one 8-byte slot per field
+_U64 = struct.Struct('<Q')
+_F64 = struct.Struct('<d')
+_HEAD, _TAIL, _FULL, _PRESSES, _STATE, _HEARTBEAT = [i * 8 for i in range(6)]
+_HEADER_SIZE = 64
+
+# One pick: time it was complete, time it was put in the ring, press
+#   duration in milliseconds (-1 if unknown), seconds from its first
+#   press to being complete
+_RECORD = struct.Struct('<ddid')
+
+_STATES = ('starting', 'waiting', 'pressed', 'stopped')
+
+# How often a producer waiting on a full ring looks again
+_FULL_RETRY_SEC = 0.005
+
+
+class EventRing(object):
+    """Single-producer single-consumer ring of (released_at, enqueued_at,
+        duration_ms, age_sec) records in shared memory (inherited by forked children)
+
+        Arguments:
+            capacity: Number of records the ring holds
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._buf = mmap.mmap(-1, _HEADER_SIZE + capacity * _RECORD.size)
+
+    def _get(self, offset):
+        return _U64.unpack_from(self._buf, offset)[0]
+
+    def _set(self, offset, value):
+        _U64.pack_into(self._buf, offset, value)
+
+    def put(self, released_at, enqueued_at=None, duration_ms=None, age_sec=0.0):
+        """Producer side: add a record, waiting for the consumer to make
+            room if the ring is full
+        """
+        head = self._get(_HEAD)
+        if head - self._get(_TAIL) >= self.capacity:
+            self._set(_FULL, self._get(_FULL) + 1)
+            while head - self._get(_TAIL) >= self.capacity:
+                time.sleep(_FULL_RETRY_SEC)
+        if enqueued_at is None:
+            enqueued_at = time.time()
+        _RECORD.pack_into(self._buf, _HEADER_SIZE + (head % self.capacity) * _RECORD.size,
+                          released_at, enqueued_at,
+                          duration_ms if duration_ms is not None else -1, age_sec)
+        self._set(_HEAD, head + 1)
+
+    def get_all(self):
+        """Consumer side: remove and return every published record"""
+        tail = self._get(_TAIL)
+        head = self._get(_HEAD)
+        records = []
+        while tail < head:
+            records.append(_RECORD.unpack_from(
+                    self._buf, _HEADER_SIZE + (tail % self.capacity) * _RECORD.size))
+            tail += 1
+        self._set(_TAIL, tail)
+        return records
+
+    def depth(self):
+        return self._get(_HEAD) - self._get(_TAIL)
+
+    def full_count(self):
+        """How many puts found the ring full and had to wait"""
+        return self._get(_FULL)
+
+
+class SharedGpioStatus(object):
+    """GpioThreadStatus look-alike kept in an EventRing's header, so the
+        GATT process can see what the edge capture process is doing
+
+        pick_latency is local to the edge capture process
+    """
+
+    def __init__(self, ring):
+        self._ring = ring
+        self.last_press_time = None
+        self.pick_latency = LatencyRecorder()
+
+    @property
+    def state(self):
+        return _STATES[self._ring._get(_STATE)]
+
+    @state.setter
+    def state(self, value):
+        self._ring._set(_STATE, _STATES.index(value))
+
+    @property
+    def heartbeat(self):
+        value = _F64.unpack_from(self._ring._buf, _HEARTBEAT)[0]
+        return value if value else None
+
+    @heartbeat.setter
+    def heartbeat(self, value):
+        _F64.pack_into(self._ring._buf, _HEARTBEAT, value or 0.0)
+
+    @property
+    def presses(self):
+        return self._ring._get(_PRESSES)
+
+    @presses.setter
+    def presses(self, value):
+        self._ring._set(_PRESSES, value)
+
+    def as_dict(self):
+        return {
+                'state': self.state,
+                'heartbeat_age_sec': heartbeat_age_sec(self.heartbeat),
+                'presses': self.presses,
+                'ring_depth': self._ring.depth(),
+                'ring_full': self._ring.full_count(),
+        }
+
+
+class _RingSink(object):
+    """Takes the place of TrashGrabbedChrc inside the edge capture process"""
+
+    def __init__(self, ring, wake_fd):
+        self.ring = ring
+        self.wake_fd = wake_fd
+
+    def pick_stages(self, clock=time.monotonic):
+        # The rest of the pipeline runs in the GATT process
+        return [NotifyStage(self, clock)]
+
+    def notify_trash_grabbed(self, duration_ms=None, age_sec=0.0):
+        self.ring.put(time.time(), duration_ms=duration_ms, age_sec=age_sec)
+        os.write(self.wake_fd, b'\x01')
+
+
+class EdgeCaptureProcess(object):
+    """Runs poll_function (gpio_poll_thread) in a forked process and
+        delivers its picks to trash_grabbed_chrc on the main loop
+
+        start() it before this process starts any thread, see above
+
+        Arguments:
+            poll_function: gpio_poll_thread, or anything taking
+                (trash_grabbed_chrc, status=...)
+            trash_grabbed_chrc: The TrashGrabbedChrc picks are delivered to,
+                may be set after start() as long as it is before the main
+                loop runs
+            capacity: Ring size in picks
+    """
+
+    def __init__(self, poll_function, trash_grabbed_chrc=None, capacity=256):
+        self.poll_function = poll_function
+        self.trash_grabbed_chrc = trash_grabbed_chrc
+        self.ring = EventRing(capacity)
+        self.status = SharedGpioStatus(self.ring)
+        # Time from the handle release being seen to the pick being
+        #   taken out of the ring by the main loop
+        self.queue_latency = LatencyRecorder()
+        self._read_fd, self._write_fd = os.pipe()
+        self._process = None
+        self._watch_id = None
+        self.exitcode = None
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        self._process = context.Process(target=self._child_main, name='edge-capture')
+        self._process.daemon = True
+        self._process.start()
+        if threading.active_count() > 1:
+            print('Warning: edge capture process forked with %d threads running' %
+                  threading.active_count())
+        os.close(self._write_fd)
+        self._watch_id = GObject.io_add_watch(
+                self._read_fd, GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                self._on_wake)
+        print('Edge capture process started, pid %d' % self._process.pid)
+
+    def _child_main(self):
+        os.close(self._read_fd)
+        self.poll_function(_RingSink(self.ring, self._write_fd), status=self.status)
+
+    def _on_wake(self, fd, condition):
+        data = b''
+        if condition & GObject.IO_IN:
+            data = os.read(fd, 4096)
+        self.drain()
+        if data:
+            return True
+
+        # End of file: the child is gone and nobody writes to the pipe any
+        #   more, which would otherwise wake us up forever
+        self._watch_id = None
+        os.close(self._read_fd)
+        if self._process is not None:
+            self._process.join(1)
+            self.exitcode = self._process.exitcode
+        print('Edge capture process exited (code %s), no more picks' % self.exitcode)
+        self.status.state = 'stopped'
+        return False
+
+    def drain(self):
+        """Deliver every pick waiting in the ring"""
+        for released_at, enqueued_at, duration_ms, age_sec in self.ring.get_all():
+            queued_sec = time.time() - released_at
+            self.queue_latency.add(queued_sec)
+            self.trash_grabbed_chrc.notify_trash_grabbed(
+                    duration_ms if duration_ms >= 0 else None,
+                    age_sec + max(0.0, queued_sec))
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def stop(self):
+        if self._watch_id is not None:
+            GObject.source_remove(self._watch_id)
+            self._watch_id = None
+            os.close(self._read_fd)
+        if self.is_alive():
+            self._process.terminate()
+            self._process.join(1)
+
+
+###############################
+#          Benchmark          #
+###############################
+def _synthetic_dbus_load(seconds):
+    """Hold the GIL roughly the way building a big GetManagedObjects reply does"""
+    end = time.time() + seconds
+    while time.time() < end:
+        response = {}
+        for i in range(100):
+            response['/org/bluez/example/service0/char%d' % i] = {
+                    'org.bluez.GattCharacteristic1': {
+                            'UUID': '%08x-0000-1000-8000-00805f9b34fb' % i,
+                            'Flags': ['read', 'notify'],
+                            'Descriptors': ['/desc%d' % j for j in range(4)],
+                    }
+            }
+
+
+def _synthetic_edges(put, edges, interval):
+    """Producer: an edge every interval seconds, put(edge time, enqueue time)"""
+    next_edge = time.time() + interval
+    for _ in range(edges):
+        time.sleep(max(0.0, next_edge - time.time()))
+        put(next_edge, time.time())
+        next_edge += interval
+
+
+def _consume(drain, edges, load_ms, idle_ms):
+    """Main loop stand-in: bursts of D-Bus load with short idle gaps, draining
+        picks in between.  Returns (edge->enqueue, edge->dequeue) recorders
+    """
+    to_queue = LatencyRecorder(edges)
+    to_main_loop = LatencyRecorder(edges)
+    seen = 0
+    while seen < edges:
+        _synthetic_dbus_load(load_ms / 1000.0)
+        time.sleep(idle_ms / 1000.0)
+        now = time.time()
+        for record in drain():
+            edge_at, enqueued_at = record[:2]
+            to_queue.add(enqueued_at - edge_at)
+            to_main_loop.add(now - edge_at)
+            seen += 1
+    return to_queue, to_main_loop
+
+
+def bench_thread(edges, interval, load_ms, idle_ms):
+    picks = queue.Queue()
+
+    def drain():
+        records = []
+        while True:
+            try:
+                records.append(picks.get_nowait())
+            except queue.Empty:
+                return records
+
+    producer = threading.Thread(target=_synthetic_edges,
+                                args=(lambda *record: picks.put(record), edges, interval))
+    producer.start()
+    result = _consume(drain, edges, load_ms, idle_ms)
+    producer.join()
+    return result
+
+
+def bench_process(edges, interval, load_ms, idle_ms):
+    ring = EventRing(max(256, edges))
+    context = multiprocessing.get_context('fork')
+    producer = context.Process(target=_synthetic_edges, args=(ring.put, edges, interval))
+    producer.start()
+    result = _consume(ring.get_all, edges, load_ms, idle_ms)
+    producer.join()
+    return result
+
+
+def main(edges, interval_ms, load_ms, idle_ms):
+    print('%d edges every %d ms, main loop busy %d ms / idle %d ms' % (
+            edges, interval_ms, load_ms, idle_ms))
+    for name, bench in (('thread', bench_thread), ('process', bench_process)):
+        to_queue, to_main_loop = bench(edges, interval_ms / 1000.0, load_ms, idle_ms)
+        print('%-8s edge->queue %s' % (name, to_queue.percentiles()))
+        print('%-8s edge->main loop %s' % (name, to_main_loop.percentiles()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edges', default=200, type=int,
+                        help="number of synthetic edges (default: 200)")
+    parser.add_argument('--interval-ms', default=37, type=int,
+                        help="time between edges (default: 37)")
+    parser.add_argument('--load-ms', default=40, type=int,
+                        help="length of each synthetic D-Bus load burst (default: 40)")
+    parser.add_argument('--idle-ms', default=2, type=int,
+                        help="main loop idle time between bursts (default: 2)")
+    args = parser.parse_args()
+
+    main(args.edges, args.interval_ms, args.load_ms, args.idle_ms)
@@ -0,0 +1,357 @@
+######################################################
+#
+# Micro-benchmarks for the GATT server classes in
+#   ble_gatt_server.py
+#
+# Usage:
+#   python gatt_benchmarks.py values
+#       Marshalling cost of characteristic values built as
+#       lists of dbus.Byte versus a single dbus.ByteArray
+#   python gatt_benchmarks.py notify
+#       Notifications/second and CPU per notification sent as
+#       PropertiesChanged signals versus written to an
+#       AcquireNotify socket (needs dbus-daemon, see
+#       private_bus.py)
+#   python gatt_benchmarks.py registration
+#       Time for a client to fetch and introspect GATT trees
+#       of 10, 100 and 500 characteristics the way BlueZ
+#       does on registration, with and without the per-class
+#       dispatch caches in dbus_cache.py
+#   python gatt_benchmarks.py async
+#       Main loop latency while slow reads are in flight, with
+#       ReadValue run on the main loop versus in a worker
+#       (AsyncCharacteristic)
+#
+#####################################################
+
+import argparse
+import os
+import socket
+import threading
+import time
+
+import dbus
+import dbus.lowlevel
+import dbus.mainloop.glib
+import dbus.service
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+import dbus_cache
+from ble_gatt_server import Application, AsyncCharacteristic, Characteristic, \
+        Descriptor, Service, dbus_bytes, DBUS_OM_IFACE, DBUS_PROP_IFACE, \
+        GATT_CHRC_IFACE
+from latency_stats import LatencyRecorder
+from private_bus import PrivateBus
+
+
+def _time_per_call(func, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        func()
+    return (time.time() - start) / iterations
+
+
+def bench_values(sizes, iterations):
+    """Time building and marshalling a value of each size in sizes,
+        both as a PropertiesChanged signal and as a ReadValue reply ('ay')
+    """
+    path = '/org/bluez/example/service0/char0'
+
+    def properties_changed(make_value):
+        msg = dbus.lowlevel.SignalMessage(path, DBUS_PROP_IFACE, 'PropertiesChanged')
+        msg.append(GATT_CHRC_IFACE, { 'Value': make_value() }, [],
+                   signature='sa{sv}as')
+
+    def read_reply(make_value):
+        msg = dbus.lowlevel.SignalMessage(path, GATT_CHRC_IFACE, 'ReadValue')
+        msg.append(make_value(), signature='ay')
+
+    print('%6s  %-18s  %18s  %14s' % (
+            'bytes', 'value type', 'PropertiesChanged', 'ReadValue'))
+    for size in sizes:
+        payload = os.urandom(size)
+        variants = (
+                ('list of dbus.Byte', lambda: [dbus.Byte(b) for b in bytearray(payload)]),
+                ('dbus.ByteArray', lambda: dbus_bytes(payload)),
+        )
+        for name, make_value in variants:
+            changed_us = _time_per_call(
+                    lambda: properties_changed(make_value), iterations) * 1e6
+            read_us = _time_per_call(
+                    lambda: read_reply(make_value), iterations) * 1e6
+            print('%6d  %-18s  %15.1f us  %11.1f us' % (
+                    size, name, changed_us, read_us))
+
+
+class _NotifyBenchChrc(Characteristic):
+    acquire_notify = True
+
+    def __init__(self, bus, service):
+        Characteristic.__init__(self, bus, 0, '2a19', ['notify'], service)
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def StopNotify(self):
+        self.notifying = False
+
+
+def _report_notify(name, count, elapsed, cpu):
+    print('%-18s  %10.0f notifications/s  %8.1f us CPU/notification' % (
+            name, count / elapsed, cpu * 1e6 / count))
+
+
+def bench_notify(count, size, mtu):
+    """Send count notifications of size bytes both ways
+
+        The CPU figure is this process only: for PropertiesChanged that
+        leaves out dbus-daemon and bluetoothd, for the socket it includes
+        the thread standing in for bluetoothd
+    """
+    private_bus = PrivateBus()
+    try:
+        bus = private_bus.connect()
+        service = Service(bus, 0, '180f', True)
+        chrc = _NotifyBenchChrc(bus, service)
+        payload = os.urandom(size)
+        print('%d notifications of %d bytes, MTU %d' % (count, size, mtu))
+
+        started, cpu_started = time.time(), time.process_time()
+        for _ in range(count):
+            chrc.notify_value(payload)
+        bus.flush()
+        _report_notify('PropertiesChanged', count,
+                       time.time() - started, time.process_time() - cpu_started)
+
+        # Called directly, the way BlueZ calls it over D-Bus
+        fd, _ = chrc.AcquireNotify({ 'mtu': dbus.UInt16(mtu) })
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0, fd.take())
+
+        def bluetoothd():
+            for _ in range(count):
+                peer.recv(mtu)
+
+        reader = threading.Thread(target=bluetoothd)
+        started, cpu_started = time.time(), time.process_time()
+        reader.start()
+        for _ in range(count):
+            chrc.notify_value(payload)
+        reader.join()
+        _report_notify('AcquireNotify', count,
+                       time.time() - started, time.process_time() - cpu_started)
+
+        peer.close()
+        chrc._release_notify_sock()
+    finally:
+        private_bus.close()
+
+
+class _BenchApplication(Application):
+    """A single service with size characteristics, one descriptor each"""
+
+    def __init__(self, bus, size):
+        self.path = '/'
+        self.services = []
+        dbus.service.Object.__init__(self, bus, self.path)
+        service = Service(bus, 0, '180f', True)
+        for index in range(size):
+            chrc = Characteristic(bus, index, '%08x-0000-1000-8000-00805f9b34fb' % index,
+                                  ['read', 'notify'], service)
+            chrc.add_descriptor(Descriptor(bus, 0, '2901', ['read'], chrc))
+            service.add_characteristic(chrc)
+        self.add_service(service)
+
+    def remove(self):
+        for service in self.services:
+            for chrc in service.get_characteristics():
+                for desc in chrc.get_descriptors():
+                    desc.remove_from_connection()
+                chrc.remove_from_connection()
+            service.remove_from_connection()
+        self.remove_from_connection()
+
+
+def _register(client_bus, destination):
+    """What BlueZ does with a newly registered application: fetch the
+        tree, then introspect and read the properties of every object
+    """
+    objects = client_bus.call_blocking(destination, '/', DBUS_OM_IFACE,
+                                       'GetManagedObjects', '', [])
+    for path, interfaces in objects.items():
+        client_bus.call_blocking(destination, path, dbus.INTROSPECTABLE_IFACE,
+                                 'Introspect', '', [])
+        for interface in interfaces:
+            client_bus.call_blocking(destination, path, DBUS_PROP_IFACE,
+                                     'GetAll', 's', [interface])
+
+
+def bench_registration(sizes, rounds):
+    """Time _register() on trees of each size, with cold caches every round"""
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    if hasattr(GObject, 'threads_init'):
+        GObject.threads_init()
+
+    private_bus = PrivateBus()
+    mainloop = GObject.MainLoop()
+    loop_thread = threading.Thread(target=mainloop.run)
+    loop_thread.daemon = True
+    loop_thread.start()
+    try:
+        server_bus = private_bus.connect()
+        client_bus = private_bus.connect()
+        destination = server_bus.get_unique_name()
+
+        print('%8s  %16s  %16s  %8s' % ('chrcs', 'uncached', 'cached', 'speedup'))
+        for size in sizes:
+            app = _BenchApplication(server_bus, size)
+            best = {}
+            for cached in (False, True):
+                dbus_cache.enabled = cached
+                for _ in range(rounds):
+                    dbus_cache.clear()
+                    started = time.time()
+                    _register(client_bus, destination)
+                    elapsed = time.time() - started
+                    best[cached] = min(best.get(cached, elapsed), elapsed)
+            app.remove()
+            print('%8d  %13.1f ms  %13.1f ms  %7.2fx' % (
+                    size, best[False] * 1000, best[True] * 1000, best[False] / best[True]))
+    finally:
+        dbus_cache.enabled = True
+        mainloop.quit()
+        private_bus.close()
+
+
+class _SlowReadChrc(Characteristic):
+    """ReadValue takes delay seconds, on the main loop"""
+
+    def __init__(self, bus, index, service, delay):
+        Characteristic.__init__(self, bus, index, '2a19', ['read'], service)
+        self.delay = delay
+
+    def ReadValue(self, options):
+        time.sleep(self.delay)
+        return dbus_bytes(b'\x00' * 20)
+
+
+class _SlowAsyncReadChrc(AsyncCharacteristic):
+    """The same read, in a worker"""
+
+    def __init__(self, bus, index, service, delay):
+        AsyncCharacteristic.__init__(self, bus, index, '2a19', ['read'], service)
+        self.delay = delay
+
+    def read_value(self, options):
+        time.sleep(self.delay)
+        return b'\x00' * 20
+
+
+def bench_async(reads, delay, tick_ms):
+    """Read a characteristic whose reads take delay seconds, reads times,
+        while a tick_ms main loop timer records how late it fires
+    """
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    if hasattr(GObject, 'threads_init'):
+        GObject.threads_init()
+
+    private_bus = PrivateBus()
+    mainloop = GObject.MainLoop()
+    loop_thread = threading.Thread(target=mainloop.run)
+    loop_thread.daemon = True
+    loop_thread.start()
+    try:
+        server_bus = private_bus.connect()
+        client_bus = private_bus.connect()
+        destination = server_bus.get_unique_name()
+        service = Service(server_bus, 0, '180f', True)
+        chrcs = [('main loop', _SlowReadChrc(server_bus, 0, service, delay)),
+                 ('worker', _SlowAsyncReadChrc(server_bus, 1, service, delay))]
+
+        print('%d reads taking %.0f ms each, %d ms main loop timer' % (
+                reads, delay * 1000, tick_ms))
+        print('%-10s  %10s  %10s  %10s  %10s' % ('ReadValue', 'reads/s',
+                                                 'late p50', 'late p99', 'late max'))
+        for name, chrc in chrcs:
+            lateness = LatencyRecorder(size=4096)
+            ticking = { 'next': time.time() + tick_ms / 1000.0 }
+
+            # Bound now: the timer must record into this pass' results
+            #   even if it fires once more after the next pass started
+            def tick(lateness=lateness, ticking=ticking):
+                now = time.time()
+                lateness.add(max(0.0, now - ticking['next']))
+                ticking['next'] = now + tick_ms / 1000.0
+                return True
+
+            tick_source = GObject.timeout_add(tick_ms, tick)
+            started = time.time()
+            for _ in range(reads):
+                client_bus.call_blocking(destination, chrc.path, GATT_CHRC_IFACE,
+                                         'ReadValue', 'a{sv}', [{}])
+            elapsed = time.time() - started
+            GObject.source_remove(tick_source)
+
+            late = lateness.percentiles()
+            print('%-10s  %10.1f  %7.1f ms  %7.1f ms  %7.1f ms' % (
+                    name, reads / elapsed, late.get('p50_ms', 0),
+                    late.get('p99_ms', 0), late.get('max_ms', 0)))
+    finally:
+        mainloop.quit()
+        private_bus.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    values_parser = subparsers.add_parser('values',
+            help="marshalling cost of characteristic values")
+    values_parser.add_argument('--sizes', default='20,244,512',
+                               help="comma separated value sizes in bytes " +
+                               "(default: 20,244,512)")
+    values_parser.add_argument('--iterations', default=10000, type=int,
+                               help="iterations per measurement (default: 10000)")
+
+    notify_parser = subparsers.add_parser('notify',
+            help="PropertiesChanged versus AcquireNotify notifications")
+    notify_parser.add_argument('--count', default=20000, type=int,
+                               help="notifications per measurement (default: 20000)")
+    notify_parser.add_argument('--size', default=8, type=int,
+                               help="value size in bytes (default: 8)")
+    notify_parser.add_argument('--mtu', default=185, type=int,
+                               help="negotiated ATT MTU (default: 185)")
+
+    registration_parser = subparsers.add_parser('registration',
+            help="GATT tree registration time with and without dispatch caches")
+    registration_parser.add_argument('--sizes', default='10,100,500',
+                                     help="comma separated characteristic counts " +
+                                     "(default: 10,100,500)")
+    registration_parser.add_argument('--rounds', default=5, type=int,
+                                     help="rounds per measurement, the best is " +
+                                     "reported (default: 5)")
+
+    async_parser = subparsers.add_parser('async',
+            help="main loop latency during slow reads, synchronous versus async")
+    async_parser.add_argument('--reads', default=20, type=int,
+                              help="reads per measurement (default: 20)")
+    async_parser.add_argument('--delay-ms', default=100, type=float,
+                              help="time each read takes (default: 100)")
+    async_parser.add_argument('--tick-ms', default=10, type=int,
+                              help="main loop timer period (default: 10)")
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'values':
+        bench_values([int(size) for size in args.sizes.split(',')], args.iterations)
+    elif args.benchmark == 'notify':
+        bench_notify(args.count, args.size, args.mtu)
+    elif args.benchmark == 'registration':
+        bench_registration([int(size) for size in args.sizes.split(',')], args.rounds)
+    elif args.benchmark == 'async':
+        bench_async(args.reads, args.delay_ms / 1000.0, args.tick_ms)
+    else:
+        parser.print_help()
@@ -0,0 +1,383 @@
+######################################################
+#
+# On-device GPS for tagging picks with their location
+#
+# Reads a UART GPS module (e.g. on /dev/serial0) as a
+#   byte stream and parses its NMEA 0183 sentences
+#   incrementally.  Only GGA and RMC sentences are parsed;
+#   everything else is skipped by looking at its type in
+#   the receive buffer, without slicing out a line.  The
+#   checksum is computed over the whole sentence at once
+#   (one integer fold instead of a loop over its bytes)
+#
+# Positions are kept as fixed point integers, degrees
+#   * 1e7 (the precision of an int32, about 1 cm), so they
+#   go into a pick record without float conversions
+#
+# The reader thread publishes every fix to a FixSlot by
+#   replacing a single attribute with a new, never modified
+#   Fix, so the GPIO thread reads the latest fix without
+#   taking a lock
+#
+# Run this file directly to benchmark the parser on a
+#   recorded NMEA file (cat /dev/serial0 > drive.nmea), or
+#   on a synthetic one if no file is given:
+#     python gps_nmea.py --bench drive.nmea
+#
+#####################################################
+
+import argparse
+import functools
+import operator
+import os
+import termios
+import threading
+import time
+import tty
+
+
+DEFAULT_BAUDRATE = 9600
+
+# A fix older than this is not attached to a pick
+MAX_FIX_AGE_SEC = 10.0
+
+# NMEA sentences are at most 82 characters, anything longer is line noise
+MAX_SENTENCE_BYTES = 128
+
+REOPEN_DELAY_SEC = 5.0
+
+_E7 = 10 ** 7
+
+
+class Fix(object):
+    """One GPS position, never modified once published
+
+        Arguments:
+            lat_e7: Latitude in degrees * 1e7 (int)
+            lon_e7: Longitude in degrees * 1e7 (int)
+            quality: GGA fix quality (1 GPS, 2 DGPS, ...)
+            satellites: Satellites in use, or None (RMC has none)
+            received_at: time.monotonic() when the sentence was parsed
+    """
+
+    __slots__ = ('lat_e7', 'lon_e7', 'quality', 'satellites', 'received_at')
+
+    def __init__(self, lat_e7, lon_e7, quality, satellites, received_at):
+        self.lat_e7 = lat_e7
+        self.lon_e7 = lon_e7
+        self.quality = quality
+        self.satellites = satellites
+        self.received_at = received_at
+
+    def as_dict(self):
+        return {
+                'lat': self.lat_e7 / float(_E7),
+                'lon': self.lon_e7 / float(_E7),
+                'quality': self.quality,
+                'satellites': self.satellites,
+                'age_sec': round(time.monotonic() - self.received_at, 3),
+        }
+
+
+class FixSlot(object):
+    """The latest Fix, written by one thread and read by any
+
+        Fixes are immutable and publishing replaces one reference,
+        which is atomic, so readers always see a whole fix
+    """
+
+    __slots__ = ('fix',)
+
+    def __init__(self):
+        self.fix = None
+
+    def publish(self, fix):
+        self.fix = fix
+
+    def latest(self, max_age_sec=MAX_FIX_AGE_SEC):
+        """The latest fix, or None if there is none younger than max_age_sec"""
+        fix = self.fix
+        if fix is None or time.monotonic() - fix.received_at > max_age_sec:
+            return None
+        return fix
+
+
+def _checksum(data):
+    """XOR of all bytes of data
+
+        Folds the bytes as one integer, halving its width each
+        round, instead of looping over them in Python
+    """
+    value = int.from_bytes(data, 'little')
+    width = len(data)
+    while width > 1:
+        half = (width + 1) // 2
+        value = (value & ((1 << (8 * half)) - 1)) ^ (value >> (8 * half))
+        width = half
+    return value
+
+
+def _coordinate_e7(value, hemisphere):
+    """NMEA (d)ddmm.mmmm and its hemisphere (N/S/E/W) to degrees * 1e7
+
+        Raises ValueError for empty or malformed fields
+    """
+    dot = value.find(b'.')
+    if dot < 0:
+        dot = len(value)
+    if dot < 3:
+        raise ValueError('bad coordinate %r' % value)
+    fraction = value[dot + 1:]
+    scale = 10 ** len(fraction)
+    # Minutes * scale, rounded to the nearest 1e-7 degree below
+    minutes = int(value[dot - 2:dot] + fraction)
+    e7 = int(value[:dot - 2]) * _E7 + (minutes * _E7 + 30 * scale) // (60 * scale)
+    if hemisphere == b'S' or hemisphere == b'W':
+        return -e7
+    if hemisphere == b'N' or hemisphere == b'E':
+        return e7
+    raise ValueError('bad hemisphere %r' % hemisphere)
+
+
+class NmeaParser(object):
+    """Incremental NMEA parser, publishing GGA and RMC fixes to slot
+
+        Arguments:
+            slot: FixSlot fixes are published to
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+        self._buf = bytearray()
+
+        self.bytes_count = 0
+        self.sentence_count = 0
+        self.fix_count = 0
+        self.checksum_errors = 0
+        self.malformed_count = 0
+        self.overflow_count = 0
+
+        # RMC has no fix quality, it keeps the one of the last GGA
+        self._quality = 1
+
+    def feed(self, data):
+        """Parse the sentences completed by data (bytes read from the GPS)"""
+        self.bytes_count += len(data)
+        buf = self._buf
+        buf += data
+
+        pos = 0
+        while True:
+            start = buf.find(b'$', pos)
+            if start < 0:
+                pos = len(buf)
+                break
+            end = buf.find(b'\n', start)
+            if end < 0:
+                pos = start
+                if len(buf) - start > MAX_SENTENCE_BYTES:
+                    self.overflow_count += 1
+                    pos = len(buf)
+                break
+            pos = end + 1
+
+            self.sentence_count += 1
+            # $GPGGA, $GNRMC, ...: the type follows the two talker characters
+            if not (buf.startswith(b'GGA', start + 3, end) or
+                    buf.startswith(b'RMC', start + 3, end)):
+                continue
+            star = buf.rfind(b'*', start, end)
+            if star < 0:
+                self.malformed_count += 1
+                continue
+            body = bytes(buf[start + 1:star])
+            try:
+                expected = int(buf[star + 1:star + 3], 16)
+            except ValueError:
+                self.malformed_count += 1
+                continue
+            if _checksum(body) != expected:
+                self.checksum_errors += 1
+                continue
+            self._parse(body.split(b','))
+
+        del buf[:pos]
+
+    def _parse(self, fields):
+        try:
+            if fields[0].endswith(b'GGA'):
+                # time, lat, N/S, lon, E/W, quality, satellites, ...
+                quality = int(fields[6])
+                if quality == 0:
+                    return
+                self._quality = quality
+                fix = Fix(_coordinate_e7(fields[2], fields[3]),
+                          _coordinate_e7(fields[4], fields[5]),
+                          quality, int(fields[7]), time.monotonic())
+            else:
+                # time, status, lat, N/S, lon, E/W, ...
+                if fields[2] != b'A':
+                    return
+                fix = Fix(_coordinate_e7(fields[3], fields[4]),
+                          _coordinate_e7(fields[5], fields[6]),
+                          self._quality, None, time.monotonic())
+        except (IndexError, ValueError):
+            self.malformed_count += 1
+            return
+        self.fix_count += 1
+        self.slot.publish(fix)
+
+    def as_dict(self):
+        return {
+                'bytes': self.bytes_count,
+                'sentences': self.sentence_count,
+                'fixes': self.fix_count,
+                'checksum_errors': self.checksum_errors,
+                'malformed': self.malformed_count,
+                'overflows': self.overflow_count,
+        }
+
+
+class GpsReader(object):
+    """Reads the GPS module on a serial device in a daemon thread
+
+        Arguments:
+            device: Filepath of the serial device, e.g. /dev/serial0
+            baudrate: The module's baud rate
+    """
+
+    def __init__(self, device, baudrate=DEFAULT_BAUDRATE):
+        self.device = device
+        self.baudrate = baudrate
+        self.slot = FixSlot()
+        self.parser = NmeaParser(self.slot)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='gps-reader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def latest(self, max_age_sec=MAX_FIX_AGE_SEC):
+        """The latest fix, or None if there is no recent one"""
+        return self.slot.latest(max_age_sec)
+
+    def _open(self):
+        fd = os.open(self.device, os.O_RDONLY | os.O_NOCTTY)
+        tty.setraw(fd)
+        attrs = termios.tcgetattr(fd)
+        speed = getattr(termios, 'B%d' % self.baudrate)
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        return fd
+
+    def _run(self):
+        print('Reading GPS from %s at %d baud' % (self.device, self.baudrate))
+        while True:
+            try:
+                fd = self._open()
+                try:
+                    while True:
+                        data = os.read(fd, 1024)
+                        if not data:
+                            break
+                        self.parser.feed(data)
+                finally:
+                    os.close(fd)
+            except (OSError, termios.error) as e:
+                print('GPS read failed')
+                print(e)
+            time.sleep(REOPEN_DELAY_SEC)
+
+    def as_dict(self):
+        fix = self.slot.fix
+        stats = self.parser.as_dict()
+        stats['device'] = self.device
+        stats['alive'] = self._thread is not None and self._thread.is_alive()
+        stats['fix'] = fix.as_dict() if fix is not None else None
+        return stats
+
+
+###############################
+#          Benchmark          #
+###############################
+def _sentence(body):
+    checksum = functools.reduce(operator.xor, body.encode('ascii'), 0)
+    return '$%s*%02X\r\n' % (body, checksum)
+
+
+def synthetic_nmea(seconds):
+    """A recording like a 1 Hz module's: GGA, GSA, GSV, RMC and VTG per second"""
+    lines = []
+    for second in range(seconds):
+        clock = '%02d%02d%02d.00' % (second // 3600 % 24, second // 60 % 60, second % 60)
+        minutes = 7.038 + second * 0.0001
+        lat = '40%07.4f' % minutes
+        lon = '088%07.4f' % (14.412 + second * 0.0001)
+        lines.append(_sentence('GPGGA,%s,%s,N,%s,W,1,08,0.9,228.4,M,-33.9,M,,' % (
+                clock, lat, lon)))
+        lines.append(_sentence('GPGSA,A,3,04,05,09,12,24,25,29,31,,,,,1.8,0.9,1.5'))
+        lines.append(_sentence('GPGSV,2,1,08,04,56,045,41,05,40,305,38,09,23,101,35,12,65,210,44'))
+        lines.append(_sentence('GPGSV,2,2,08,24,18,150,30,25,32,270,36,29,12,330,28,31,45,060,40'))
+        lines.append(_sentence('GPRMC,%s,A,%s,N,%s,W,0.4,84.4,230394,003.1,W' % (
+                clock, lat, lon)))
+        lines.append(_sentence('GPVTG,84.4,T,87.5,M,0.4,N,0.7,K'))
+    return ''.join(lines).encode('ascii')
+
+
+def main(path, seconds, chunk, baudrate, rounds):
+    if path:
+        with open(path, 'rb') as recording:
+            data = recording.read()
+    else:
+        data = synthetic_nmea(seconds)
+    chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+
+    best = None
+    for _ in range(rounds):
+        parser = NmeaParser(FixSlot())
+        started = time.process_time()
+        for piece in chunks:
+            parser.feed(piece)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    throughput = len(data) / best if best else float('inf')
+    # A UART sends one byte per 10 bits (start, 8 data, stop)
+    line_rate = baudrate / 10.0
+    print('Parsed %d bytes (%s) in %d byte reads' % (
+            len(data), path or 'synthetic, %d s at 1 Hz' % seconds, chunk))
+    print('  %d sentences, %d fixes, %d checksum errors, %d malformed' % (
+            parser.sentence_count, parser.fix_count, parser.checksum_errors,
+            parser.malformed_count))
+    print('  %.0f KiB/s, %.0f sentences/s of CPU time' % (
+            throughput / 1024, parser.sentence_count / best if best else float('inf')))
+    print('  CPU at a saturated %d baud line: %.3f %%' % (
+            baudrate, 100.0 * line_rate / throughput))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', metavar='FILE', nargs='?', const='',
+                        help="benchmark the parser on a recorded NMEA file " +
+                        "(synthetic if no file is given)")
+    parser.add_argument('--seconds', default=3600, type=int,
+                        help="length of the synthetic recording (default: 3600)")
+    parser.add_argument('--chunk', default=64, type=int,
+                        help="bytes per read fed to the parser (default: 64)")
+    parser.add_argument('--baudrate', default=DEFAULT_BAUDRATE, type=int,
+                        help="baud rate for the CPU estimate (default: %d)" % DEFAULT_BAUDRATE)
+    parser.add_argument('--rounds', default=3, type=int,
+                        help="timed rounds, the best one is reported (default: 3)")
+    parser.add_argument('--device',
+                        help="print fixes read from this serial device instead")
+    args = parser.parse_args()
+
+    if args.device:
+        reader = GpsReader(args.device, args.baudrate)
+        reader.start()
+        while True:
+            time.sleep(1)
+            print(reader.as_dict())
+    else:
+        main(args.bench, args.seconds, args.chunk, args.baudrate, args.rounds)
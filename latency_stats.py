@@ -0,0 +1,55 @@
+######################################################
+#
+# Fixed-size latency recorder
+#
+# Keeps the last N samples in a ring so that percentiles
+#   are cheap to compute on demand and memory never grows
+#
+#####################################################
+
+import array
+import threading
+
+
+class LatencyRecorder(object):
+    """Ring buffer of the most recent latency samples (in seconds)
+
+        Arguments:
+            size: Number of samples kept
+    """
+
+    __slots__ = ('size', 'count', '_samples', '_lock')
+
+    def __init__(self, size=256):
+        self.size = size
+        self.count = 0
+        # Unboxed doubles, a tenth of the memory of a list of floats
+        self._samples = array.array('d', bytes(8 * size))
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples[self.count % self.size] = seconds
+            self.count += 1
+
+    def percentiles(self):
+        """Return count and p50/p90/p99/max (in milliseconds) of the
+            samples currently in the ring
+        """
+        with self._lock:
+            samples = sorted(self._samples[:min(self.count, self.size)])
+            count = self.count
+
+        if not samples:
+            return { 'count': count }
+
+        def pick(fraction):
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000.0, 3)
+
+        return {
+                'count': count,
+                'p50_ms': pick(0.50),
+                'p90_ms': pick(0.90),
+                'p99_ms': pick(0.99),
+                'max_ms': round(samples[-1] * 1000.0, 3),
+        }
@@ -0,0 +1,234 @@
+######################################################
+#
+# Main loop stall detection and systemd integration
+#
+# A heartbeat on the GObject main loop measures how late
+#   it is scheduled (loop lag).  A monitor thread notices
+#   when the heartbeat stops and logs the main thread's
+#   stack, so we can see what wedged the loop
+#
+# When run under systemd with Type=notify and WatchdogSec=
+#   (see ble-stp.service), the heartbeat pings the watchdog
+#   only while both the main loop and the GPIO thread are
+#   healthy, so a hung unit gets restarted.  READY=1 is
+#   sent once both BlueZ registrations have succeeded, and
+#   the unit's STATUS= names the pick pipeline stages under
+#   backpressure while there are any
+#
+# Everything is timed with time.monotonic(): the Pi has no
+#   RTC, and the wall clock steps when NTP or fake-hwclock
+#   sets it, which would look like (or hide) a stall
+#
+#####################################################
+
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from latency_stats import LatencyRecorder
+
+
+HEARTBEAT_MS = 250
+STALL_THRESHOLD_MS = 1000
+
+# The GPIO thread counts as hung if it has not been heard from in this long
+GPIO_STALE_SEC = 10
+
+
+def sd_notify(state):
+    """Send state (e.g. 'READY=1') to systemd, if we were started by it
+
+        Returns True if the message was sent
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state.encode('utf-8'), address)
+        return True
+    except (IOError, OSError) as e:
+        print('sd_notify failed')
+        print(e)
+        return False
+    finally:
+        sock.close()
+
+
+def heartbeat_age_sec(heartbeat):
+    """Seconds since heartbeat (a time.monotonic()), or None if there was none"""
+    if heartbeat is None:
+        return None
+    return round(time.monotonic() - heartbeat, 3)
+
+
+def watchdog_interval_sec():
+    """Return the systemd watchdog interval in seconds, or None if disabled"""
+    usec = os.environ.get('WATCHDOG_USEC')
+    if not usec:
+        return None
+    pid = os.environ.get('WATCHDOG_PID')
+    if pid and int(pid) != os.getpid():
+        return None
+    return int(usec) / 1e6
+
+
+class LoopWatchdog(object):
+    """Heartbeat on the main loop, stall detector and systemd watchdog
+
+        Arguments:
+            gpio_thread: The GPIO polling thread, or None
+            gpio_status: GpioThreadStatus with a heartbeat attribute, the
+                time.monotonic() its loop last ran (and optionally
+                backpressure), or None
+            heartbeat_ms: How often the heartbeat is scheduled
+            stall_threshold_ms: Heartbeat lateness that counts as a stall
+    """
+
+    def __init__(self, gpio_thread=None, gpio_status=None,
+                 heartbeat_ms=HEARTBEAT_MS, stall_threshold_ms=STALL_THRESHOLD_MS):
+        self.gpio_thread = gpio_thread
+        self.gpio_status = gpio_status
+        self.heartbeat_ms = heartbeat_ms
+        self.stall_threshold_ms = stall_threshold_ms
+
+        self.lag = LatencyRecorder()
+        self.stall_count = 0
+        self.watchdog_pings = 0
+        self.ready = False
+        self.status = None
+        self._reported_backpressure = ()
+
+        self._watchdog_sec = watchdog_interval_sec()
+        self._last_ping = None
+        self._last_beat = None
+        self._expected_beat = None
+        self._was_healthy = True
+        self._main_thread_ident = threading.current_thread().ident
+        self._monitor = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Start the heartbeat (call from the main loop's thread)"""
+        now = time.monotonic()
+        self._last_beat = now
+        self._expected_beat = now + self.heartbeat_ms / 1000.0
+        GObject.timeout_add(self.heartbeat_ms, self._on_heartbeat)
+
+        self._monitor = threading.Thread(target=self._monitor_loop,
+                                         name='loop-watchdog')
+        self._monitor.daemon = True
+        self._monitor.start()
+
+        if self._watchdog_sec:
+            print('systemd watchdog enabled, interval %.1f s' % self._watchdog_sec)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def notify_ready(self, status=None):
+        """Tell systemd we are up (only the first call does anything)"""
+        if self.ready:
+            return
+        self.ready = True
+        self.status = status
+        print('Ready %.2f s after process start' % process_uptime_sec())
+        message = 'READY=1'
+        if status:
+            message += '\nSTATUS=' + status
+        sd_notify(message)
+
+    def gpio_healthy(self):
+        if self.gpio_thread is not None and not self.gpio_thread.is_alive():
+            return False
+        if self.gpio_status is not None and self.gpio_status.heartbeat is not None:
+            return time.monotonic() - self.gpio_status.heartbeat < GPIO_STALE_SEC
+        return True
+
+    def _on_heartbeat(self):
+        now = time.monotonic()
+        self.lag.add(max(0.0, now - self._expected_beat))
+        self._last_beat = now
+        self._expected_beat = now + self.heartbeat_ms / 1000.0
+
+        healthy = self.gpio_healthy()
+        if healthy != self._was_healthy:
+            print('GPIO thread ' + ('recovered' if healthy else
+                                    'is not responding, withholding watchdog pings'))
+            self._was_healthy = healthy
+
+        self._report_backpressure()
+
+        if healthy and self._watchdog_sec and (self._last_ping is None or
+                now - self._last_ping >= self._watchdog_sec / 2.0):
+            if sd_notify('WATCHDOG=1'):
+                self.watchdog_pings += 1
+            self._last_ping = now
+
+        return True
+
+    def _report_backpressure(self):
+        backpressure = tuple(getattr(self.gpio_status, 'backpressure', None) or ())
+        if backpressure == self._reported_backpressure:
+            return
+        self._reported_backpressure = backpressure
+        if backpressure:
+            status = 'Pick pipeline backpressure: ' + ', '.join(backpressure)
+        else:
+            status = self.status or ''
+        sd_notify('STATUS=' + status)
+
+    def _monitor_loop(self):
+        threshold = self.stall_threshold_ms / 1000.0
+        stalled_beat = None
+        while not self._stop_event.wait(threshold / 2.0):
+            last_beat = self._last_beat
+            late = time.monotonic() - last_beat - self.heartbeat_ms / 1000.0
+            if late < threshold or stalled_beat == last_beat:
+                continue
+
+            # Report each stall once, with whatever the loop is stuck in
+            stalled_beat = last_beat
+            self.stall_count += 1
+            frame = sys._current_frames().get(self._main_thread_ident)
+            print('Main loop stalled for %.0f ms, main thread stack:' % (late * 1000))
+            if frame is not None:
+                print(''.join(traceback.format_stack(frame)))
+
+    def as_dict(self):
+        return {
+                'loop_lag': self.lag.percentiles(),
+                'stalls': self.stall_count,
+                'gpio_healthy': self.gpio_healthy(),
+                'watchdog_sec': self._watchdog_sec,
+                'watchdog_pings': self.watchdog_pings,
+                'backpressure': list(self._reported_backpressure),
+                'ready': self.ready,
+        }
+
+
+_PROCESS_START = time.time()
+
+
+def process_uptime_sec():
+    """Seconds since the process started (or since this module was imported)"""
+    try:
+        with open('/proc/self/stat') as stat:
+            start_ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime:
+            system_uptime = float(uptime.read().split()[0])
+        return system_uptime - start_ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return time.time() - _PROCESS_START
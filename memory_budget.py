@@ -0,0 +1,170 @@
+######################################################
+#
+# Memory benchmark and RSS budget for the Pi Zero
+#
+# Builds the GATT application (not exported on any bus,
+#   like the soak harness) with its pick journal in a
+#   fresh process, and reports RSS (measured without
+#   tracemalloc, which inflates it) and the tracemalloc
+#   peak (measured in a second process)
+#   - after startup (imports, objects, journal)
+#   - after --picks simulated picks, each one journaled,
+#     indicated and confirmed
+# for the full application and for --lean (no demo
+#   services, see my-gatt-server.py)
+#
+# The lean numbers are checked against RSS_BUDGET_KB and
+#   the run fails if they are over.  The budget is tracked
+#   per release: measure on the Pi Zero when cutting a
+#   release and lower the budget to the new numbers plus
+#   some headroom, never raise it without a reason in the
+#   commit message
+#
+# Usage:
+#   python memory_budget.py --picks 100000
+#
+#####################################################
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from contextlib import redirect_stdout
+
+
+# Lean mode RSS budget (KiB) for the current release
+RSS_BUDGET_KB = {
+        'startup': 24 * 1024,
+        'after_picks': 32 * 1024,
+}
+
+
+def _rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _measure():
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+            'rss_kb': _rss_kb(),
+            'traced_kb': current // 1024,
+            'traced_peak_kb': peak // 1024,
+    }
+
+
+def _run_process(lean, picks, trace):
+    command = [sys.executable, os.path.abspath(__file__), '--run',
+               '--picks', str(picks)]
+    if lean:
+        command.append('--lean')
+    if trace:
+        command.append('--trace')
+    return json.loads(subprocess.check_output(command).decode('utf-8'))
+
+
+def run(lean, picks, trace):
+    """Measure one configuration in this process and return the results"""
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return _run(lean, picks, trace)
+
+
+def _run(lean, picks, trace):
+    if trace:
+        tracemalloc.start()
+
+    # Imported here so the imports count towards startup
+    from pick_journal import PickJournal
+    from soak_harness import load_server_module
+    server = load_server_module()
+
+    tmp_dir = tempfile.mkdtemp(prefix='stp-memory-',
+                               dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    journal = PickJournal(os.path.join(tmp_dir, 'picks.db'))
+    try:
+        app = server.SmartTrashPickerApplication(None, journal,
+                                                 include_demo_services=not lean)
+        chrc = app.services[-1].characteristics[0]
+        startup = _measure()
+
+        started = time.time()
+        chrc.StartNotify()
+        for _ in range(picks):
+            chrc.notify_trash_grabbed()
+            # The phone confirms every indication
+            chrc.Confirm()
+        journal.flush()
+        elapsed = time.time() - started
+        after_picks = _measure()
+    finally:
+        journal.close()
+        shutil.rmtree(tmp_dir)
+        tracemalloc.stop()
+
+    return {
+            'lean': lean,
+            'services': len(app.services),
+            'picks': picks,
+            'picks_per_sec': picks / elapsed if elapsed else None,
+            'startup': startup,
+            'after_picks': after_picks,
+    }
+
+
+def main(picks):
+    results = []
+    for lean in (False, True):
+        # A fresh interpreter per measurement, so RSS is not shared
+        result = _run_process(lean, picks, trace=False)
+        traced = _run_process(lean, picks, trace=True)
+        for when in ('startup', 'after_picks'):
+            result[when]['traced_kb'] = traced[when]['traced_kb']
+            result[when]['traced_peak_kb'] = traced[when]['traced_peak_kb']
+        results.append(result)
+
+    print('%-6s %-12s %10s %12s %16s' % ('mode', 'when', 'RSS KiB', 'traced KiB',
+                                         'traced peak KiB'))
+    for result in results:
+        mode = 'lean' if result['lean'] else 'full'
+        for when in ('startup', 'after_picks'):
+            numbers = result[when]
+            print('%-6s %-12s %10d %12d %16d' % (mode, when, numbers['rss_kb'],
+                                                 numbers['traced_kb'],
+                                                 numbers['traced_peak_kb']))
+
+    lean = results[-1]
+    over = [when for when, budget in sorted(RSS_BUDGET_KB.items())
+            if lean[when]['rss_kb'] > budget]
+    for when in over:
+        print('Lean %s RSS %d KiB is over the budget of %d KiB' % (
+                when, lean[when]['rss_kb'], RSS_BUDGET_KB[when]))
+    if not over:
+        print('Within the RSS budget')
+    return not over
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--picks', default=100000, type=int,
+                        help="simulated picks (default: 100000)")
+    parser.add_argument('--run', action='store_true',
+                        help="measure one configuration and print JSON (used internally)")
+    parser.add_argument('--lean', action='store_true',
+                        help="with --run, measure the lean configuration")
+    parser.add_argument('--trace', action='store_true',
+                        help="with --run, measure with tracemalloc")
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.lean, args.picks, args.trace)))
+    else:
+        sys.exit(0 if main(args.picks) else 1)
@@ -13,6 +13,15 @@
 #   Smart Trash Picker Service UIUD: 0x1337
 #    |
 #    --> Trash Grabbed Characteristic UIUD: 0x1574
+#    --> Pick Stats Characteristic UIUD: 0x1575
+#    --> Pick Export Characteristic UIUD: 0x1576
+#   Current Time Service UIUD: 0x1805
+#    |
+#    --> Current Time Characteristic UIUD: 0x2A2B
+#    --> Local Time Information Characteristic UIUD: 0x2A0F
+#
+# Every pick is written to a durable journal (see pick_journal.py)
+#   and stays pending until it has been sent to a GATT client
 #
 #####################################################
 
@@ -22,14 +31,18 @@ import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
 
+import argparse
 import array
+import collections
+import functools
 try:
   from gi.repository import GObject
 except ImportError:
   import gobject as GObject
+import os
 import sys
-
-from random import randint
+import threading
+import time
 
 
 # Example BLE code from bluez that contains the classes 
@@ -38,9 +51,26 @@ from ble_advertisement import Advertisement, find_adapter, \
         BLUEZ_SERVICE_NAME, LE_ADVERTISING_MANAGER_IFACE, \
         DBUS_OM_IFACE, DBUS_PROP_IFACE
 from ble_gatt_server import Service, Characteristic, Descriptor, \
-        Application, \
+        Application, AsyncCharacteristic, \
         GATT_SERVICE_IFACE, GATT_CHRC_IFACE, GATT_DESC_IFACE, \
-        GATT_MANAGER_IFACE
+        GATT_MANAGER_IFACE, InvalidValueLengthException, FailedException, \
+        InvalidOffsetException
+from admin_socket import AdminServer, ADMIN_SOCKET_PATH
+from clock_sync import ClockSync, parse_current_time, pack_current_time, \
+        parse_local_time_info, pack_local_time_info
+from dbus_recorder import DbusRecorder
+from device_presence import DevicePresence
+from latency_stats import LatencyRecorder
+from loop_watchdog import LoopWatchdog, heartbeat_age_sec
+from pick_export import WINDOW_CURSOR, WINDOW_HEADER, encode_picks, export_id
+from pick_journal import PickJournal
+from pick_pipeline import PickPipeline, PickEvent, DebounceStage, ClassifyStage, \
+        EnrichStage, BufferStage, DeliverStage, QUEUE_SIZE
+from pick_record import PickRecord
+from pick_stats import PickStats
+from press_coalescer import PressCoalescer, MERGE_GAP_SEC, MIN_PRESS_SEC, \
+        MAX_PRESS_SEC
+from sampling_profiler import SamplingProfiler, install_signal_handlers
 
 
 
@@ -50,6 +80,13 @@ from ble_gatt_server import Service, Characteristic, Descriptor, \
 SMART_TRASH_PICKER_SERVICE_FULL_UIUD = '00001337-0000-1000-8000-00805f9b34fb'
 SMART_TRASH_PICKER_SERVICE_16_BIT_UIUD = '1337'
 
+# Where the durable pick journal lives: next to this script, or next to
+#   stp.pyz when running from the zipapp (see build_zipapp.py)
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if not os.path.isdir(_SCRIPT_DIR):
+    _SCRIPT_DIR = os.path.dirname(_SCRIPT_DIR)
+PICK_JOURNAL_PATH = os.path.join(_SCRIPT_DIR, 'picks.db')
+
 
 ############################################################
 # BLE Advertisment classes                                 #
@@ -72,13 +109,32 @@ class SmartTrashPickerAdvertisement(Advertisement):
         # Transport Discovery Data
         self.add_data(0x26, [0x01, 0x01, 0x00])
 
+# Status of our BlueZ registrations (reported by the admin socket)
+registration_status = {
+        'advertisement': 'pending',
+        'application': 'pending',
+}
+
+# Set in main code, tells systemd we are ready once both
+#   registrations succeeded
+loop_watchdog = None
+
+def notify_ready_if_registered():
+    if loop_watchdog is None:
+        return
+    if all(status == 'registered' for status in registration_status.values()):
+        loop_watchdog.notify_ready('Advertising and serving GATT application')
+
 # Callbacks to register with the advertising manager
 def stp_register_ad_cb():
     print("STP Advertisement registered")
+    registration_status['advertisement'] = 'registered'
+    notify_ready_if_registered()
 
 def stp_register_ad_error_cb(error):
     print("Failed to register advertisment")
     print(error)
+    registration_status['advertisement'] = 'failed: ' + str(error)
 
 
 ############################################################
@@ -88,12 +144,59 @@ def stp_register_ad_error_cb(error):
 class TrashGrabbedChrc(Characteristic):
     """BLE Characteristic that will notify/indicate when trash has been picked up
 
+        Each indication carries a packed PickRecord (see pick_record.py),
+        with the location of the latest GPS fix if there is a recent one
+
+        With a ClockSync, picks are stamped with the phone's clock.  Picks
+        made before the phone first set our clock are stamped again
+        (in the journal too) once it has
+
+        If BlueZ acquires notifications (AcquireNotify), picks are written
+        to the socket it hands us instead of going out in PropertiesChanged.
+        Either way, with a journal, up to INDICATION_WINDOW indications are kept in
+        flight until the client confirms them (BlueZ calls Confirm() for
+        each acknowledged indication, in the order they were sent).  Only
+        confirmed picks are marked delivered in the journal; the oldest
+        unconfirmed one is resent after CONFIRM_TIMEOUT_MS, and the window
+        goes back to the backlog after MAX_SEND_ATTEMPTS tries
+
+        With a DevicePresence, delivery is paused while no subscribed device
+        is connected: nothing is sent, the confirmation timer is stopped and
+        the pick pipeline's deliver stage returns right away, picks only go
+        to the journal.  The subscription itself (notifying) is kept, so
+        when a known phone is ready again (ServicesResolved) delivery
+        resumes and the backlog is flushed, without waiting for a
+        StartNotify that a bonded phone does not send
+
+        Arguments:
+            journal: PickJournal that every pick is written to, or None
+                to only keep picks in memory (sent once, never retried)
+            presence: DevicePresence tracking connected devices, or None
+            stats: PickStats every pick is counted in, or None
+            gps: GpsReader whose latest fix is attached to picks, or None
+            clock: ClockSync picks are stamped with, or None for the
+                system clock
+            confirms: False for BlueZ versions that never call Confirm():
+                picks then count as delivered once indicated, and are lost
+                if the phone does not receive them
     """
 
     # 16-bit UIUD for the TrashGrabbed characteristic
     TRASH_GRABBED_CHRC_UIUD = '1574'
 
-    def __init__(self, bus, index, service):
+    INDICATION_WINDOW = 4
+    CONFIRM_TIMEOUT_MS = 2000
+    MAX_SEND_ATTEMPTS = 3
+
+    # Picks remembered for stamping again once the clock is synced, in
+    #   case the phone never writes Current Time
+    MAX_UNSYNCED = 1024
+
+    # Let BlueZ hand us a socket for indications (see Characteristic)
+    acquire_notify = True
+
+    def __init__(self, bus, index, service, journal=None, presence=None, stats=None,
+                 gps=None, clock=None, confirms=True):
         Characteristic.__init__(
                 self, bus, index,
                 self.TRASH_GRABBED_CHRC_UIUD,
@@ -102,75 +205,619 @@ class TrashGrabbedChrc(Characteristic):
                 ['indicate'],
                 service)
         self.notifying = False
-
-
-    def notify_trash_grabbed(self):
+        self.journal = journal
+        self.stats = stats
+        self.gps = gps
+        # Sequence numbers when we have no journal to hand them out
+        self._next_seq = 0
+        # The GPIO thread and the main loop (flushing the backlog,
+        #   confirmations, timeouts) can both send picks
+        self._send_lock = threading.Lock()
+
+        # seq -> [record, time last sent, send attempts], oldest first
+        self._in_flight = collections.OrderedDict()
+        # seq of every indication sent and not confirmed yet, in the order
+        #   sent: resent picks are in here once per copy, so a late Confirm
+        #   for an earlier copy is matched with the pick it is for
+        self._sent = collections.deque()
+        # seq of copies sent before their picks went back to the backlog,
+        #   oldest first: they no longer hold up the window, but BlueZ
+        #   may still confirm them, ahead of anything sent since
+        self._stale = collections.deque(
+                maxlen=self.INDICATION_WINDOW * self.MAX_SEND_ATTEMPTS)
+        # Journal sequence number flush_backlog() carries on from, the
+        #   picks before it are in flight or delivered
+        self._send_cursor = 0
+        self._timeout_source = None
+        self.confirms = confirms
+        # No subscribed device is connected (see device_disconnected)
+        self._paused = False
+
+        self.delivered_count = 0
+        self.retry_count = 0
+        self.requeue_count = 0
+        self.confirm_rtt = LatencyRecorder()
+
+        self.presence = presence
+        if presence is not None:
+            presence.add_listener(self)
+
+        self.clock = clock
+        # (record, time.monotonic()) of picks stamped before the clock was synced
+        self._unsynced = collections.deque(maxlen=self.MAX_UNSYNCED)
+        if clock is not None:
+            clock.add_listener(self)
+
+    def notify_trash_grabbed(self, duration_ms=None, age_sec=0.0):
         """Invoke this method to notify that trash has been grabbed
             (e.g. one thread will invoke this when it sees that the
             IR sensor has been tripped in the handle)
+
+            The pick is journaled first, so it is delivered later
+            if no client is listening right now.  This runs the enrich,
+            buffer and deliver steps of the pick pipeline in one go
+            (see pick_stages())
+
+            Arguments:
+                duration_ms: How long the handle was pressed, or None
+                age_sec: How long ago the handle was first pressed
         """
         print("notify_trash_grabbed() invoked")
-        if not self.notifying:
+        record = self.new_pick(duration_ms, age_sec)
+        self.store_pick(record)
+        self.deliver_pick(record)
+
+    def pick_stages(self, clock=time.monotonic):
+        """The stages of the pick pipeline (see pick_pipeline.py) that
+            turn a classified pick into an indication, for a pipeline
+            timing its events with clock
+        """
+        # With a journal every delivery sends the whole backlog, so
+        #   deliveries waiting behind a slow one can be coalesced
+        return [EnrichStage(self, clock), BufferStage(self),
+                DeliverStage(self, coalesce=self.journal is not None)]
+
+    def new_pick(self, duration_ms=None, age_sec=0.0):
+        """Return the PickRecord of a pick first pressed age_sec ago,
+            stamped with the clock and tagged with the GPS' location and
+            duration_ms
+        """
+        if self.clock is None:
+            record = PickRecord(None, time.time() - age_sec, duration_ms=duration_ms)
+        else:
+            monotonic = time.monotonic() - age_sec
+            with self._send_lock:
+                # Checked first: if the clock is synced meanwhile, the
+                #   pick is stamped again in clock_synced
+                synced = self.clock.synced
+                record = PickRecord(None, self.clock.to_wall(monotonic),
+                                    duration_ms=duration_ms)
+                if not synced:
+                    self._unsynced.append((record, monotonic))
+        if self.gps is not None:
+            fix = self.gps.latest()
+            if fix is not None:
+                record.lat_e7 = fix.lat_e7
+                record.lon_e7 = fix.lon_e7
+        return record
+
+    def store_pick(self, record):
+        """Count record and journal it (or only number it, without a journal)"""
+        if self.stats is not None:
+            self.stats.add(record.timestamp)
+        if self.journal is None:
+            record.seq = self._next_seq
+            self._next_seq += 1
+        else:
+            self.journal.append(record)
+
+    def deliver_pick(self, record):
+        """Send a stored pick, with the backlog in front of it"""
+        if self._paused:
+            return
+        if self.journal is None:
+            self.update_value(record.pack())
+        else:
+            self.flush_backlog()
+
+    def flush_backlog(self):
+        """Send undelivered picks, oldest first, while there is room
+            in the indication window
+        """
+        if self.journal is None or not self.notifying or self._paused:
             return
 
-        # Send a random integer from 0-10 for debugging purposes
-        # The exact integer sent has no application purposes, 
-        #   but we can tell that a new indication has been sent
-        #   on the client-side if we see that the value changed
-        random_int = randint(0, 10)
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                { 'Value': [dbus.Byte(random_int)] },
-                []
-        )
+        with self._send_lock:
+            while self._window_open():
+                records = self.journal.pending_from(self._send_cursor,
+                                                    self.INDICATION_WINDOW)
+                if not records:
+                    return
+                for record in records:
+                    if not self._window_open():
+                        return
+                    if record.seq not in self._in_flight and \
+                            not self._send_pick(record):
+                        return
+                    self._send_cursor = record.seq + 1
+
+    def _window_open(self):
+        # Must be called with _send_lock held
+        # Every copy sent since the last requeue counts, a Confirm may
+        #   still come for it
+        return self.notifying and not self._paused and \
+                len(self._sent) < self.INDICATION_WINDOW
+
+    def _send_pick(self, record):
+        # Must be called with _send_lock held
+        # Forced, a pick going out again after being requeued is
+        #   not a duplicate for the value store to suppress
+        if not self.update_value(record.pack(), force=True):
+            return False
+
+        if not self.confirms:
+            self.journal.ack(record.seq)
+            self.delivered_count += 1
+            return True
+
+        self._sent.append(record.seq)
+        self._in_flight[record.seq] = [record, time.time(), 1]
+        if self._timeout_source is None:
+            self._timeout_source = GObject.timeout_add(
+                    self.CONFIRM_TIMEOUT_MS // 2, self._check_confirm_timeouts)
+        return True
+
+    def _check_confirm_timeouts(self):
+        with self._send_lock:
+            if not self._in_flight:
+                self._timeout_source = None
+                return False
+
+            oldest = next(iter(self._in_flight.values()))
+            if time.time() - oldest[1] < self.CONFIRM_TIMEOUT_MS / 1000.0:
+                return True
+
+            # Confirmations arrive in order, so nothing behind the
+            #   oldest unconfirmed indication has been confirmed either
+            if oldest[2] >= self.MAX_SEND_ATTEMPTS:
+                # They stay pending in the journal, and a late Confirm
+                #   for one of them still marks it delivered
+                print('%d indications unconfirmed, back to the backlog' % len(self._in_flight))
+                self.requeue_count += len(self._in_flight)
+                self._in_flight.clear()
+                self._stale.extend(self._sent)
+                self._sent.clear()
+                self._send_cursor = 0
+                self._timeout_source = None
+                # Send them again, once the lock is released
+                GObject.idle_add(self._resend_backlog)
+                return False
+
+            # Only the oldest is sent again, the ones behind it get their
+            #   turn once it is confirmed
+            oldest[1] = time.time()
+            oldest[2] += 1
+            self.retry_count += 1
+            self._sent.append(oldest[0].seq)
+            self.notify_value(oldest[0].pack())
+            return True
+
+    def _resend_backlog(self):
+        self.flush_backlog()
+        return False
+
+    def delivery_stats(self):
+        """Delivery counters for the admin socket"""
+        stats = {
+                'delivered': self.delivered_count,
+                'in_flight': len(self._in_flight),
+                'retried': self.retry_count,
+                'requeued': self.requeue_count,
+                'unconfirmed_sent': len(self._sent) + len(self._stale),
+                'confirms': self.confirms,
+                'paused': self._paused,
+                'confirm_rtt': self.confirm_rtt.percentiles(),
+        }
+        if self.gps is not None:
+            stats['gps'] = self.gps.as_dict()
+        if self.clock is not None:
+            stats['clock'] = self.clock.as_dict()
+            stats['unsynced'] = len(self._unsynced)
+        return stats
+
+    # ClockSync listener
+    def clock_synced(self, clock):
+        with self._send_lock:
+            unsynced = list(self._unsynced)
+            self._unsynced.clear()
+            for record, monotonic in unsynced:
+                record.timestamp = clock.to_wall(monotonic)
+                # Not journaled yet, it goes in with the new timestamp
+                if self.journal is not None and record.seq is not None:
+                    self.journal.restamp(record)
+        if unsynced:
+            print('Stamped %d picks again with the synced clock' % len(unsynced))
+
+    # DevicePresence listener
+    def device_ready(self, device):
+        if not device.known or not self.notifying:
+            return
+        # A bonded phone gets its subscription back without a new
+        #   StartNotify, so it is subscribed as soon as it is ready
+        device.subscribed = True
+        device.ever_subscribed = True
+        with self._send_lock:
+            if self._paused:
+                print('Known device ready, resuming delivery')
+            self._paused = False
+        if self.journal is not None and self.journal.pending_count():
+            print('Known device ready, flushing the backlog')
+        self.flush_backlog()
+
+    def device_disconnected(self, device):
+        if not self.notifying or self._paused:
+            return
+        if self.presence.any_connected() and \
+                (not device.subscribed or self.presence.any_subscribed()):
+            return
+        # Nobody is left to deliver to, BlueZ may not tell us
+        #   with a StopNotify
+        print('No subscribed device connected, pausing delivery')
+        self._stop_delivery(pause=True)
 
     # Implement necessary GATT_CHRC_IFACE methods
+    def Confirm(self):
+        with self._send_lock:
+            # Copies sent before a requeue were sent first, so they are
+            #   confirmed first
+            if self._stale:
+                seq = self._stale.popleft()
+            elif self._sent:
+                seq = self._sent.popleft()
+                entry = self._in_flight.pop(seq, None)
+                if entry is not None:
+                    self.confirm_rtt.add(time.time() - entry[1])
+            else:
+                print('Confirmation for an indication we are not waiting on')
+                return
+
+            # Acked already if an earlier copy was confirmed, a copy sent
+            #   before a requeue still marks its pick delivered
+            if self.journal.ack(seq):
+                self.delivered_count += 1
+
+        # Refill the window
+        self.flush_backlog()
+
     def StartNotify(self):
-        if self.notifying:
+        if self.notifying and not self._paused:
             print('Already notifying, nothing to do')
             return
 
         self.notifying = True
+        self._paused = False
+        if self.presence is not None:
+            self.presence.subscribe_connected()
+        self.flush_backlog()
 
     def StopNotify(self):
         if not self.notifying:
             print('Not notifying, nothing to do')
             return
 
-        self.notifying = False
+        # BlueZ only calls StopNotify once the last device unsubscribed
+        if self.presence is not None:
+            self.presence.unsubscribe_all()
+        self._stop_delivery()
+
+    def _stop_delivery(self, pause=False):
+        # Paused, the subscription is kept for the device to come back to
+        with self._send_lock:
+            if pause:
+                self._paused = True
+            else:
+                self.notifying = False
+                self._paused = False
+            # Whatever was not confirmed stays in the backlog, and no
+            #   Confirm comes for it any more
+            self._in_flight.clear()
+            self._sent.clear()
+            self._stale.clear()
+            self._send_cursor = 0
+            if self._timeout_source is not None:
+                GObject.source_remove(self._timeout_source)
+                self._timeout_source = None
+
+
+
+class PickStatsChrc(Characteristic):
+    """BLE Characteristic that serves one part of the pre-aggregated pick
+        statistics (see pick_stats.py): the summary of totals and peak,
+        the per-minute counts or the per-hour counts
+
+        The summary fits in one ATT read at the default MTU, the bucket
+        values do not.  BlueZ reads the rest with increasing offsets,
+        which are served from the snapshot the same device's offset 0
+        read took, so the parts are consistent even with two phones
+        reading at once
+
+        Arguments:
+            uuid: PICK_STATS_CHRC_UIUD, PICK_STATS_MINUTES_CHRC_UIUD or
+                PICK_STATS_HOURS_CHRC_UIUD
+            pack: Function returning the value (e.g. PickStats.pack_summary)
+    """
+
+    # 16-bit UIUDs for the PickStats characteristics
+    PICK_STATS_CHRC_UIUD = '1575'
+    PICK_STATS_MINUTES_CHRC_UIUD = '1577'
+    PICK_STATS_HOURS_CHRC_UIUD = '1578'
+
+    # Devices a snapshot is kept for
+    MAX_SNAPSHOTS = 8
+
+    def __init__(self, bus, index, service, uuid, pack):
+        Characteristic.__init__(
+                self, bus, index,
+                uuid,
+                ['read'],
+                service)
+        self.pack = pack
+        # Device -> value its last offset 0 read returned
+        self._snapshots = collections.OrderedDict()
+
+    def ReadValue(self, options):
+        offset = int(options.get('offset', 0))
+        device = str(options.get('device', ''))
+        snapshot = self._snapshots.get(device)
+        if offset == 0 or snapshot is None:
+            snapshot = self.pack()
+            self._snapshots.pop(device, None)
+            self._snapshots[device] = snapshot
+            while len(self._snapshots) > self.MAX_SNAPSHOTS:
+                self._snapshots.popitem(last=False)
+        if offset > len(snapshot):
+            raise InvalidOffsetException()
+        return snapshot[offset:]
+
+
+
+class PickExportChrc(AsyncCharacteristic):
+    """BLE Characteristic serving every journaled pick (the day's, see
+        RETAIN_DELIVERED_SEC) as one compressed, column-wise export
+        (see pick_export.py)
+
+        An attribute value is at most 512 bytes, so the export is served
+        in windows of up to EXPORT_WINDOW bytes.  The phone writes a
+        cursor, a snapshot id and a byte position, and reads the window
+        it points at with as many long reads as that takes.  Each window
+        starts with its snapshot id, position and the export's length,
+        the phone moves on by writing the next position.  Reads never
+        move the cursor, so a repeated read, or one that timed out while
+        its worker still finished, returns the same window again
+
+        Writing snapshot id 0 takes a new snapshot of the journal.
+        Writing any other id resumes that snapshot, and fails if it is
+        not one of the last MAX_SNAPSHOTS taken, rather than seeking into
+        different bytes.  Every device has a cursor of its own; one that
+        reads before writing a cursor gets a new snapshot
+
+        Reads and writes run in a worker thread, encoding a day of picks
+        takes a while on the Pi Zero
+    """
+
+    # 16-bit UIUD for the PickExport characteristic
+    PICK_EXPORT_CHRC_UIUD = '1576'
+
+    EXPORT_WINDOW = 512
+
+    # Snapshots kept for resuming, and devices a cursor is kept for
+    MAX_SNAPSHOTS = 2
+    MAX_CURSORS = 8
+
+    HANDLER_TIMEOUT_MS = 20000
+    # The handlers share the snapshots and the cursors
+    MAX_CONCURRENT_HANDLERS = 1
+
+    def __init__(self, bus, index, service, journal):
+        AsyncCharacteristic.__init__(
+                self, bus, index,
+                self.PICK_EXPORT_CHRC_UIUD,
+                ['read', 'write'],
+                service)
+        self.journal = journal
+        # Snapshot id -> export, oldest first
+        self._snapshots = collections.OrderedDict()
+        # Device -> (snapshot id, position), least recently written first
+        self._cursors = collections.OrderedDict()
+        self.export_count = 0
+
+    def _take_snapshot(self):
+        self.journal.flush(5)
+        export = encode_picks(self.journal.iter_picks())
+        snapshot_id = export_id(export)
+        self._snapshots.pop(snapshot_id, None)
+        self._snapshots[snapshot_id] = export
+        while len(self._snapshots) > self.MAX_SNAPSHOTS:
+            self._snapshots.popitem(last=False)
+        self.export_count += 1
+        print('Pick export %08x of %d bytes ready' % (snapshot_id, len(export)))
+        return snapshot_id
+
+    def _set_cursor(self, device, snapshot_id, position):
+        self._cursors.pop(device, None)
+        self._cursors[device] = (snapshot_id, position)
+        while len(self._cursors) > self.MAX_CURSORS:
+            self._cursors.popitem(last=False)
+
+    def read_value(self, options):
+        offset = int(options.get('offset', 0))
+        device = str(options.get('device', ''))
+        cursor = self._cursors.get(device)
+        if cursor is None:
+            cursor = (self._take_snapshot(), 0)
+            self._set_cursor(device, *cursor)
+        snapshot_id, position = cursor
+        export = self._snapshots.get(snapshot_id)
+        if export is None:
+            # Replaced by newer snapshots since the cursor was written
+            raise FailedException('Export %08x is gone, start over' % snapshot_id)
+
+        end = position + self.EXPORT_WINDOW - WINDOW_HEADER.size
+        window = WINDOW_HEADER.pack(snapshot_id, position, len(export)) + export[position:end]
+        if offset > len(window):
+            raise InvalidOffsetException()
+        return window[offset:]
+
+    def write_value(self, value, options):
+        if len(value) != WINDOW_CURSOR.size:
+            raise InvalidValueLengthException()
+        snapshot_id, position = WINDOW_CURSOR.unpack(bytes(value))
+        if snapshot_id == 0:
+            if position != 0:
+                raise InvalidOffsetException()
+            snapshot_id = self._take_snapshot()
+        export = self._snapshots.get(snapshot_id)
+        if export is None:
+            raise FailedException('Export %08x is gone, start over' % snapshot_id)
+        if position > len(export):
+            raise InvalidOffsetException()
+        self._set_cursor(str(options.get('device', '')), snapshot_id, position)
+
+
+
+class CurrentTimeChrc(Characteristic):
+    """BLE Characteristic the phone writes its clock to (see clock_sync.py)
+
+        Reading it returns our estimate of the phone's clock
+    """
+
+    CURRENT_TIME_UUID = '00002a2b-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, bus, index, service, clock):
+        Characteristic.__init__(
+                self, bus, index,
+                self.CURRENT_TIME_UUID,
+                ['read', 'write'],
+                service)
+        self.clock = clock
+
+    def ReadValue(self, options):
+        return pack_current_time(self.clock.now(), self.clock.utc_offset)
+
+    def WriteValue(self, value, options):
+        if len(value) != 10:
+            raise InvalidValueLengthException()
+        try:
+            wall = parse_current_time(value, self.clock.utc_offset)
+        except ValueError as e:
+            print(e)
+            # Data field ignored
+            raise FailedException("0x80")
+        self.clock.sync(wall)
+        print('Clock synced from the phone, system clock is %.1f s off' %
+              (time.time() - wall))
+
+
+class LocalTimeInfoChrc(Characteristic):
+    """BLE Characteristic with the phone's time zone, for interpreting
+        Current Time (which is local time).  Phones should write it
+        before Current Time
+    """
+
+    LOCAL_TIME_INFO_UUID = '00002a0f-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, bus, index, service, clock):
+        Characteristic.__init__(
+                self, bus, index,
+                self.LOCAL_TIME_INFO_UUID,
+                ['read', 'write'],
+                service)
+        self.clock = clock
+
+    def ReadValue(self, options):
+        return pack_local_time_info(self.clock.utc_offset)
+
+    def WriteValue(self, value, options):
+        try:
+            self.clock.utc_offset = parse_local_time_info(value)
+        except ValueError as e:
+            print(e)
+            raise InvalidValueLengthException()
+
+
+class CurrentTimeService(Service):
+    """BLE Current Time Service (0x1805), so the phone can set our clock
+
+        Arguments:
+            clock: ClockSync the written time goes to
+    """
+
+    CURRENT_TIME_SERVICE_UUID = '00001805-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, bus, index, clock):
+        Service.__init__(self, bus, index, self.CURRENT_TIME_SERVICE_UUID, True)
+        self.add_characteristic(CurrentTimeChrc(bus, 0, self, clock))
+        self.add_characteristic(LocalTimeInfoChrc(bus, 1, self, clock))
 
 
 
 class SmartTrashPickerService(Service):
     """BLE Service that will indicate client when trash is picked up
 
-        Only has one characteristic, namely TrashGrabbedChrc
+        Has TrashGrabbedChrc, three PickStatsChrc serving statistics
+        about the picks and, with a journal, PickExportChrc serving all
+        of them
     """
 
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, journal=None, presence=None, gps=None, clock=None,
+                 confirms=True):
         Service.__init__(self, bus, index, SMART_TRASH_PICKER_SERVICE_FULL_UIUD, True)
-        self.add_characteristic(TrashGrabbedChrc(bus, 0, self))
+        self.stats = PickStats(journal.next_seq() if journal is not None else 0,
+                               clock.now if clock is not None else time.time)
+        self.add_characteristic(TrashGrabbedChrc(bus, 0, self, journal, presence,
+                                                 self.stats, gps, clock, confirms))
+        self.add_characteristic(PickStatsChrc(bus, 1, self,
+                                              PickStatsChrc.PICK_STATS_CHRC_UIUD,
+                                              self.stats.pack_summary))
+        if journal is not None:
+            self.add_characteristic(PickExportChrc(bus, 2, self, journal))
+        self.add_characteristic(PickStatsChrc(bus, 3, self,
+                                              PickStatsChrc.PICK_STATS_MINUTES_CHRC_UIUD,
+                                              self.stats.pack_minutes))
+        self.add_characteristic(PickStatsChrc(bus, 4, self,
+                                              PickStatsChrc.PICK_STATS_HOURS_CHRC_UIUD,
+                                              self.stats.pack_hours))
 
 
 
 class SmartTrashPickerApplication(Application):
     """BLE Smart Trash Picker Application
 
-        As of now, it only contains one service, SmartTrashPickerService
+        Contains SmartTrashPickerService and CurrentTimeService (plus the
+        demo services from ble_gatt_server.py, unless include_demo_services
+        is False)
     """
 
-    def __init__(self, bus):
-        Application.__init__(self, bus)
+    def __init__(self, bus, journal=None, presence=None, include_demo_services=True,
+                 gps=None, clock=None, confirms=True):
+        Application.__init__(self, bus, include_demo_services)
+        self.clock = clock if clock is not None else ClockSync()
+        self.add_service(CurrentTimeService(bus, 37, self.clock))
         # The 36 is arbitrary
-        self.add_service(SmartTrashPickerService(bus, 36))
+        # Added last, the GPIO thread finds it as services[-1]
+        self.add_service(SmartTrashPickerService(bus, 36, journal, presence, gps,
+                                                 self.clock, confirms))
 
 # Callbacks to register when adding Application to BlueZ manager
 def register_app_cb():
     print("STP Application successfully registered")
+    registration_status['application'] = 'registered'
+    notify_ready_if_registered()
 
 def register_app_error_cb(error):
     print("Failed to register STP Application")
     print(error)
+    registration_status['application'] = 'failed: ' + str(error)
 
 
 
@@ -178,83 +825,299 @@ def register_app_error_cb(error):
 #################################
 # Entry point for GPIO thread   #
 #################################
-def gpio_poll_thread(trash_grabbed_chrc):
+class GpioThreadStatus(object):
+    """What the GPIO thread is doing, updated by the GPIO thread
+        and read by the admin socket and the LoopWatchdog
+
+        Also listens to the pick pipeline's backpressure, the
+        LoopWatchdog passes it on to systemd
+    """
+
+    def __init__(self):
+        self.state = 'starting'
+        # time.monotonic() the GPIO thread's loop last ran (for the watchdog)
+        self.heartbeat = None
+        self.presses = 0
+        self.last_press_time = None
+        # Time from a pick being complete to the pick pipeline being done with it
+        self.pick_latency = LatencyRecorder()
+        # The PickPipeline the presses go through
+        self.pipeline = None
+        # Names of the pipeline stages whose queue is filling up
+        self.backpressure = ()
+
+    # PickPipeline listener
+    def pick_backpressure(self, pipeline, stage_name, active):
+        self.backpressure = tuple(pipeline.backpressure)
+
+    def as_dict(self):
+        status = {
+                'state': self.state,
+                'heartbeat_age_sec': heartbeat_age_sec(self.heartbeat),
+                'presses': self.presses,
+                'last_press_time': self.last_press_time,
+                'pick_latency': self.pick_latency.percentiles(),
+        }
+        if self.pipeline is not None:
+            status['pipeline'] = self.pipeline.as_dict()
+        return status
+
+
+class GpioPressSource(object):
+    """Source of the pick pipeline: raw handle presses from the IR
+        sensor on a GPIO pin
+
+        Arguments:
+            gpio: Module providing the RPi.GPIO API, set up
+            pin: The IR sensor's input pin (BCM numbering)
+            sleep: Function used to sleep between polls
+            status: GpioThreadStatus to keep up to date
+            monotonic: Clock the presses are timed with
+    """
+
+    # Once we detected a falling edge, we busy wait until
+    #   the GPIO input goes back to 1 (i.e. the user has
+    #   released the handle and completed picking up trash)
+    # POLLING_WAIT_SEC sets how long we time.sleep() before
+    #   polling the status of the pin again
+    # It is also the resolution of the press durations the
+    #   coalescer merges and filters on (see press_coalescer.py)
+    POLLING_WAIT_SEC = 0.02
+
+    # Wake up this often while waiting for a falling edge, so the
+    #   watchdog can tell a quiet picker from a hung GPIO thread
+    EDGE_WAIT_TIMEOUT_MS = 2000
+
+    def __init__(self, gpio, pin, sleep, status, monotonic):
+        self.gpio = gpio
+        self.pin = pin
+        self.sleep = sleep
+        self.status = status
+        self.monotonic = monotonic
+
+    def read(self, timeout=None):
+        """Wait for the next press, at most timeout seconds (or
+            EDGE_WAIT_TIMEOUT_MS), and return it as a PickEvent, or None
+        """
+        GPIO = self.gpio
+        status = self.status
+
+        status.heartbeat = time.monotonic()
+        if status.state != 'waiting':
+            print("Waiting for falling edge")
+            status.state = 'waiting'
+
+        timeout_ms = self.EDGE_WAIT_TIMEOUT_MS
+        if timeout is not None:
+            timeout_ms = max(1, min(timeout_ms, int(timeout * 1000) + 1))
+
+        # Intelligently wait until we have falling edge
+        #  (e.g. the handle of the trash picker was closed when
+        #    someone grabbed the trash)
+        channel = GPIO.wait_for_edge(self.pin, GPIO.FALLING,
+                                     bouncetime=200, timeout=timeout_ms)
+        if channel is None:
+            # Timed out, nobody picked anything up
+            return None
+        pressed_at = self.monotonic()
+
+
+        # Busy wait (poll) until the edge rises again
+        # (e.g. the user has released the handle to put the
+        #   garbage into their bucket)
+        # This extra time.sleep is so we handle debouncing: a press
+        #   that is already over by now is dropped by the debounce stage
+        self.sleep(0.01)
+
+
+        if not GPIO.input(self.pin):
+            # This was a valid falling edge, so busy wait until the edge rises,
+            #    (e.g. when the user releases the handle and the IR 
+            #     beam is no longer obstructed)
+            print("Valid handle press detected, beginning busy wait")
+            status.state = 'pressed'
+
+            while not GPIO.input(self.pin):
+                status.heartbeat = time.monotonic()
+                self.sleep(self.POLLING_WAIT_SEC)
+
+            print("Handle released")
+            status.presses += 1
+            status.last_press_time = time.time()
+        return PickEvent(pressed_at, pressed_at, self.monotonic())
+
+
+def gpio_poll_thread(trash_grabbed_chrc, gpio=None, sleep=time.sleep, status=None,
+                     coalescer=None, monotonic=time.monotonic, queue_size=QUEUE_SIZE):
     """Target function for GPIO worker thread
 
+        Runs the pick pipeline (see pick_pipeline.py): presses from
+        GpioPressSource are debounced and classified here, then go
+        through trash_grabbed_chrc's pick stages
+
         Arguments:
             trash_grabbed_chrc: The TrashGrabbedChrc to use
-                for sending BLE notifications
+                for sending BLE notifications (anything with
+                pick_stages())
+            gpio: Module providing the RPi.GPIO API (defaults to
+                RPi.GPIO, the soak harness passes a simulated one)
+            sleep: Function used to sleep between polls
+            status: GpioThreadStatus to keep up to date, or None
+            coalescer: PressCoalescer merging presses into picks (defaults
+                to one with the default gap and durations)
+            monotonic: Clock the presses are timed with
+            queue_size: Size of the queues in front of the stages that can
+                block, 0 to run every stage on this thread
     """
     print("GPIO polling thread started")
 
-    import RPi.GPIO as GPIO
-    import time
+    if status is None:
+        status = GpioThreadStatus()
+    if coalescer is None:
+        coalescer = PressCoalescer()
+
+    if gpio is None:
+        import RPi.GPIO as gpio
+    GPIO = gpio
 
     # Use GPIO Pin 17 for the input line from IR collector
     IR_SENSOR_INPUT_PIN_NUM = 17
-   
-    # Once we detected a falling edge, we busy wait until
-    #   the GPIO input goes back to 1 (i.e. the user has
-    #   released the handle and completed picking up trash)
-    # POLLING_WAIT_SEC sets how long we time.sleep() before
-    #   polling the status of IR_SENSOR_INPUT_PIN_NUM again
-    POLLING_WAIT_SEC = 0.25
 
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(IR_SENSOR_INPUT_PIN_NUM, GPIO.IN)
 
+    pipeline = PickPipeline(GpioPressSource(GPIO, IR_SENSOR_INPUT_PIN_NUM, sleep,
+                                            status, monotonic),
+                            monotonic, status.pick_latency)
+    pipeline.add_listener(status)
+    pipeline.add_stage(DebounceStage())
+    pipeline.add_stage(ClassifyStage(coalescer))
+    for stage in trash_grabbed_chrc.pick_stages(monotonic):
+        pipeline.add_stage(stage, queue_size if stage.QUEUED else 0)
+    status.pipeline = pipeline
+
 
     print("Beginning GPIO thread's main loop")
     try: 
-        while True:
-
-            print("Waiting for falling edge")
-
-            # Intelligently wait until we have falling edge
-            #  (e.g. the handle of the trash picker was closed when
-            #    someone grabbed the trash)
-            GPIO.wait_for_edge(IR_SENSOR_INPUT_PIN_NUM, GPIO.FALLING, bouncetime=200)
+        # Also passes on the pick the coalescer still holds when
+        #   the pipeline stops
+        pipeline.run()
+    finally:
+        print("GPIO cleanup")
+        status.state = 'stopped'
+        GPIO.cleanup()
 
 
-            # Busy wait (poll) until the edge rises again
-            # (e.g. the user has released the handle to put the
-            #   garbage into their bucket)
-            # This extra time.sleep is so we handle debouncing and we only send 
-            #   one BLE indication per handle press
-            time.sleep(0.01)
+def analog_poll_thread(trash_grabbed_chrc, source, status=None, queue_size=QUEUE_SIZE):
+    """Target function for the analog sensing worker thread
 
+        Runs the pick pipeline (see pick_pipeline.py) with an
+        AnalogPressSource: its picks are classified already, so they
+        go straight through trash_grabbed_chrc's pick stages
 
-            if not GPIO.input(IR_SENSOR_INPUT_PIN_NUM):
-                # This was a valid falling edge, so busy wait until the edge rises,
-                #    (e.g. when the user releases the handle and the IR 
-                #     beam is no longer obstructed)
-                #    then send the BLE indication using notify_trash_grabbed
-                print("Valid handle press detected, beginning busy wait")
+        Arguments:
+            trash_grabbed_chrc: The TrashGrabbedChrc to use
+                for sending BLE notifications (anything with
+                pick_stages())
+            source: The AnalogPressSource, made with status
+            status: GpioThreadStatus to keep up to date, or None
+            queue_size: Size of the queues in front of the stages that can
+                block, 0 to run every stage on this thread
+    """
+    print("Analog sensing thread started")
 
-                while not GPIO.input(IR_SENSOR_INPUT_PIN_NUM):
-                    time.sleep(POLLING_WAIT_SEC)
+    if status is None:
+        status = GpioThreadStatus()
 
+    pipeline = PickPipeline(source, source.monotonic, status.pick_latency)
+    pipeline.add_listener(status)
+    for stage in trash_grabbed_chrc.pick_stages(source.monotonic):
+        pipeline.add_stage(stage, queue_size if stage.QUEUED else 0)
+    status.pipeline = pipeline
 
-                print("Handle released, sending BLE indication")
-                trash_grabbed_chrc.notify_trash_grabbed()
+    status.state = 'waiting'
+    try:
+        pipeline.run()
     finally:
-        print("GPIO cleanup")
-        GPIO.cleanup()
+        status.state = 'stopped'
+        source.close()
+
 
 
-        
 
 ###############################
 #          Main code          #
 ###############################
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    sensing = parser.add_mutually_exclusive_group()
+    sensing.add_argument('--edge-process', action='store_true',
+                         help="capture GPIO edges in a separate process instead " +
+                         "of a thread (see edge_capture.py)")
+    sensing.add_argument('--analog', action='store_true',
+                         help="detect picks from the IR receiver's analog level " +
+                         "on an SPI ADC instead of GPIO edges (see analog_sensing.py)")
+    parser.add_argument('--lean', action='store_true',
+                        help="leave out the demo GATT services to save memory " +
+                        "(see memory_budget.py)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record the D-Bus calls BlueZ makes on us and the " +
+                        "signals we emit to FILE (replay with dbus_recorder.py)")
+    parser.add_argument('--no-confirm', action='store_true',
+                        help="count picks as delivered once indicated, for BlueZ " +
+                        "versions that never call Confirm (picks the phone does " +
+                        "not receive are lost)")
+    parser.add_argument('--gps', metavar='DEVICE',
+                        help="tag picks with the location from a NMEA GPS module " +
+                        "on this serial device, e.g. /dev/serial0 (see gps_nmea.py)")
+    parser.add_argument('--gps-baudrate', default=9600, type=int,
+                        help="baud rate of the GPS module (default: 9600)")
+    parser.add_argument('--merge-gap-ms', default=MERGE_GAP_SEC * 1000, type=float,
+                        help="merge presses starting less than this after the " +
+                        "last release into one pick (default: %d, see press_coalescer.py)" %
+                        (MERGE_GAP_SEC * 1000))
+    parser.add_argument('--min-press-ms', default=MIN_PRESS_SEC * 1000, type=float,
+                        help="ignore shorter picks (default: %d)" % (MIN_PRESS_SEC * 1000))
+    parser.add_argument('--max-press-ms', default=MAX_PRESS_SEC * 1000, type=float,
+                        help="ignore longer picks (default: %d)" % (MAX_PRESS_SEC * 1000))
+    parser.add_argument('--press-trace', metavar='FILE',
+                        help="append every raw handle press to FILE (replay with " +
+                        "press_coalescer.py)")
+    args = parser.parse_args()
+
+    # Line buffered, so the trace survives the picker being switched off
+    press_trace = open(args.press_trace, 'a', 1) if args.press_trace else None
+    press_coalescer = PressCoalescer(args.merge_gap_ms / 1000.0,
+                                     args.min_press_ms / 1000.0,
+                                     args.max_press_ms / 1000.0,
+                                     press_trace)
+
+    # The optional sensing modes are imported only when used, so
+    #   numpy and multiprocessing stay out of memory otherwise
+    edge_capture = None
+    if args.edge_process:
+        from edge_capture import EdgeCaptureProcess
+        # Keep edge handling away from the main loop's GIL, picks come
+        #   back through a shared memory ring
+        # Forked first, while we have no threads and no bus connection
+        #   yet (see edge_capture.py)
+        edge_capture = EdgeCaptureProcess(
+                functools.partial(gpio_poll_thread, coalescer=press_coalescer))
+        edge_capture.start()
+
     # Initialize the main loop
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     # Get access to the system bus (so we can communicate with BlueZ components)
     bus = dbus.SystemBus()
 
+    # Record before anything is exported, so GetManagedObjects is captured
+    dbus_recorder = None
+    if args.record:
+        dbus_recorder = DbusRecorder(bus, args.record)
+        dbus_recorder.start()
+
     adapter = find_adapter(bus)
     if not adapter:
         print('LEAdvertisingManager interface not found')
@@ -296,7 +1159,26 @@ if __name__ == '__main__':
             GATT_MANAGER_IFACE
     )
 
-    stp_app = SmartTrashPickerApplication(bus)
+    # Open the pick journal before anything can produce picks
+    print("Opening pick journal at " + PICK_JOURNAL_PATH)
+    pick_journal = PickJournal(PICK_JOURNAL_PATH)
+
+    # Follow which phones are connected, so the backlog goes out as soon
+    #   as one is back and nothing runs while none are around
+    device_presence = DevicePresence(bus, adapter)
+    device_presence.start()
+
+    # Picks carry the latest fix of an on-device GPS, if there is one
+    gps_reader = None
+    if args.gps:
+        from gps_nmea import GpsReader
+        gps_reader = GpsReader(args.gps, args.gps_baudrate)
+        gps_reader.start()
+
+    stp_app = SmartTrashPickerApplication(bus, pick_journal, device_presence,
+                                          include_demo_services=not args.lean,
+                                          gps=gps_reader,
+                                          confirms=not args.no_confirm)
 
     service_manager.RegisterApplication(
             stp_app.get_path(),
@@ -311,17 +1193,58 @@ if __name__ == '__main__':
     # The worker thread can call notify_trash_grabbed(), independent of 
     #   GObject's MainLoop, when it recieves GPIO input that 
     #   the user has grabbed an item of garbage
-    import threading
     print("Attempting to start GPIO thread")
     # NOTE: this is hack to get the TrashGrabbedChrc object, and really
     #   we should be grabbing it from DBus using object paths
     # But I have to meet a deadline for INFO 490 so this hack will have
     #   to make do until I can do a v2.0
-    trash_grabbed_chrc = stp_app.services[3].characteristics[0]
-    gpio_thread = threading.Thread(target=gpio_poll_thread, args=(trash_grabbed_chrc,))
-    gpio_thread.start()
+    trash_grabbed_chrc = stp_app.services[-1].characteristics[0]
+    if edge_capture is not None:
+        # Already running, its picks are handled once the main loop runs
+        edge_capture.trash_grabbed_chrc = trash_grabbed_chrc
+        gpio_thread = edge_capture
+        gpio_status = edge_capture.status
+    elif args.analog:
+        # Classify the analog IR level instead of trusting the beam's edges
+        from analog_sensing import AnalogPressSource, SpiAdcSource
+        gpio_status = GpioThreadStatus()
+        gpio_thread = threading.Thread(target=analog_poll_thread,
+                                       args=(trash_grabbed_chrc,
+                                             AnalogPressSource(SpiAdcSource(), gpio_status),
+                                             gpio_status))
+        gpio_thread.daemon = True
+        gpio_thread.start()
+    else:
+        gpio_status = GpioThreadStatus()
+        gpio_thread = threading.Thread(target=gpio_poll_thread, args=(trash_grabbed_chrc,),
+                                       kwargs={ 'status': gpio_status,
+                                                'coalescer': press_coalescer })
+        gpio_thread.start()
+
+
+    # Watch the main loop for stalls and feed the systemd watchdog
+    #   while both it and the GPIO thread are healthy
+    loop_watchdog = LoopWatchdog(gpio_thread, gpio_status)
+    loop_watchdog.start()
+    notify_ready_if_registered()
+
+
+    # Serve the local admin socket (see admin_socket.py) from the main loop
+    admin_server = AdminServer(ADMIN_SOCKET_PATH, stp_app, pick_journal,
+                               gpio_thread, gpio_status, registration_status,
+                               loop_watchdog, device_presence)
+    try:
+        admin_server.start()
+    except (IOError, OSError) as e:
+        print("Could not start admin socket")
+        print(e)
+
 
 
+    # SIGUSR1 starts and SIGUSR2 stops the sampling profiler
+    #   (see sampling_profiler.py)
+    install_signal_handlers(SamplingProfiler())
+
 
     # Get the GObject main loop
     mainloop = GObject.MainLoop()
@@ -344,10 +1267,23 @@ if __name__ == '__main__':
     finally:
         print("Exiting mainloop")
 
+        admin_server.stop()
+        loop_watchdog.stop()
+        if dbus_recorder is not None:
+            dbus_recorder.stop()
+        if args.edge_process:
+            gpio_thread.stop()
+
         # remove any DBus objects for cleanup
         stp_app.remove_from_connection()
         stp_advertisement.remove_from_connection()
 
+        # Make sure every journaled pick has hit the disk
+        if not pick_journal.close():
+            print("Some picks did not make it to the pick journal")
+        if press_trace is not None:
+            press_trace.close()
+
 
         
 
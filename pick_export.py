@@ -0,0 +1,290 @@
+######################################################
+#
+# Compressed, column-wise export of the pick journal
+#
+# At the end of a cleanup event the organiser wants every
+#   pick of the day, and sending them one indication each
+#   costs a radio round trip per pick.  The export encodes
+#   the picks column by column, which puts similar bytes
+#   next to each other, and compresses them with zlib:
+#     - sequence numbers as varint deltas (mostly 1 byte)
+#     - timestamps in milliseconds as zigzag varint deltas
+#       (restamped picks can go backwards)
+#     - a bitmap of which picks have a location, then
+#       latitudes and longitudes (degrees * 1e7) as zigzag
+#       varint deltas from the previous located pick
+#     - press durations in milliseconds as varints
+#
+# Export format (little endian):
+#   4 bytes  magic           -> b'STPX'
+#   uint8    version         -> 2 (1 had no durations)
+#   uint32   count           -> picks in the export
+#   uint32   payload_length  -> length of the payload once
+#                               decompressed
+#   ...      zlib stream     -> the payload:
+#              varint seq[0], varint (seq[i] - seq[i-1])...
+#              varint ms[0], zigzag varint (ms[i] - ms[i-1])...
+#              ceil(count / 8) bytes location bitmap (bit i
+#                of byte i // 8, least significant first)
+#              zigzag varint latitude deltas...
+#              zigzag varint longitude deltas...
+#              varint (duration_ms + 1), 0 if unknown...
+#   uint32   crc32           -> CRC-32 of everything above
+#
+# The Pick Export characteristic serves it in windows (see
+#   PickExportChrc in my-gatt-server.py).  The phone writes a
+#   cursor and reads the window it points at:
+#   cursor (written):
+#     uint32   snapshot id   -> export_id() of the export, 0 for
+#                               a new snapshot of the journal
+#     uint32   position      -> byte position in the export
+#   window (read):
+#     uint32   snapshot id
+#     uint32   position      -> of the first data byte
+#     uint32   length        -> of the whole export
+#     ...      data          -> up to the window size less this
+#                               header, empty past the end
+#   The snapshot id is the export's CRC-32, so resuming only
+#   ever continues the same bytes
+#
+# Run this file directly to compare export size and the
+#   estimated time on air against one indication per pick:
+#     python pick_export.py --counts 10000,100000
+#
+#####################################################
+
+import argparse
+import random
+import struct
+import time
+import zlib
+
+from pick_record import PickRecord
+
+
+MAGIC = b'STPX'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sBII')
+_CRC = struct.Struct('<I')
+
+WINDOW_CURSOR = struct.Struct('<II')
+WINDOW_HEADER = struct.Struct('<III')
+
+_FIELD_INDEX = dict((name, index) for index, (name, _) in enumerate(PickRecord.FIELDS))
+
+
+def _varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def encode_picks(rows, level=9):
+    """Return the export (bytes) of rows, oldest first
+
+        Arguments:
+            rows: Iterable of journal rows, the values of PickRecord.FIELDS
+                in order (e.g. PickJournal.iter_picks())
+            level: zlib compression level
+    """
+    seq_index = _FIELD_INDEX['seq']
+    timestamp_index = _FIELD_INDEX['timestamp']
+    lat_index = _FIELD_INDEX['lat_e7']
+    lon_index = _FIELD_INDEX['lon_e7']
+    duration_index = _FIELD_INDEX['duration_ms']
+
+    seqs = bytearray()
+    times = bytearray()
+    bitmap = bytearray()
+    lats = bytearray()
+    lons = bytearray()
+    durations = bytearray()
+
+    count = 0
+    last_seq = 0
+    last_ms = 0
+    last_lat = last_lon = 0
+    for row in rows:
+        seq = row[seq_index]
+        ms = int(round(row[timestamp_index] * 1000))
+        if count:
+            _varint(seqs, seq - last_seq)
+            _varint(times, _zigzag(ms - last_ms))
+        else:
+            _varint(seqs, seq)
+            _varint(times, ms)
+        last_seq, last_ms = seq, ms
+
+        if count % 8 == 0:
+            bitmap.append(0)
+        lat = row[lat_index]
+        if lat is not None:
+            lon = row[lon_index]
+            bitmap[-1] |= 1 << (count % 8)
+            _varint(lats, _zigzag(lat - last_lat))
+            _varint(lons, _zigzag(lon - last_lon))
+            last_lat, last_lon = lat, lon
+        duration_ms = row[duration_index]
+        _varint(durations, duration_ms + 1 if duration_ms is not None else 0)
+        count += 1
+
+    payload = seqs + times + bitmap + lats + lons + durations
+    blob = _HEADER.pack(MAGIC, VERSION, count, len(payload)) + zlib.compress(bytes(payload), level)
+    return blob + _CRC.pack(zlib.crc32(blob) & 0xffffffff)
+
+
+def export_id(blob):
+    """Return the snapshot id of an export, its CRC-32 (never 0)"""
+    return _CRC.unpack_from(blob, len(blob) - _CRC.size)[0] or 1
+
+
+def read_window(value):
+    """Return (snapshot id, position, export length, data) of a window
+        read from the Pick Export characteristic
+    """
+    value = bytes(value)
+    if len(value) < WINDOW_HEADER.size:
+        raise ValueError('Window of %d bytes has no header' % len(value))
+    snapshot_id, position, length = WINDOW_HEADER.unpack_from(value)
+    return snapshot_id, position, length, value[WINDOW_HEADER.size:]
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def decode_picks(blob):
+    """Return the (seq, timestamp, lat_e7, lon_e7, duration_ms) tuples
+        of an export, what the phone does with it
+
+        Raises ValueError if the export is corrupt
+    """
+    if len(blob) < _HEADER.size + _CRC.size:
+        raise ValueError('Export is too short')
+    crc, = _CRC.unpack_from(blob, len(blob) - _CRC.size)
+    if zlib.crc32(blob[:-_CRC.size]) & 0xffffffff != crc:
+        raise ValueError('Export checksum mismatch')
+    magic, version, count, payload_length = _HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version %d export' % VERSION)
+    payload = zlib.decompress(blob[_HEADER.size:-_CRC.size])
+    if len(payload) != payload_length:
+        raise ValueError('Export payload length mismatch')
+
+    offset = 0
+    seqs = []
+    for i in range(count):
+        value, offset = _read_varint(payload, offset)
+        seqs.append(value + (seqs[-1] if i else 0))
+    times = []
+    for i in range(count):
+        value, offset = _read_varint(payload, offset)
+        times.append(_unzigzag(value) + times[-1] if i else value)
+    bitmap = payload[offset:offset + (count + 7) // 8]
+    offset += len(bitmap)
+    located = [i for i in range(count) if bitmap[i // 8] & (1 << (i % 8))]
+    lats = []
+    for _ in located:
+        value, offset = _read_varint(payload, offset)
+        lats.append(_unzigzag(value) + (lats[-1] if lats else 0))
+    lons = []
+    for _ in located:
+        value, offset = _read_varint(payload, offset)
+        lons.append(_unzigzag(value) + (lons[-1] if lons else 0))
+    durations = []
+    for _ in range(count):
+        value, offset = _read_varint(payload, offset)
+        durations.append(value - 1 if value else None)
+
+    locations = dict(zip(located, zip(lats, lons)))
+    return [(seqs[i], times[i] / 1000.0) + locations.get(i, (None, None)) +
+            (durations[i],) for i in range(count)]
+
+
+###############################
+#          Benchmark          #
+###############################
+def synthetic_picks(count, seed=490):
+    """Rows of a cleanup event: a pick every half minute or so, most of
+        them located along a walk
+    """
+    rng = random.Random(seed)
+    rows = []
+    timestamp = 1561000000.0
+    lat, lon = 401100000, -882400000
+    for seq in range(count):
+        timestamp += rng.expovariate(1 / 30.0)
+        lat += rng.randint(-150, 150)
+        lon += rng.randint(-150, 150)
+        located = rng.random() < 0.9
+        rows.append((seq, round(timestamp, 3), lat if located else None,
+                     lon if located else None, rng.randint(300, 1500)))
+    return rows
+
+
+def main(counts, mtu, interval_ms, window):
+    # One ATT payload is MTU - 3 bytes (opcode, handle), one round trip
+    #   per indication (indicate, confirm) or read (request, response)
+    per_packet = mtu - 3
+    record_size = len(PickRecord(0, 0.0).pack())
+    print('MTU %d, one round trip per %.1f ms connection interval, %d byte windows' % (
+            mtu, interval_ms, window))
+    print('%8s  %-12s  %10s  %12s  %10s  %10s' % ('picks', 'format', 'bytes',
+                                                   'round trips', 'on air', 'encode'))
+    for count in counts:
+        rows = synthetic_picks(count)
+
+        started = time.process_time()
+        blob = encode_picks(rows)
+        encode_time = time.process_time() - started
+        if decode_picks(blob) != rows:
+            raise RuntimeError('Export does not decode to its picks')
+
+        per_event_bytes = count * record_size
+        per_event_trips = count
+        # Every window is a cursor write and one long read
+        data_per_window = window - WINDOW_HEADER.size
+        windows = (len(blob) + data_per_window - 1) // data_per_window
+        export_trips = windows * (1 + (window + per_packet - 1) // per_packet)
+
+        for name, size, trips, encode in (
+                ('per event', per_event_bytes, per_event_trips, None),
+                ('export', len(blob), export_trips, encode_time)):
+            print('%8d  %-12s  %10d  %12d  %8.1f s  %10s' % (
+                    count, name, size, trips, trips * interval_ms / 1000.0,
+                    '%.0f ms' % (encode * 1000) if encode is not None else '-'))
+        print('%8s  %.2f bytes/pick, %.1fx smaller' % (
+                '', len(blob) / float(count), per_event_bytes / float(len(blob))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', default='10000,100000',
+                        help="comma separated pick counts (default: 10000,100000)")
+    parser.add_argument('--mtu', default=185, type=int,
+                        help="negotiated ATT MTU (default: 185)")
+    parser.add_argument('--interval-ms', default=30, type=float,
+                        help="BLE connection interval (default: 30)")
+    parser.add_argument('--window', default=512, type=int,
+                        help="export window size (default: 512)")
+    args = parser.parse_args()
+
+    main([int(count) for count in args.counts.split(',')], args.mtu,
+         args.interval_ms, args.window)
@@ -0,0 +1,399 @@
+######################################################
+#
+# Durable journal of trash picks
+#
+# Every pick is written to a SQLite database so picks
+#   made while no phone is listening survive the process
+#   dying or the Pi losing power mid-route
+#
+# Writes are done by a single background writer thread
+#   that groups picks into one transaction (group commit),
+#   flushing every FLUSH_EVERY events or FLUSH_INTERVAL_MS
+#   milliseconds, whichever comes first.  The database runs
+#   in WAL mode with synchronous=FULL, so each group commit
+#   costs one fsync of the WAL instead of one per pick
+#
+# A commit that fails is rolled back and its operations are
+#   kept and tried again, first thing in the next commit (at
+#   least every RETRY_INTERVAL_SEC).  flush() and close() only
+#   report success once everything queued before them has
+#   actually been committed
+#
+# Picks stay "pending" until the GATT side acknowledges
+#   delivery with ack(); delivered rows are compacted away
+#   once they are older than RETAIN_DELIVERED_SEC
+#
+# Run this file directly to benchmark sustained insert rate
+#   and commit (fsync) count, e.g. on a tmpfs:
+#     python pick_journal.py --dir /dev/shm --count 20000
+#
+#####################################################
+
+import argparse
+import collections
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pick_record import PickRecord
+
+
+# Defaults for group commit
+FLUSH_EVERY = 16
+FLUSH_INTERVAL_MS = 250
+
+# Delivered picks are kept this long (for exporting the day's picks)
+#   before being compacted out of the database
+RETAIN_DELIVERED_SEC = 24 * 60 * 60
+COMPACT_INTERVAL_SEC = 60
+
+# How often the operations of a failed commit are tried again
+#   while nothing new is queued
+RETRY_INTERVAL_SEC = 1.0
+
+_COLUMNS = [name for name, _ in PickRecord.FIELDS]
+_INSERT_SQL = 'INSERT OR REPLACE INTO picks (%s) VALUES (%s)' % (
+        ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+_ACK_SQL = 'UPDATE picks SET delivered_at = ? WHERE seq = ?'
+_RESTAMP_SQL = 'UPDATE picks SET timestamp = ? WHERE seq = ?'
+# The newest pick is always kept, so sequence numbers carry on after a restart
+_COMPACT_SQL = 'DELETE FROM picks WHERE delivered_at < ? AND seq < (SELECT MAX(seq) FROM picks)'
+_SELECT_PENDING_SQL = 'SELECT %s FROM picks WHERE delivered_at IS NULL ORDER BY seq' % (
+        ', '.join(_COLUMNS))
+_SELECT_ALL_SQL = 'SELECT %s FROM picks ORDER BY seq' % ', '.join(_COLUMNS)
+
+
+class _Waiter(object):
+    """A flush() or close() waiting for the commit of its batch"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.committed = False
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout) and self.committed
+
+
+class PickJournal(object):
+    """Durable, group-committed journal of PickRecords
+
+        Arguments:
+            path: Filepath of the SQLite database
+            flush_every: Commit once this many operations are queued
+            flush_interval_ms: Commit at most this many milliseconds
+                after the first operation of a batch was queued
+            retain_delivered_sec: How long delivered picks are kept
+                before being compacted
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY,
+                 flush_interval_ms=FLUSH_INTERVAL_MS,
+                 retain_delivered_sec=RETAIN_DELIVERED_SEC):
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self.flush_interval_ms = flush_interval_ms
+        self.retain_delivered_sec = retain_delivered_sec
+
+        # Statistics (only written by the writer thread)
+        self.commit_count = 0
+        self.inserted_count = 0
+        self.acked_count = 0
+        self.compacted_count = 0
+        self.failed_commit_count = 0
+
+        self._lock = threading.Lock()
+        self._ops = queue.Queue()
+        self._last_compaction = 0
+        # Operations of failed commits, oldest first (writer thread only)
+        self._retry = []
+
+        # Pending (undelivered) picks, oldest first
+        # This mirrors the database so the GATT side never has to
+        #   wait for the writer thread to read the backlog
+        self._pending = collections.OrderedDict()
+
+        self._conn = sqlite3.connect(path, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._ensure_schema()
+
+        next_seq = self._conn.execute(
+                'SELECT COALESCE(MAX(seq), -1) + 1 FROM picks').fetchone()[0]
+        for row in self._conn.execute(_SELECT_PENDING_SQL):
+            record = PickRecord.from_row(row)
+            self._pending[record.seq] = record
+        self._next_seq = next_seq
+
+        if self._pending:
+            print('Pick journal recovered %d undelivered picks' % len(self._pending))
+
+        self._writer = threading.Thread(target=self._writer_loop,
+                                        name='pick-journal-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _ensure_schema(self):
+        columns = ', '.join('%s %s' % field for field in PickRecord.FIELDS)
+        self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS picks (%s, delivered_at REAL)' % columns)
+        self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS picks_delivered_at ON picks (delivered_at)')
+
+        # Add any field that was introduced after the database was created
+        existing = set(row[1] for row in self._conn.execute('PRAGMA table_info(picks)'))
+        for name, sql_type in PickRecord.FIELDS:
+            if name not in existing:
+                # Constraints cannot be added to existing rows, only the type
+                self._conn.execute('ALTER TABLE picks ADD COLUMN %s %s' % (
+                        name, sql_type.split()[0]))
+
+    def append(self, record):
+        """Journal a new pick
+
+            If record.seq is None, the next sequence number is assigned
+
+            Returns the record
+        """
+        with self._lock:
+            if record.seq is None:
+                record.seq = self._next_seq
+            self._next_seq = max(self._next_seq, record.seq + 1)
+            self._pending[record.seq] = record
+        self._ops.put(('insert', record))
+        return record
+
+    def ack(self, seq):
+        """Mark the pick with sequence number seq as delivered
+
+            Returns True if the pick was pending
+        """
+        with self._lock:
+            if self._pending.pop(seq, None) is None:
+                return False
+        self._ops.put(('ack', seq, time.time()))
+        return True
+
+    def restamp(self, record):
+        """Persist a new timestamp of a journaled pick (e.g. once the
+            clock has been synced)
+        """
+        self._ops.put(('restamp', record.timestamp, record.seq))
+
+    def is_pending(self, seq):
+        with self._lock:
+            return seq in self._pending
+
+    def pending(self):
+        """Return a list of all undelivered picks, oldest first"""
+        with self._lock:
+            return list(self._pending.values())
+
+    def pending_from(self, seq, limit):
+        """Return up to limit undelivered picks with a sequence number of
+            at least seq, oldest first
+
+            Looks up sequence numbers one by one from seq on instead of
+            copying the backlog, so it can be drained a few picks at a time
+        """
+        with self._lock:
+            if not self._pending:
+                return []
+            seq = max(seq, next(iter(self._pending)))
+            records = []
+            while seq < self._next_seq and len(records) < limit:
+                record = self._pending.get(seq)
+                if record is not None:
+                    records.append(record)
+                seq += 1
+            return records
+
+    def uncommitted_count(self):
+        """Operations whose commit failed and that are waiting to be tried again"""
+        return len(self._retry)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def next_seq(self):
+        """Sequence number the next pick will get (the number of picks ever journaled)"""
+        with self._lock:
+            return self._next_seq
+
+    def iter_picks(self):
+        """Yield the row (values of PickRecord.FIELDS) of every journaled
+            pick, delivered ones not compacted yet included, oldest first
+
+            Reads through a connection of its own (WAL lets it run next
+            to the writer thread), call flush() first to include picks
+            still queued
+        """
+        conn = sqlite3.connect(self.path)
+        try:
+            for row in conn.execute(_SELECT_ALL_SQL):
+                yield row
+        finally:
+            conn.close()
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been committed
+
+            Returns False if that did not happen within timeout seconds,
+            or the commit failed
+        """
+        waiter = _Waiter()
+        self._ops.put(('flush', waiter))
+        return waiter.wait(timeout)
+
+    def close(self):
+        """Commit everything queued so far and stop the writer thread
+
+            Returns False if some of it could not be committed
+        """
+        if not self._writer.is_alive():
+            return not self._retry
+        waiter = _Waiter()
+        self._ops.put(('stop', waiter))
+        committed = waiter.wait()
+        self._writer.join()
+        self._conn.close()
+        if not committed:
+            print('Pick journal closed with %d operations not committed' % len(self._retry))
+        return committed
+
+    def _writer_loop(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self._ops.get(timeout=RETRY_INTERVAL_SEC if self._retry else None)]
+            except queue.Empty:
+                # Nothing new, try the failed commit again
+                self._commit([])
+                continue
+            deadline = time.time() + self.flush_interval_ms / 1000.0
+
+            # Keep collecting until the batch is full, the interval
+            #   has passed, or someone is waiting on the batch
+            while len(batch) < self.flush_every and \
+                    batch[-1][0] not in ('flush', 'stop'):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._ops.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            stopping = self._commit(batch)
+
+    def _commit(self, batch):
+        # The failed commit's operations go first, in their order
+        ops = self._retry + [op for op in batch if op[0] not in ('flush', 'stop')]
+        inserts = [op[1].to_row() for op in ops if op[0] == 'insert']
+        acks = [(op[2], op[1]) for op in ops if op[0] == 'ack']
+        restamps = [(op[1], op[2]) for op in ops if op[0] == 'restamp']
+        waiters = [op[1] for op in batch if op[0] in ('flush', 'stop')]
+        stopping = any(op[0] == 'stop' for op in batch)
+
+        now = time.time()
+        compact = now - self._last_compaction >= COMPACT_INTERVAL_SEC
+
+        committed = True
+        if inserts or acks or restamps or compact:
+            try:
+                self._conn.execute('BEGIN')
+                if inserts:
+                    self._conn.executemany(_INSERT_SQL, inserts)
+                if acks:
+                    self._conn.executemany(_ACK_SQL, acks)
+                if restamps:
+                    self._conn.executemany(_RESTAMP_SQL, restamps)
+                if compact:
+                    cursor = self._conn.execute(
+                            _COMPACT_SQL, (now - self.retain_delivered_sec,))
+                    compacted = max(0, cursor.rowcount)
+                self._conn.execute('COMMIT')
+                self.commit_count += 1
+                self.inserted_count += len(inserts)
+                self.acked_count += len(acks)
+                if compact:
+                    self.compacted_count += compacted
+                    self._last_compaction = now
+            except sqlite3.Error as e:
+                committed = False
+                self.failed_commit_count += 1
+                print('Pick journal commit failed, %d operations kept to try again' % len(ops))
+                print(e)
+                if self._conn.in_transaction:
+                    self._conn.execute('ROLLBACK')
+        self._retry = ops if not committed else []
+
+        for waiter in waiters:
+            waiter.committed = committed
+            waiter.done.set()
+
+        return stopping
+
+
+###############################
+#          Benchmark          #
+###############################
+def main(directory, count, flush_every, flush_interval_ms, rate):
+    tmp_dir = tempfile.mkdtemp(prefix='pick-journal-', dir=directory)
+    path = os.path.join(tmp_dir, 'picks.db')
+    print('Benchmarking pick journal at ' + path)
+
+    try:
+        journal = PickJournal(path, flush_every, flush_interval_ms)
+
+        start = time.time()
+        for _ in range(count):
+            journal.append(PickRecord(None, time.time()))
+            if rate > 0:
+                time.sleep(1.0 / rate)
+        journal.flush()
+        elapsed = time.time() - start
+        insert_commits = journal.commit_count
+
+        for record in journal.pending():
+            journal.ack(record.seq)
+        journal.close()
+
+        # In WAL mode with synchronous=FULL every commit is one fsync
+        #   of the WAL file (checkpoints add a few more)
+        print('Inserted %d picks in %.3f s (%.0f picks/s)' % (
+                journal.inserted_count, elapsed, journal.inserted_count / elapsed))
+        print('Commits (WAL fsyncs) while inserting: %d' % insert_commits)
+        print('Picks per fsync: %.1f' % (
+                journal.inserted_count / float(max(1, insert_commits))))
+        print('Commits (WAL fsyncs) total, including acks: %d' % journal.commit_count)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                        help="directory to create the benchmark database in " +
+                        "(default: /dev/shm)")
+    parser.add_argument('--count', default=10000, type=int,
+                        help="number of picks to insert (default: 10000)")
+    parser.add_argument('--flush-every', default=FLUSH_EVERY, type=int,
+                        help="group commit size (default: %d)" % FLUSH_EVERY)
+    parser.add_argument('--flush-interval-ms', default=FLUSH_INTERVAL_MS, type=int,
+                        help="group commit interval (default: %d)" % FLUSH_INTERVAL_MS)
+    parser.add_argument('--rate', default=0, type=float,
+                        help="picks per second to insert, 0=as fast as " +
+                        "possible (default: 0)")
+    args = parser.parse_args()
+
+    main(args.dir, args.count, args.flush_every, args.flush_interval_ms, args.rate)
@@ -0,0 +1,655 @@
+######################################################
+#
+# Staged pick pipeline
+#
+# A pick goes from the IR beam to the phone through a
+#   series of stages, each of which can be swapped, or
+#   have others (storage, batching, filters) put around it,
+#   without touching the GPIO or D-Bus code:
+#
+#   source    a raw press: the falling edge on pin 17 and
+#             the release after it (GpioPressSource in
+#             my-gatt-server.py), or a pick classified from
+#             the analog IR level (AnalogPressSource in
+#             analog_sensing.py, which skips debounce and
+#             classify)
+#   debounce  DebounceStage: drops presses that had already
+#             cleared when first checked
+#   classify  ClassifyStage: merges a shaky grip's presses
+#             into one pick and rejects implausible ones (see
+#             press_coalescer.py)
+#   enrich    EnrichStage: the PickRecord, with the wall clock
+#             time of the first press, location and press
+#             duration
+#   buffer    BufferStage: pick stats and the durable journal
+#   deliver   DeliverStage: indications to the phone
+#
+# The source and the stages run on the thread calling
+#   PickPipeline.run() (the GPIO or analog sensing thread), except that a stage
+#   added with a queue_size gets a bounded queue in front of
+#   it and a worker thread of its own, which also runs the
+#   stages after it up to the next queued one.  Stages that
+#   can block (QUEUED: buffer and deliver) are queued, so a
+#   busy journal or D-Bus never holds up the GPIO thread
+#
+# Backpressure: once a queue is QUEUE_HIGH_WATER full it is
+#   logged and listeners' pick_backpressure(pipeline, stage,
+#   True) is called, and (stage, False) once it is down to
+#   QUEUE_LOW_WATER.  A full queue blocks the thread putting
+#   into it, so picks are never dropped; if the journal is
+#   stuck for good the GPIO thread's heartbeat stops and the
+#   watchdog restarts us.  The exception are coalescing
+#   stages: delivering a journaled pick sends the whole
+#   backlog, so an event for the deliver stage only has to
+#   wake it up.  Once its queue is full further events are
+#   dropped (counted as coalesced) instead of blocking, and a
+#   stuck delivery never holds up the journal
+#
+# A stage holding an event back (classify, during the merge
+#   gap) is flushed when the pipeline stops: run() passes on
+#   whatever it lets go of, and each worker empties its queue
+#   before the next one is stopped, so no pick is lost on exit
+#
+# Every stage counts the events in and out and times each
+#   call, queued stages also how long events waited and how
+#   long the stage before them was blocked.  as_dict() is
+#   what the admin socket shows under gpio.pipeline
+#
+# Run this file directly to see the per-stage numbers for a
+#   day of synthetic presses and a slow delivery stage:
+#     python pick_pipeline.py --hours 24 --deliver-ms 20
+#
+#####################################################
+
+import argparse
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from latency_stats import LatencyRecorder
+from pick_record import PickRecord
+from press_coalescer import PressCoalescer, synthetic_presses
+
+
+QUEUE_SIZE = 16
+
+# Fractions of a queue's size
+QUEUE_HIGH_WATER = 0.75
+QUEUE_LOW_WATER = 0.25
+
+# The first check is 10 ms after the edge, so a press that
+#   had already cleared by then measures about 10 ms
+DEBOUNCE_SEC = 0.02
+
+# Idle worker threads wake up this often to notice stop()
+_IDLE_WAKEUP_SEC = 1.0
+
+
+class PickEvent(object):
+    """A press, then a pick, on its way through the pipeline
+
+        Arguments:
+            started_at: When it entered the pipeline, or was let go of
+                by a stage holding it back (pipeline clock)
+            pressed_at: When the handle was pressed (raw presses), or
+                first pressed (picks)
+            released_at: When it was released (raw presses)
+            duration_ms: How long the pick's press lasted (picks)
+    """
+
+    __slots__ = ('started_at', 'pressed_at', 'released_at', 'duration_ms', 'record')
+
+    def __init__(self, started_at, pressed_at=None, released_at=None, duration_ms=None):
+        self.started_at = started_at
+        self.pressed_at = pressed_at
+        self.released_at = released_at
+        self.duration_ms = duration_ms
+        # The PickRecord, from the enrich stage on
+        self.record = None
+
+
+class Stage(object):
+    """One step of a PickPipeline
+
+        process(event) returns the event to pass on (the same one or a
+        new one), or None to drop or hold it.  A stage holding events
+        back returns when it wants to be polled from deadline(), and
+        poll(now) returns the event it lets go of, or None.  flush(now)
+        is called once the pipeline stops and returns the event it
+        was holding back, or None
+
+        A stage is only called from the thread running its part of
+        the pipeline
+    """
+
+    name = 'stage'
+
+    # Whether the stage can block (storage, D-Bus) and should get a
+    #   queue and thread of its own
+    QUEUED = False
+
+    # Whether processing an event also covers every event before it,
+    #   so a queued stage can drop events once its queue is full
+    coalesce = False
+
+    def process(self, event):
+        return event
+
+    def deadline(self):
+        return None
+
+    def poll(self, now):
+        return None
+
+    def flush(self, now):
+        return None
+
+    def as_dict(self):
+        """The stage's own counters"""
+        return {}
+
+
+class DebounceStage(Stage):
+    """Drops presses shorter than min_sec, noise on the line"""
+
+    name = 'debounce'
+
+    def __init__(self, min_sec=DEBOUNCE_SEC):
+        self.min_sec = min_sec
+        self.bounces = 0
+
+    def process(self, event):
+        if event.released_at - event.pressed_at < self.min_sec:
+            self.bounces += 1
+            return None
+        return event
+
+    def as_dict(self):
+        return { 'bounces': self.bounces }
+
+
+class ClassifyStage(Stage):
+    """Turns presses into picks through a PressCoalescer, holding each
+        pick back until no more presses can be merged into it
+    """
+
+    name = 'classify'
+
+    def __init__(self, coalescer):
+        self.coalescer = coalescer
+
+    def process(self, event):
+        return self._pick(self.coalescer.press(event.pressed_at, event.released_at),
+                          event.started_at)
+
+    def deadline(self):
+        return self.coalescer.deadline()
+
+    def poll(self, now):
+        return self._pick(self.coalescer.poll(now), now)
+
+    def flush(self, now):
+        return self._pick(self.coalescer.flush(), now)
+
+    def _pick(self, duration_ms, now):
+        if duration_ms is None:
+            return None
+        return PickEvent(now, self.coalescer.pick_pressed_at, duration_ms=duration_ms)
+
+    def as_dict(self):
+        return self.coalescer.as_dict()
+
+
+def _age_sec(event, clock):
+    """Seconds since the pick was first pressed, 0 if unknown"""
+    if event.pressed_at is None:
+        return 0.0
+    return max(0.0, clock() - event.pressed_at)
+
+
+class EnrichStage(Stage):
+    """Makes the pick's PickRecord (TrashGrabbedChrc.new_pick), stamped
+        with the time of its first press
+
+        Arguments:
+            chrc: The TrashGrabbedChrc
+            clock: Clock of the events' times (the pipeline's)
+    """
+
+    name = 'enrich'
+
+    def __init__(self, chrc, clock=time.monotonic):
+        self.chrc = chrc
+        self.clock = clock
+
+    def process(self, event):
+        event.record = self.chrc.new_pick(event.duration_ms, _age_sec(event, self.clock))
+        return event
+
+
+class BufferStage(Stage):
+    """Counts and journals the pick (TrashGrabbedChrc.store_pick)"""
+
+    name = 'buffer'
+    QUEUED = True
+
+    def __init__(self, chrc):
+        self.chrc = chrc
+
+    def process(self, event):
+        self.chrc.store_pick(event.record)
+        return event
+
+
+class DeliverStage(Stage):
+    """Sends the pick and any backlog (TrashGrabbedChrc.deliver_pick)
+
+        Arguments:
+            chrc: The TrashGrabbedChrc
+            coalesce: True if deliver_pick sends every stored pick, not
+                only the one it is given (the chrc has a journal)
+    """
+
+    name = 'deliver'
+    QUEUED = True
+
+    def __init__(self, chrc, coalesce=False):
+        self.chrc = chrc
+        self.coalesce = coalesce
+
+    def process(self, event):
+        self.chrc.deliver_pick(event.record)
+        return event
+
+
+class NotifyStage(Stage):
+    """Hands the pick to anything with notify_trash_grabbed(duration_ms,
+        age_sec), e.g. the edge capture process' ring
+
+        Arguments:
+            target: Where picks go
+            clock: Clock of the events' times (the pipeline's)
+    """
+
+    name = 'notify'
+
+    def __init__(self, target, clock=time.monotonic):
+        self.target = target
+        self.clock = clock
+
+    def process(self, event):
+        self.target.notify_trash_grabbed(event.duration_ms, _age_sec(event, self.clock))
+        return event
+
+
+class _StageSlot(object):
+    """A stage of a pipeline with its counters and queue"""
+
+    def __init__(self, stage, queue_size):
+        self.stage = stage
+        self.queue_size = queue_size
+        # (time.perf_counter() when put, event)
+        self.queue = queue.Queue(queue_size) if queue_size else None
+        self.high_water = max(1, int(queue_size * QUEUE_HIGH_WATER))
+        self.low_water = int(queue_size * QUEUE_LOW_WATER)
+
+        self.events_in = 0
+        self.events_out = 0
+        self.busy_sec = 0.0
+        self.process_time = LatencyRecorder()
+        self.queue_wait = LatencyRecorder()
+        self.max_depth = 0
+        self.blocked_sec = 0.0
+        self.backpressure = False
+        self.backpressure_count = 0
+        # Events dropped by a coalescing stage's full queue
+        self.coalesced = 0
+        # Set once nothing more is put into the queue, the worker
+        #   exits when it is empty
+        self.closed = False
+
+    def as_dict(self):
+        stats = {
+                'name': self.stage.name,
+                'in': self.events_in,
+                'out': self.events_out,
+                'busy_sec': round(self.busy_sec, 6),
+                'process_time': self.process_time.percentiles(),
+        }
+        if self.queue is not None:
+            stats['queue'] = {
+                    'size': self.queue_size,
+                    'depth': self.queue.qsize(),
+                    'max_depth': self.max_depth,
+                    'wait': self.queue_wait.percentiles(),
+                    'blocked_sec': round(self.blocked_sec, 6),
+                    'backpressure': self.backpressure,
+                    'backpressure_count': self.backpressure_count,
+                    'coalesced': self.coalesced,
+            }
+        own = self.stage.as_dict()
+        if own:
+            stats['stage'] = own
+        return stats
+
+
+class PickPipeline(object):
+    """A source and the stages after it, in the order they were added
+
+        Stage times are measured with time.perf_counter(), the events'
+        own times with clock
+
+        Listeners may define pick_backpressure(pipeline, stage_name, active),
+        called from whichever pipeline thread sees the change
+
+        Arguments:
+            source: Anything with read(timeout) returning the next
+                PickEvent, or None once timeout seconds (its own
+                choice if None) have passed without one
+            clock: Clock of the events' times
+            latency: LatencyRecorder for the time from an event entering
+                the pipeline (or being let go of) to the last stage
+                finishing with it, or None for one of its own
+    """
+
+    def __init__(self, source, clock=time.monotonic, latency=None):
+        self.source = source
+        self.clock = clock
+        self.latency = latency if latency is not None else LatencyRecorder()
+        self.source_events = 0
+        self._slots = []
+        self._listeners = []
+        self._workers = []
+        self._running = False
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, queue_size=0):
+        """Append stage, behind a queue of queue_size events and on a
+            thread of its own if queue_size is not 0
+        """
+        self._slots.append(_StageSlot(stage, queue_size))
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    @property
+    def backpressure(self):
+        """Names of the stages whose queue is filling up"""
+        return [slot.stage.name for slot in self._slots if slot.backpressure]
+
+    def _segment(self, start):
+        """Indexes of the stages run by the thread that runs stage start"""
+        end = start + 1
+        while end < len(self._slots) and self._slots[end].queue is None:
+            end += 1
+        return range(start, end)
+
+    def run(self):
+        """Read from the source and run the stages until stop() is called
+            (or the source raises)
+        """
+        self._running = True
+        source_segment = range(0)
+        for index, slot in enumerate(self._slots):
+            if slot.queue is None:
+                if index == len(source_segment):
+                    source_segment = range(index + 1)
+                continue
+            worker = threading.Thread(target=self._worker_loop, args=(index,),
+                                      name='pick-%s' % slot.stage.name)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        try:
+            while self._running:
+                event = self.source.read(self._timeout(source_segment, None))
+                if event is not None:
+                    self.source_events += 1
+                    self._pass_on(0, event)
+                self._poll(source_segment)
+        finally:
+            self._running = False
+            try:
+                self._flush(source_segment)
+            finally:
+                self._close_workers()
+
+    def stop(self):
+        """Stop reading the source.  run() then passes on the events
+            stages are holding back, and returns once the workers have
+            emptied their queues
+        """
+        self._running = False
+
+    def _close_workers(self):
+        # In pipeline order, so a worker is only closed once the
+        #   one before it can no longer put anything into its queue
+        workers = iter(self._workers)
+        for slot in self._slots:
+            if slot.queue is not None:
+                slot.closed = True
+                next(workers).join(_IDLE_WAKEUP_SEC * 2)
+
+    def _worker_loop(self, start):
+        slot = self._slots[start]
+        segment = self._segment(start)
+        while True:
+            try:
+                put_at, event = slot.queue.get(
+                        timeout=self._timeout(segment, _IDLE_WAKEUP_SEC))
+            except queue.Empty:
+                if slot.closed:
+                    self._flush(segment)
+                    return
+                self._poll(segment)
+                continue
+            slot.queue_wait.add(time.perf_counter() - put_at)
+            if slot.backpressure and slot.queue.qsize() <= slot.low_water:
+                self._set_backpressure(slot, False)
+            self._process(start, event)
+            self._poll(segment)
+
+    def _timeout(self, segment, idle):
+        """Seconds until a stage in segment wants to be polled (at most idle)"""
+        deadlines = [deadline for deadline in
+                     (self._slots[index].stage.deadline() for index in segment)
+                     if deadline is not None]
+        if not deadlines:
+            return idle
+        timeout = max(0.0, min(deadlines) - self.clock())
+        return timeout if idle is None else min(timeout, idle)
+
+    def _poll(self, segment):
+        now = self.clock()
+        for index in segment:
+            stage = self._slots[index].stage
+            deadline = stage.deadline()
+            if deadline is not None and deadline <= now:
+                event = stage.poll(now)
+                if event is not None:
+                    self._pass_on(index + 1, event)
+
+    def _flush(self, segment):
+        """Pass on whatever the stages in segment are holding back"""
+        now = self.clock()
+        for index in segment:
+            event = self._slots[index].stage.flush(now)
+            if event is not None:
+                self._pass_on(index + 1, event)
+
+    def _process(self, index, event):
+        """Run stage index on event, in the calling thread"""
+        slot = self._slots[index]
+        slot.events_in += 1
+        started = time.perf_counter()
+        event = slot.stage.process(event)
+        elapsed = time.perf_counter() - started
+        slot.busy_sec += elapsed
+        slot.process_time.add(elapsed)
+        if event is not None:
+            self._pass_on(index + 1, event)
+
+    def _pass_on(self, index, event):
+        """Hand event to stage index, from the stage before it"""
+        if index > 0:
+            self._slots[index - 1].events_out += 1
+        if index == len(self._slots):
+            self.latency.add(self.clock() - event.started_at)
+            return
+        slot = self._slots[index]
+        if slot.queue is None:
+            self._process(index, event)
+            return
+
+        if not slot.backpressure and slot.queue.qsize() + 1 >= slot.high_water:
+            self._set_backpressure(slot, True)
+        item = (time.perf_counter(), event)
+        try:
+            slot.queue.put_nowait(item)
+        except queue.Full:
+            if slot.stage.coalesce:
+                # Whatever is queued covers this event too
+                slot.coalesced += 1
+                return
+            started = time.perf_counter()
+            slot.queue.put(item)
+            slot.blocked_sec += time.perf_counter() - started
+        slot.max_depth = max(slot.max_depth, slot.queue.qsize())
+
+    def _set_backpressure(self, slot, active):
+        with self._lock:
+            if slot.backpressure == active:
+                return
+            slot.backpressure = active
+            if active:
+                slot.backpressure_count += 1
+        print('Pick pipeline: %s queue %s' % (
+                slot.stage.name, 'filling up' if active else 'drained'))
+        for listener in self._listeners:
+            callback = getattr(listener, 'pick_backpressure', None)
+            if callback is not None:
+                callback(self, slot.stage.name, active)
+
+    def as_dict(self):
+        return {
+                'source_events': self.source_events,
+                'latency': self.latency.percentiles(),
+                'backpressure': self.backpressure,
+                'stages': [slot.as_dict() for slot in self._slots],
+        }
+
+
+###############################
+#          Benchmark          #
+###############################
+class _ReplayFinished(Exception):
+    """Raised by _ReplaySource once every press has been replayed"""
+
+
+class _ReplaySource(object):
+    """Source replaying (pressed_at, released_at) presses as fast as the
+        pipeline takes them, on a virtual clock
+    """
+
+    def __init__(self, presses):
+        self.presses = presses
+        self.now = 0.0
+        self._index = 0
+
+    def clock(self):
+        return self.now
+
+    def read(self, timeout):
+        if self._index == len(self.presses):
+            # Let the last pick's merge gap pass, then stop
+            if timeout is None:
+                raise _ReplayFinished()
+            self.now += timeout
+            return None
+        pressed_at, released_at = self.presses[self._index]
+        if timeout is not None and pressed_at > self.now + timeout:
+            self.now += timeout
+            return None
+        self._index += 1
+        self.now = max(self.now, released_at)
+        return PickEvent(self.now, pressed_at, released_at)
+
+
+class _BenchChrc(object):
+    """Stands in for TrashGrabbedChrc with a journal, with a slow
+        delivery that sends everything stored so far
+    """
+
+    def __init__(self, deliver_sec):
+        self.deliver_sec = deliver_sec
+        self.stored = 0
+        self.delivered = 0
+
+    def new_pick(self, duration_ms, age_sec=0.0):
+        return PickRecord(None, time.time() - age_sec, duration_ms=duration_ms)
+
+    def store_pick(self, record):
+        record.seq = self.stored
+        self.stored += 1
+
+    def deliver_pick(self, record):
+        stored = self.stored
+        time.sleep(self.deliver_sec)
+        self.delivered = max(self.delivered, stored)
+
+
+def main(hours, deliver_ms, queue_size):
+    presses, real_picks = synthetic_presses(hours * 3600.0)
+    source = _ReplaySource(presses)
+    chrc = _BenchChrc(deliver_ms / 1000.0)
+
+    pipeline = PickPipeline(source, source.clock)
+    pipeline.add_stage(DebounceStage())
+    pipeline.add_stage(ClassifyStage(PressCoalescer()))
+    for stage in (EnrichStage(chrc, source.clock), BufferStage(chrc),
+                  DeliverStage(chrc, True)):
+        pipeline.add_stage(stage, queue_size if stage.QUEUED else 0)
+
+    started = time.perf_counter()
+    try:
+        pipeline.run()
+    except _ReplayFinished:
+        pass
+    elapsed = time.perf_counter() - started
+
+    print('%d presses (%d real picks) replayed in %.2f s, %d ms per delivery, '
+          'queues of %d' % (len(presses), real_picks, elapsed, deliver_ms, queue_size))
+    print('%-9s %6s %6s %10s %10s %9s %11s %10s %6s %9s' % (
+            'stage', 'in', 'out', 'p50 ms', 'p99 ms', 'max depth', 'wait p99 ms',
+            'blocked s', 'bp', 'coalesced'))
+    for stats in pipeline.as_dict()['stages']:
+        times = stats['process_time']
+        queue_stats = stats.get('queue')
+        print('%-9s %6d %6d %10.3f %10.3f %9s %11s %10s %6s %9s' % (
+                stats['name'], stats['in'], stats['out'],
+                times.get('p50_ms', 0.0), times.get('p99_ms', 0.0),
+                queue_stats['max_depth'] if queue_stats else '-',
+                '%.3f' % queue_stats['wait'].get('p99_ms', 0.0) if queue_stats else '-',
+                '%.2f' % queue_stats['blocked_sec'] if queue_stats else '-',
+                queue_stats['backpressure_count'] if queue_stats else '-',
+                queue_stats['coalesced'] if queue_stats else '-'))
+    print('Delivered %d picks' % chrc.delivered)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', default=24, type=float,
+                        help="hours of synthetic presses (default: 24)")
+    parser.add_argument('--deliver-ms', default=20, type=float,
+                        help="time the deliver stage takes per pick (default: 20)")
+    parser.add_argument('--queue-size', default=QUEUE_SIZE, type=int,
+                        help="size of the queues in front of queued stages " +
+                        "(default: %d)" % QUEUE_SIZE)
+    args = parser.parse_args()
+
+    main(args.hours, args.deliver_ms, args.queue_size)
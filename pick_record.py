@@ -0,0 +1,84 @@
+######################################################
+#
+# A single trash pick, as stored in the pick journal
+#   and sent to GATT clients in an indication
+#
+# On-air format (little endian):
+#   uint32 seq        -> sequence number of the pick
+#   uint32 timestamp  -> Unix time (seconds) of the pick
+#   int32 lat_e7      -> latitude in degrees * 1e7, or
+#                        NO_LOCATION (-2**31) without a GPS fix
+#   int32 lon_e7      -> longitude in degrees * 1e7, or NO_LOCATION
+#   uint16 duration_ms -> how long the handle was pressed, or
+#                        NO_DURATION (0xFFFF) if unknown
+#
+# The location and duration were appended, clients reading
+#   only the first 8 (or 16) bytes keep working
+#
+#####################################################
+
+import struct
+
+
+class PickRecord(object):
+    """One trash pick
+
+        Arguments:
+            seq: Sequence number of the pick (unique, increasing)
+            timestamp: Unix time (float seconds) the pick happened
+            lat_e7: Latitude in degrees * 1e7 from the on-device GPS, or None
+            lon_e7: Longitude in degrees * 1e7, or None
+            duration_ms: How long the handle was pressed (see
+                press_coalescer.py), or None
+    """
+
+    # (column name, SQLite type) for every field we persist
+    FIELDS = (
+            ('seq', 'INTEGER PRIMARY KEY'),
+            ('timestamp', 'REAL NOT NULL'),
+            ('lat_e7', 'INTEGER'),
+            ('lon_e7', 'INTEGER'),
+            ('duration_ms', 'INTEGER'),
+    )
+
+    _STRUCT = struct.Struct('<IIiiH')
+
+    NO_LOCATION = -0x80000000
+    NO_DURATION = 0xffff
+
+    # There can be many thousands of these in the journal's backlog
+    __slots__ = ('seq', 'timestamp', 'lat_e7', 'lon_e7', 'duration_ms')
+
+    def __init__(self, seq, timestamp, lat_e7=None, lon_e7=None, duration_ms=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.lat_e7 = lat_e7
+        self.lon_e7 = lon_e7
+        self.duration_ms = duration_ms
+
+    def pack(self):
+        """Return the on-air representation of this pick as bytes"""
+        if self.lat_e7 is None:
+            lat_e7 = lon_e7 = self.NO_LOCATION
+        else:
+            lat_e7, lon_e7 = self.lat_e7, self.lon_e7
+        if self.duration_ms is None:
+            duration_ms = self.NO_DURATION
+        else:
+            duration_ms = min(self.duration_ms, self.NO_DURATION - 1)
+        return self._STRUCT.pack(self.seq & 0xffffffff,
+                                 int(self.timestamp) & 0xffffffff,
+                                 lat_e7, lon_e7, duration_ms)
+
+    def to_row(self):
+        """Return the values of FIELDS, in order, for a SQLite insert"""
+        return (self.seq, self.timestamp, self.lat_e7, self.lon_e7, self.duration_ms)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def __repr__(self):
+        return ('PickRecord(seq=%d, timestamp=%.3f, lat_e7=%r, lon_e7=%r, '
+                'duration_ms=%r)' % (self.seq, self.timestamp, self.lat_e7,
+                                     self.lon_e7, self.duration_ms))
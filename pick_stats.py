@@ -0,0 +1,173 @@
+######################################################
+#
+# Pre-aggregated pick statistics for the Pick Stats
+#   characteristic
+#
+# Every pick is counted into two rings of buckets, one
+#   per minute over the last hour and one per hour over
+#   the last day.  A bucket remembers which minute/hour it
+#   holds and is zeroed when it is reused, so adding a pick
+#   is O(1) and the whole structure has a fixed size no
+#   matter how many picks there are
+#
+# The statistics are read in three parts, so the summary
+#   fits in one ATT read at the default MTU of 23 (22 bytes
+#   a read) and the buckets are only read when they are
+#   shown.  Each part is consistent on its own
+#
+# Summary format (little endian, 22 bytes, pack_summary):
+#   uint32 session_total    -> picks since the server started
+#   uint32 lifetime_total   -> picks ever journaled
+#   uint32 session_start    -> Unix time the server started
+#   uint32 now              -> Unix time of the read
+#   uint16 peak_per_minute  -> most picks in any one minute
+#                              this session
+#   uint32 peak_minute      -> Unix time that minute started
+#
+# Minutes format (64 bytes, pack_minutes):
+#   uint32 now              -> Unix time the buckets end at
+#   uint8[60] minutes       -> picks per minute, oldest first,
+#                              the last one is the current
+#                              minute (saturates at 255)
+#
+# Hours format (52 bytes, pack_hours):
+#   uint32 now              -> Unix time the buckets end at
+#   uint16[24] hours        -> picks per hour, oldest first,
+#                              the last one is the current
+#                              hour (saturates at 65535)
+#
+#####################################################
+
+import array
+import struct
+import threading
+import time
+
+
+MINUTE_BUCKETS = 60
+HOUR_BUCKETS = 24
+
+_SUMMARY = struct.Struct('<IIIIHI')
+_MINUTES = struct.Struct('<I%dB' % MINUTE_BUCKETS)
+_HOURS = struct.Struct('<I%dH' % HOUR_BUCKETS)
+
+
+class _BucketRing(object):
+    """Counts per period over the last len(counts) periods
+
+        Arguments:
+            buckets: Number of periods kept
+            period: Length of a period in seconds
+            typecode: array typecode of the counts
+            limit: Largest count a bucket holds
+    """
+
+    __slots__ = ('period', 'limit', 'counts', 'stamps')
+
+    def __init__(self, buckets, period, typecode, limit):
+        self.period = period
+        self.limit = limit
+        self.counts = array.array(typecode, [0] * buckets)
+        # Which period (time // period) each bucket holds
+        self.stamps = array.array('q', [-1] * buckets)
+
+    def add(self, timestamp):
+        """Count one pick, returns the count of its period (0 if the
+            period is older than any kept)
+        """
+        index = int(timestamp // self.period)
+        slot = index % len(self.counts)
+        if self.stamps[slot] > index:
+            # Its bucket has been reused for a newer period
+            return 0
+        if self.stamps[slot] != index:
+            self.stamps[slot] = index
+            self.counts[slot] = 0
+        if self.counts[slot] < self.limit:
+            self.counts[slot] += 1
+        return self.counts[slot]
+
+    def ordered(self, now):
+        """Counts of the periods ending with the one now is in, oldest first"""
+        current = int(now // self.period)
+        buckets = len(self.counts)
+        result = []
+        for index in range(current - buckets + 1, current + 1):
+            slot = index % buckets
+            result.append(self.counts[slot] if self.stamps[slot] == index else 0)
+        return result
+
+
+class PickStats(object):
+    """Session, lifetime, per-minute and per-hour pick counts
+
+        add() is called from whichever thread detects picks and
+        the pack_*() methods from the main loop
+
+        Arguments:
+            lifetime_total: Picks made before this session
+                (PickJournal.next_seq())
+            clock: Function returning the current Unix time, the
+                clock picks are stamped with (e.g. ClockSync.now)
+    """
+
+    def __init__(self, lifetime_total=0, clock=time.time):
+        self.clock = clock
+        self.session_start = clock()
+        self.session_total = 0
+        self.lifetime_total = lifetime_total
+        self.peak_per_minute = 0
+        self.peak_minute = 0
+        self._minutes = _BucketRing(MINUTE_BUCKETS, 60, 'B', 0xff)
+        self._hours = _BucketRing(HOUR_BUCKETS, 3600, 'H', 0xffff)
+        self._lock = threading.Lock()
+
+    def add(self, timestamp):
+        """Count a pick made at timestamp (Unix time)"""
+        with self._lock:
+            self.session_total += 1
+            self.lifetime_total += 1
+            this_minute = self._minutes.add(timestamp)
+            self._hours.add(timestamp)
+            if this_minute > self.peak_per_minute:
+                self.peak_per_minute = this_minute
+                self.peak_minute = int(timestamp // 60) * 60
+
+    def pack_summary(self, now=None):
+        """Return the summary format (see above) as bytes"""
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            return _SUMMARY.pack(self.session_total & 0xffffffff,
+                                 self.lifetime_total & 0xffffffff,
+                                 int(self.session_start), int(now),
+                                 min(self.peak_per_minute, 0xffff),
+                                 self.peak_minute)
+
+    def pack_minutes(self, now=None):
+        """Return the minutes format (see above) as bytes"""
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            return _MINUTES.pack(int(now), *self._minutes.ordered(now))
+
+    def pack_hours(self, now=None):
+        """Return the hours format (see above) as bytes"""
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            return _HOURS.pack(int(now), *self._hours.ordered(now))
+
+    def as_dict(self, now=None):
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            return {
+                    'session_total': self.session_total,
+                    'lifetime_total': self.lifetime_total,
+                    'session_start': self.session_start,
+                    'peak_per_minute': self.peak_per_minute,
+                    'peak_minute': self.peak_minute,
+                    'last_hour': sum(self._minutes.ordered(now)),
+                    'last_day': sum(self._hours.ordered(now)),
+            }
@@ -0,0 +1,243 @@
+######################################################
+#
+# Coalescing handle presses into picks
+#
+# gpio_poll_thread() only sees "beam blocked, then clear
+#   again".  A shaky grip that briefly clears the IR beam
+#   mid-pick shows up as two or three presses a few hundred
+#   milliseconds apart, and each of them used to become a
+#   pick and an indication (a radio round trip each)
+#
+# PressCoalescer sits between edge detection and
+#   notify_trash_grabbed():
+#   - a press starting less than merge_gap_sec after the
+#     previous one was released is merged into it, so a pick
+#     is only complete merge_gap_sec after its last release
+#   - a merged press shorter than min_press_sec (a leaf
+#     through the beam) or longer than max_press_sec (the
+#     picker lying in the grass) is rejected
+#   - every pick carries its duration, first press to last
+#     release, in milliseconds, and is stamped with the time
+#     of its first press (pick_pressed_at), not the time the
+#     merge gap ran out
+#
+# Press traces have one raw press per line, the times it
+#   was pressed and released in seconds ("12.031 12.544"),
+#   and are recorded with --press-trace in my-gatt-server.py.
+#   Run this file directly to report how many indications
+#   coalescing saves on one, for a few merge gaps:
+#     python press_coalescer.py presses.trace
+#   without a file it uses a synthetic hour of shaky grips
+#
+#####################################################
+
+import argparse
+import random
+
+
+MERGE_GAP_SEC = 0.5
+MIN_PRESS_SEC = 0.05
+MAX_PRESS_SEC = 10.0
+
+
+class PressCoalescer(object):
+    """Merges raw presses into picks
+
+        Fed by the thread that sees the edges, times are seconds on
+        any clock that does not jump (time.monotonic())
+
+        Arguments:
+            merge_gap_sec: Presses starting less than this after the
+                previous release belong to the same pick
+            min_press_sec: Shortest pick accepted
+            max_press_sec: Longest pick accepted
+            trace: File every raw press is written to, or None
+    """
+
+    def __init__(self, merge_gap_sec=MERGE_GAP_SEC, min_press_sec=MIN_PRESS_SEC,
+                 max_press_sec=MAX_PRESS_SEC, trace=None):
+        self.merge_gap_sec = merge_gap_sec
+        self.min_press_sec = min_press_sec
+        self.max_press_sec = max_press_sec
+        self.trace = trace
+
+        # First press and last release of the pick being coalesced
+        self._pressed_at = None
+        self._released_at = None
+        # First press of the pick press(), poll() or flush() last returned
+        self.pick_pressed_at = None
+
+        self.presses = 0
+        self.merged = 0
+        self.picks = 0
+        self.rejected_short = 0
+        self.rejected_long = 0
+
+    def press(self, pressed_at, released_at):
+        """A raw press, blocked at pressed_at and clear again at released_at
+
+            Returns the duration in milliseconds of the pick this press
+            completed (the previous one, which it cannot be merged into),
+            or None
+        """
+        self.presses += 1
+        if self.trace is not None:
+            self.trace.write('%.3f %.3f\n' % (pressed_at, released_at))
+
+        duration_ms = None
+        if self._pressed_at is not None:
+            if pressed_at - self._released_at < self.merge_gap_sec:
+                self.merged += 1
+                self._released_at = released_at
+                return None
+            duration_ms = self._end_pick()
+        self._pressed_at = pressed_at
+        self._released_at = released_at
+        return duration_ms
+
+    def deadline(self):
+        """When the pick being coalesced is complete, or None if there is none"""
+        if self._pressed_at is None:
+            return None
+        return self._released_at + self.merge_gap_sec
+
+    def poll(self, now):
+        """Returns the duration in milliseconds of the pick being coalesced
+            if it is complete at now, or None
+        """
+        if self._pressed_at is None or now < self._released_at + self.merge_gap_sec:
+            return None
+        return self._end_pick()
+
+    def flush(self):
+        """Complete the pick being coalesced now, returns its duration
+            in milliseconds or None
+        """
+        if self._pressed_at is None:
+            return None
+        return self._end_pick()
+
+    def _end_pick(self):
+        duration = self._released_at - self._pressed_at
+        self.pick_pressed_at = self._pressed_at
+        self._pressed_at = self._released_at = None
+        if duration < self.min_press_sec:
+            self.rejected_short += 1
+            return None
+        if duration > self.max_press_sec:
+            self.rejected_long += 1
+            return None
+        self.picks += 1
+        return int(round(duration * 1000))
+
+    def as_dict(self):
+        return {
+                'merge_gap_sec': self.merge_gap_sec,
+                'presses': self.presses,
+                'merged': self.merged,
+                'picks': self.picks,
+                'rejected_short': self.rejected_short,
+                'rejected_long': self.rejected_long,
+        }
+
+
+###############################
+#          Benchmark          #
+###############################
+def load_trace(path):
+    """Return the (pressed_at, released_at) presses of a trace file"""
+    presses = []
+    with open(path) as trace:
+        for line in trace:
+            line = line.split('#')[0].strip()
+            if line:
+                pressed_at, released_at = line.split()
+                presses.append((float(pressed_at), float(released_at)))
+    return presses
+
+
+def synthetic_presses(seconds=3600.0, seed=490):
+    """Return (presses, real picks) for seconds of picking: a pick every
+        half minute or so, a third of them with a shaky grip clearing
+        the beam once or twice, plus leaves and the picker being laid
+        down in the grass now and then
+    """
+    rng = random.Random(seed)
+    presses = []
+    picks = 0
+    now = 0.0
+    while True:
+        now += rng.expovariate(1 / 30.0) + 1.0
+        if now >= seconds:
+            return presses, picks
+        kind = rng.random()
+        if kind < 0.05:
+            # A leaf through the beam
+            presses.append((now, now + rng.uniform(0.015, 0.04)))
+        elif kind < 0.07:
+            # Laid down with the beam blocked
+            duration = rng.uniform(20.0, 60.0)
+            presses.append((now, now + duration))
+            now += duration
+        else:
+            picks += 1
+            end = now + rng.uniform(0.4, 1.5)
+            clears = rng.choice((0, 0, 1, 2)) if rng.random() < 0.5 else 0
+            pressed_at = now
+            for _ in range(clears):
+                released_at = rng.uniform(pressed_at + 0.05, end - 0.1)
+                if released_at <= pressed_at:
+                    break
+                presses.append((pressed_at, released_at))
+                pressed_at = released_at + rng.uniform(0.03, 0.3)
+            presses.append((pressed_at, max(end, pressed_at + 0.05)))
+            now = end
+
+
+def main(trace_path, merge_gaps, interval_ms):
+    if trace_path:
+        presses = load_trace(trace_path)
+        real_picks = None
+        print('%d presses over %.0f s in %s' % (
+                len(presses), presses[-1][1] - presses[0][0] if presses else 0,
+                trace_path))
+    else:
+        presses, real_picks = synthetic_presses()
+        print('%d presses of %d real picks in a synthetic hour' % (len(presses),
+                                                                     real_picks))
+
+    # Without coalescing every press was indicated
+    print('%10s  %11s  %7s  %8s  %8s  %11s  %10s' % (
+            'merge gap', 'indications', 'merged', 'short', 'long', 'saved', 'on air'))
+    print('%10s  %11d  %7s  %8s  %8s  %11s  %8.1f s' % (
+            'none', len(presses), '-', '-', '-', '-',
+            len(presses) * interval_ms / 1000.0))
+    for merge_gap in merge_gaps:
+        coalescer = PressCoalescer(merge_gap)
+        for pressed_at, released_at in presses:
+            coalescer.press(pressed_at, released_at)
+        coalescer.flush()
+        saved = len(presses) - coalescer.picks
+        print('%8.0f ms  %11d  %7d  %8d  %8d  %5d %4.0f%%  %8.1f s' % (
+                merge_gap * 1000, coalescer.picks, coalescer.merged,
+                coalescer.rejected_short, coalescer.rejected_long, saved,
+                100.0 * saved / max(1, len(presses)),
+                coalescer.picks * interval_ms / 1000.0))
+    if real_picks is not None:
+        print('%d real picks' % real_picks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace', nargs='?',
+                        help="press trace recorded with --press-trace " +
+                        "(default: a synthetic hour)")
+    parser.add_argument('--merge-gaps', default='250,500,1000',
+                        help="comma separated merge gaps in ms (default: 250,500,1000)")
+    parser.add_argument('--interval-ms', default=30, type=float,
+                        help="BLE connection interval, one indication round " +
+                        "trip each (default: 30)")
+    args = parser.parse_args()
+
+    main(args.trace, [int(gap) / 1000.0 for gap in args.merge_gaps.split(',')],
+         args.interval_ms)
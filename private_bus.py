@@ -0,0 +1,37 @@
+######################################################
+#
+# Private D-Bus daemon for benchmarks and replays
+#
+# Starts a throwaway dbus-daemon so GATT objects can be
+#   exported and called over a real bus without BlueZ
+#   or the system bus
+#
+#####################################################
+
+import subprocess
+
+import dbus
+import dbus.bus
+
+
+class PrivateBus(object):
+    """A dbus-daemon of our own, stopped by close()"""
+
+    def __init__(self):
+        self._process = subprocess.Popen(
+                ['dbus-daemon', '--session', '--nofork', '--print-address'],
+                stdout=subprocess.PIPE)
+        self.address = self._process.stdout.readline().decode('utf-8').strip()
+        if not self.address:
+            self.close()
+            raise RuntimeError('dbus-daemon did not start')
+
+    def connect(self):
+        """Return a new connection to the private bus"""
+        return dbus.bus.BusConnection(self.address)
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+        self._process.stdout.close()
@@ -0,0 +1,181 @@
+######################################################
+#
+# On-demand sampling profiler for the running server
+#
+#   kill -USR1 <pid>  -> start profiling
+#   kill -USR2 <pid>  -> stop and write the results
+#
+# While running, a sampler thread looks at the stack of
+#   every thread (the GObject main loop, the GPIO thread,
+#   the journal writer, ...) SAMPLE_INTERVAL_SEC apart, and
+#   the D-Bus methods BlueZ calls on us (see TIMED_METHODS)
+#   are timed where dbus-python dispatches them (see
+#   dbus_cache.py): from the call to the reply, so the
+#   handlers AsyncCharacteristic runs in worker threads are
+#   timed until they are done, not only the hand-off
+#
+# Results are written to OUTPUT_DIR as
+#   stp-profile-<time>.folded   collapsed stacks, one
+#       "thread;outer;...;inner count" line per stack,
+#       ready for flamegraph.pl or speedscope
+#   stp-profile-<time>.methods  per-D-Bus-method call
+#       counts and timings
+#
+# When not profiling, nothing runs: no thread, no timing,
+#   just the two signal handlers
+#
+#####################################################
+
+import collections
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from gi.repository import GLib
+except ImportError:
+    GLib = None
+
+try:
+    import dbus_cache
+except ImportError:
+    dbus_cache = None
+
+
+# Walking every thread's stack is not free on a Pi Zero
+SAMPLE_INTERVAL_SEC = 0.015
+OUTPUT_DIR = tempfile.gettempdir()
+
+# D-Bus methods whose calls are timed while profiling
+TIMED_METHODS = frozenset([
+        'GetManagedObjects', 'GetAll', 'ReadValue', 'WriteValue',
+        'StartNotify', 'StopNotify',
+])
+
+
+def _frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """Statistical profiler over all threads plus D-Bus method timings
+
+        Arguments:
+            output_dir: Directory the result files are written to
+            interval: Seconds between samples
+    """
+
+    def __init__(self, output_dir=OUTPUT_DIR, interval=SAMPLE_INTERVAL_SEC):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.running = False
+        self._stacks = collections.Counter()
+        self._method_times = {}
+        self._sampler = None
+        self._stop_event = threading.Event()
+        self._started_at = None
+
+    def start(self):
+        """Start profiling (must be called on the main loop's thread)"""
+        if self.running:
+            print('Profiler already running')
+            return
+        print('Starting sampling profiler')
+        self.running = True
+        self._started_at = time.time()
+        self._stacks.clear()
+        self._method_times.clear()
+        self._stop_event.clear()
+        self._sampler = threading.Thread(target=self._sample_loop,
+                                         name='sampling-profiler')
+        self._sampler.daemon = True
+        self._sampler.start()
+        if dbus_cache is not None:
+            dbus_cache.timed_methods = TIMED_METHODS
+            dbus_cache.method_timer = self._time_method
+
+    def stop(self):
+        """Stop profiling and write the results
+
+            Returns the filepath prefix of the written files, or None
+        """
+        if not self.running:
+            print('Profiler not running')
+            return None
+        if dbus_cache is not None:
+            dbus_cache.method_timer = None
+        self._stop_event.set()
+        self._sampler.join()
+        self.running = False
+
+        prefix = os.path.join(self.output_dir, 'stp-profile-%d' % self._started_at)
+        self._write_folded(prefix + '.folded')
+        self._write_methods(prefix + '.methods')
+        print('Profile written to %s.folded and %s.methods' % (prefix, prefix))
+        return prefix
+
+    def _sample_loop(self):
+        own_ident = threading.current_thread().ident
+        while not self._stop_event.wait(self.interval):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                stack.reverse()
+                self._stacks[';'.join(stack)] += 1
+
+    def _time_method(self, name, elapsed):
+        # Called on the main loop, where replies are sent
+        times = self._method_times.get(name)
+        if times is None:
+            times = self._method_times[name] = [0, 0.0, 0.0]
+        times[0] += 1
+        times[1] += elapsed
+        times[2] = max(times[2], elapsed)
+
+    def _write_folded(self, path):
+        with open(path, 'w') as folded:
+            for stack, count in self._stacks.most_common():
+                folded.write('%s %d\n' % (stack, count))
+
+    def _write_methods(self, path):
+        with open(path, 'w') as methods:
+            methods.write('%-20s %8s %12s %12s %12s\n' % (
+                    'method', 'calls', 'total ms', 'mean ms', 'max ms'))
+            for name in sorted(self._method_times):
+                calls, total, longest = self._method_times[name]
+                methods.write('%-20s %8d %12.3f %12.3f %12.3f\n' % (
+                        name, calls, total * 1000, total * 1000 / calls, longest * 1000))
+
+
+def install_signal_handlers(profiler, start_signal=signal.SIGUSR1,
+                            stop_signal=signal.SIGUSR2):
+    """Start/stop profiler when the process receives start_signal/stop_signal
+
+        The handlers are dispatched by the GLib main loop when possible,
+        so they run on the main loop's thread without waiting for it
+        to wake up for some other reason
+    """
+    def on_start(*args):
+        profiler.start()
+        return True
+
+    def on_stop(*args):
+        profiler.stop()
+        return True
+
+    if GLib is not None and hasattr(GLib, 'unix_signal_add'):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, start_signal, on_start)
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, stop_signal, on_stop)
+    else:
+        signal.signal(start_signal, on_start)
+        signal.signal(stop_signal, on_stop)
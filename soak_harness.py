@@ -0,0 +1,454 @@
+######################################################
+#
+# Soak test for the pick pipeline
+#
+# Drives the real pick path
+#   simulated GPIO -> gpio_poll_thread() -> TrashGrabbedChrc
+#   -> PickJournal -> PropertiesChanged -> Confirm
+# on a virtual clock, so days of picks, phone connects and
+#   disconnects run in minutes.  The GATT objects are not
+#   exported on any bus, so PropertiesChanged goes nowhere
+#   (a mock D-Bus), but everything in front of it is real.
+#   A mock BlueZ feeds the phone's Device1 connect and
+#   disconnect sequences to a DevicePresence, and the phone
+#   writes Current Time on every connect
+#
+# Once per simulated hour we sample RSS, tracemalloc,
+#   GC object counts and per-pick latency (real time the
+#   pick pipeline's enrich, buffer and deliver stages take,
+#   from the pick being complete to it being journaled and
+#   sent).  A pick is complete once the press coalescer's
+#   merge gap after the release has passed, and harness
+#   callbacks run during that gap on the virtual clock, so
+#   it is not timed from the release.  At the end we fit a
+#   trend line to each metric and fail if any of them grows,
+#   or if a backlog was not delivered within BACKLOG_FLUSH_SEC
+#   of the phone reconnecting
+#
+# The JSON report can be compared against an older build:
+#   python soak_harness.py --days 3 --report new.json --compare old.json
+#
+#####################################################
+
+import argparse
+import gc
+import heapq
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from contextlib import redirect_stdout
+
+from clock_sync import pack_current_time
+from device_presence import DevicePresence
+from pick_journal import PickJournal
+
+
+SERVER_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'my-gatt-server.py')
+
+SAMPLE_INTERVAL_SEC = 60 * 60
+CONFIRM_DELAY_SEC = 0.05
+# The backlog must be delivered this long after the phone reconnects
+BACKLOG_FLUSH_SEC = 60
+
+# The mock phone's BlueZ object path and address
+PHONE_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+PHONE_ADDRESS = '00:11:22:33:44:55'
+
+# Allowed growth of each metric over the run (after warm-up),
+#   as a fraction of its value at the start of the trend line
+TREND_LIMITS = {
+        'rss_kb': 0.10,
+        'traced_kb': 0.10,
+        'gc_objects': 0.10,
+        'latency_p50_us': 0.25,
+}
+
+# Growth smaller than this (in the metric's units) is noise, even
+#   if it is large relative to a tiny starting value
+TREND_NOISE_FLOORS = {
+        'rss_kb': 512,
+        'traced_kb': 64,
+        'gc_objects': 500,
+        'latency_p50_us': 100,
+}
+
+# Samples in the first WARMUP_FRACTION of the run are not used
+#   for trends (caches, the journal and the allocator settling)
+WARMUP_FRACTION = 0.2
+
+
+def load_server_module():
+    """Import my-gatt-server.py (its name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location('stp_server', SERVER_SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SoakFinished(Exception):
+    """Raised by SimulatedGPIO when there are no presses left"""
+
+
+class VirtualClock(object):
+    """Simulated time with callbacks scheduled at points in simulated time"""
+
+    def __init__(self):
+        self.now = 0.0
+        self._events = []
+        self._counter = 0
+
+    def schedule(self, when, callback):
+        self._counter += 1
+        heapq.heappush(self._events, (when, self._counter, callback))
+
+    def advance_to(self, when):
+        while self._events and self._events[0][0] <= when:
+            event_time, _, callback = heapq.heappop(self._events)
+            self.now = max(self.now, event_time)
+            callback()
+        self.now = max(self.now, when)
+
+    def sleep(self, seconds):
+        self.advance_to(self.now + seconds)
+
+    def monotonic(self):
+        return self.now
+
+
+class SimulatedGPIO(object):
+    """Stand-in for the parts of RPi.GPIO that gpio_poll_thread() uses
+
+        Arguments:
+            clock: VirtualClock the presses happen on
+            presses: List of (press time, release time) in simulated seconds
+    """
+    BCM = 11
+    IN = 1
+    FALLING = 32
+
+    def __init__(self, clock, presses):
+        self.clock = clock
+        self.presses = presses
+        self._index = -1
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def wait_for_edge(self, pin, edge, bouncetime=None, timeout=None):
+        if self._index + 1 >= len(self.presses):
+            raise SoakFinished()
+        if timeout is not None and \
+                self.presses[self._index + 1][0] > self.clock.now + timeout / 1000.0:
+            self.clock.advance_to(self.clock.now + timeout / 1000.0)
+            return None
+        self._index += 1
+        self.clock.advance_to(self.presses[self._index][0])
+        return pin
+
+    def input(self, pin):
+        if self._index < 0:
+            return 1
+        if self.clock.now < self.presses[self._index][1]:
+            return 0
+        return 1
+
+
+def generate_presses(days, picks_per_hour, seed):
+    """Return a list of (press time, release time) for days of picking"""
+    rng = random.Random(seed)
+    presses = []
+    now = 0.0
+    end = days * 24 * 60 * 60
+    mean_gap = 3600.0 / picks_per_hour
+    while True:
+        now += rng.expovariate(1.0 / mean_gap) + 1.0
+        if now >= end:
+            return presses
+        duration = rng.uniform(0.2, 1.5)
+        presses.append((now, now + duration))
+        now += duration
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _rss_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _trend(samples, key):
+    """Least squares slope of key over the post-warm-up samples,
+        returned as growth over that span relative to its start
+
+        Growth below the metric's noise floor is reported as 0
+    """
+    samples = samples[int(len(samples) * WARMUP_FRACTION):]
+    if len(samples) < 3:
+        return 0.0
+    xs = [sample['hour'] for sample in samples]
+    ys = [float(sample[key]) for sample in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    start = mean_y - slope * (mean_x - xs[0])
+    growth = slope * (xs[-1] - xs[0])
+    if abs(growth) < TREND_NOISE_FLOORS[key]:
+        return 0.0
+    return growth / max(abs(start), 1e-9)
+
+
+def _build_id():
+    try:
+        return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(SERVER_SCRIPT_PATH),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_soak(days, picks_per_hour, connect_every_sec, connected_sec, seed):
+    """Run the soak test and return the report (a dict)"""
+    server = load_server_module()
+    clock = VirtualClock()
+    presses = generate_presses(days, picks_per_hour, seed)
+
+    tmp_dir = tempfile.mkdtemp(prefix='stp-soak-',
+                               dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    journal = PickJournal(os.path.join(tmp_dir, 'picks.db'))
+
+    # No bus: the objects are never exported, so signals go nowhere,
+    #   and device updates come from the mock BlueZ below
+    presence = DevicePresence(None)
+    app = server.SmartTrashPickerApplication(None, journal, presence)
+    chrc = app.services[-1].characteristics[0]
+    # CurrentTimeService comes right before SmartTrashPickerService
+    current_time_chrc = app.services[-2].characteristics[0]
+
+    samples = []
+    latencies = []
+    state = { 'picks': 0, 'started': None, 'subscribed': False, 'connects': 0,
+              'backlog_not_flushed': 0 }
+
+    # The pick pipeline's enrich stage calls new_pick and its
+    #   deliver stage deliver_pick, everything runs on one thread
+    new_pick = chrc.new_pick
+    deliver_pick = chrc.deliver_pick
+
+    def timed_new_pick(duration_ms=None, age_sec=0.0):
+        state['started'] = time.perf_counter()
+        return new_pick(duration_ms, age_sec)
+
+    def timed_deliver_pick(record):
+        deliver_pick(record)
+        latencies.append(time.perf_counter() - state['started'])
+        state['picks'] += 1
+
+    chrc.new_pick = timed_new_pick
+    chrc.deliver_pick = timed_deliver_pick
+
+    # The phone confirms each indication CONFIRM_DELAY_SEC after it is sent
+    properties_changed = chrc.PropertiesChanged
+
+    def confirming_properties_changed(*args):
+        properties_changed(*args)
+        clock.schedule(clock.now + CONFIRM_DELAY_SEC, chrc.Confirm)
+
+    chrc.PropertiesChanged = confirming_properties_changed
+
+    # Phone connects every connect_every_sec and stays for connected_sec,
+    #   in the order BlueZ reports it: Connected, ServicesResolved,
+    #   then, on the first connect only, the client subscribing.  The
+    #   phone is bonded, so later connects get the subscription back
+    #   without a StartNotify, and losing the link does not call
+    #   StopNotify either: the presence tracking pauses and resumes
+    #   delivery
+    def connect():
+        backlog = [record.seq for record in journal.pending()]
+        presence.update(PHONE_PATH, { 'Address': PHONE_ADDRESS, 'Paired': True,
+                                      'Connected': True })
+        presence.update(PHONE_PATH, { 'ServicesResolved': True })
+        current_time_chrc.WriteValue(pack_current_time(time.time()), {})
+        if not state['subscribed']:
+            chrc.StartNotify()
+            state['subscribed'] = True
+        clock.schedule(clock.now + connected_sec, disconnect)
+        clock.schedule(clock.now + BACKLOG_FLUSH_SEC,
+                       lambda: check_backlog_flushed(backlog))
+
+    def check_backlog_flushed(backlog):
+        state['connects'] += 1
+        if any(journal.is_pending(seq) for seq in backlog):
+            state['backlog_not_flushed'] += 1
+
+    def disconnect():
+        presence.update(PHONE_PATH, { 'ServicesResolved': False })
+        presence.update(PHONE_PATH, { 'Connected': False })
+        clock.schedule(clock.now + connect_every_sec - connected_sec, connect)
+
+    def sample():
+        gc.collect()
+        # Leave out what the harness itself allocates (e.g. the samples)
+        snapshot = tracemalloc.take_snapshot().filter_traces(harness_filters)
+        traced = sum(stat.size for stat in snapshot.statistics('filename'))
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        samples.append({
+                'hour': clock.now / 3600.0,
+                'picks': state['picks'],
+                'rss_kb': _rss_kb(),
+                'traced_kb': traced // 1024,
+                'traced_peak_kb': traced_peak // 1024,
+                'gc_objects': len(gc.get_objects()),
+                'gc_collections': sum(stats['collections'] for stats in gc.get_stats()),
+                'latency_p50_us': _percentile(latencies, 0.5) * 1e6,
+                'latency_p99_us': _percentile(latencies, 0.99) * 1e6,
+                'backlog': journal.pending_count(),
+                'emitted': chrc.emitted_count,
+        })
+        del latencies[:]
+        clock.schedule(clock.now + SAMPLE_INTERVAL_SEC, sample)
+
+    harness_filters = [
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+    ]
+
+    clock.schedule(0, connect)
+    clock.schedule(SAMPLE_INTERVAL_SEC, sample)
+
+    gpio = SimulatedGPIO(clock, presses)
+
+    # Baseline allocation snapshot, taken once the first simulated hour is over
+    snapshots = []
+    clock.schedule(SAMPLE_INTERVAL_SEC * 1.5,
+                   lambda: snapshots.append(
+                           tracemalloc.take_snapshot().filter_traces(harness_filters)))
+
+    tracemalloc.start()
+    start = time.time()
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            try:
+                # No queues: the virtual clock is not thread safe
+                server.gpio_poll_thread(chrc, gpio, clock.sleep,
+                                        monotonic=clock.monotonic, queue_size=0)
+            except SoakFinished:
+                pass
+        snapshots.append(tracemalloc.take_snapshot().filter_traces(harness_filters))
+    finally:
+        tracemalloc.stop()
+        journal.close()
+        shutil.rmtree(tmp_dir)
+    elapsed = time.time() - start
+
+    growth = []
+    if len(snapshots) == 2:
+        for stat in snapshots[1].compare_to(snapshots[0], 'lineno')[:10]:
+            growth.append({ 'where': str(stat.traceback), 'size_diff_kb': stat.size_diff // 1024,
+                            'count_diff': stat.count_diff })
+
+    trends = dict((key, _trend(samples, key)) for key in TREND_LIMITS)
+    failures = [key for key, limit in TREND_LIMITS.items() if trends[key] > limit]
+    if state['backlog_not_flushed'] or not state['connects']:
+        failures.append('backlog_not_flushed')
+
+    return {
+            'build': _build_id(),
+            'python': platform.python_version(),
+            'parameters': {
+                    'days': days, 'picks_per_hour': picks_per_hour,
+                    'connect_every_sec': connect_every_sec,
+                    'connected_sec': connected_sec, 'seed': seed,
+            },
+            'picks': state['picks'],
+            'connects': state['connects'],
+            'backlog_not_flushed': state['backlog_not_flushed'],
+            'elapsed_sec': elapsed,
+            'samples': samples,
+            'trends': trends,
+            'trend_limits': TREND_LIMITS,
+            'top_allocation_growth': growth,
+            'failures': failures,
+            'passed': not failures,
+    }
+
+
+def print_report(report, baseline=None):
+    print('Build %s: %d picks over %.1f simulated days in %.1f s' % (
+            report['build'], report['picks'], report['parameters']['days'],
+            report['elapsed_sec']))
+    print('  backlog not flushed on %d of %d connects' % (
+            report['backlog_not_flushed'], report['connects']))
+    last = report['samples'][-1] if report['samples'] else {}
+    base_last = baseline['samples'][-1] if baseline and baseline['samples'] else {}
+    for key in TREND_LIMITS:
+        line = '  %-16s final %10.1f  trend %+6.1f%% (limit %+.0f%%)' % (
+                key, last.get(key, 0), report['trends'][key] * 100,
+                TREND_LIMITS[key] * 100)
+        if base_last:
+            line += '  baseline %s final %10.1f' % (baseline['build'], base_last.get(key, 0))
+        print(line)
+    for stat in report['top_allocation_growth'][:5]:
+        print('  %+6d KiB %+7d blocks  %s' % (
+                stat['size_diff_kb'], stat['count_diff'], stat['where']))
+    print('PASSED' if report['passed'] else 'FAILED: ' + ', '.join(report['failures']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', default=3, type=float,
+                        help="simulated days to run (default: 3)")
+    parser.add_argument('--picks-per-hour', default=200, type=float,
+                        help="average picks per simulated hour (default: 200)")
+    parser.add_argument('--connect-every', default=30 * 60, type=float,
+                        help="seconds between phone connects (default: 1800)")
+    parser.add_argument('--connected-for', default=10 * 60, type=float,
+                        help="seconds the phone stays connected (default: 600)")
+    parser.add_argument('--seed', default=490, type=int,
+                        help="random seed for the pick schedule (default: 490)")
+    parser.add_argument('--report', default='soak-report.json',
+                        help="where to write the JSON report (default: soak-report.json)")
+    parser.add_argument('--compare', default=None,
+                        help="JSON report of an older build to compare against")
+    args = parser.parse_args()
+
+    report = run_soak(args.days, args.picks_per_hour, args.connect_every,
+                      args.connected_for, args.seed)
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+
+    sys.exit(0 if report['passed'] else 1)
@@ -10,6 +10,8 @@ source activate smart-trash-picker
 
 GATT_SCRIPT_ABS_FILEPATH=${GATT_DIR}/${GATT_FILENAME}
 echo "Starting GATT server using script at ${GATT_SCRIPT_ABS_FILEPATH}"
-python ${GATT_SCRIPT_ABS_FILEPATH}
+# exec, so the server is the service's main process and may talk to systemd
+# --lean: no demo GATT services, see memory_budget.py
+exec python ${GATT_SCRIPT_ABS_FILEPATH} --lean
 
 
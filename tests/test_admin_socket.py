@@ -0,0 +1,117 @@
+######################################################
+#
+# Admin socket commands and replies: bad arguments are
+#   told apart from commands failing, and a large reply
+#   reaches a client whose socket takes it in parts
+#
+# Needs PyGObject (admin_socket imports GObject), but no
+#   main loop: the watch callbacks are called directly
+#
+#####################################################
+
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from admin_socket import AdminServer
+    from gi.repository import GObject
+except ImportError:
+    AdminServer = None
+
+
+class FakeApp(object):
+
+    services = []
+
+
+@unittest.skipIf(AdminServer is None, 'needs PyGObject')
+class AdminCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = AdminServer('/nonexistent/admin.sock', FakeApp())
+
+    def test_bad_arguments(self):
+        self.assertEqual(self.server.handle_command('tree extra'),
+                         { 'error': 'bad arguments for tree' })
+        self.assertEqual(self.server.handle_command('log on now'),
+                         { 'error': 'bad arguments for log' })
+
+    def test_type_error_inside_a_command_is_a_failure(self):
+        def broken():
+            return len(None)
+        self.server.commands['broken'] = broken
+        reply = self.server.handle_command('broken')
+        self.assertTrue(reply['error'].startswith('broken failed: TypeError'))
+
+    def test_good_arguments_still_work(self):
+        self.assertIn('status', self.server.handle_command('help')['commands'])
+        self.assertEqual(self.server.handle_command('log on'), { 'logging': True })
+        self.assertEqual(self.server.handle_command('log'), { 'error': 'usage: log on|off' })
+
+    def test_log_off_and_on_leaves_old_stdout_usable(self):
+        stdout = sys.stdout
+        try:
+            self.server.handle_command('log off')
+            quiet = sys.stdout
+            self.server.handle_command('log on')
+            self.assertIs(sys.stdout, stdout)
+            # A thread that picked up stdout while logging was off
+            print('still printing', file=quiet)
+        finally:
+            sys.stdout = stdout
+
+
+@unittest.skipIf(AdminServer is None, 'needs PyGObject')
+class AdminReplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = AdminServer('/nonexistent/admin.sock', FakeApp())
+        self.ours, self.theirs = socket.socketpair()
+        self.ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.ours.setblocking(False)
+        self.client = { 'sock': self.ours, 'buffer': b'', 'out': bytearray(),
+                        'watch_id': None, 'write_watch_id': None }
+        self.server._clients[self.ours.fileno()] = self.client
+
+    def tearDown(self):
+        self.theirs.close()
+        self.ours.close()
+
+    def test_large_reply_is_written_in_parts(self):
+        reply = b'x' * 300000 + b'\n'
+        self.assertTrue(self.server._send(self.client, reply))
+        # The socket did not take it all, the rest waits for IO_OUT
+        self.assertTrue(self.client['out'])
+        self.assertIsNotNone(self.client['write_watch_id'])
+
+        received = b''
+        keep_watching = True
+        while keep_watching or len(received) < len(reply):
+            received += self.theirs.recv(65536)
+            if keep_watching:
+                keep_watching = self.server._on_client_writable(
+                        self.ours.fileno(), GObject.IO_OUT, self.client)
+        self.assertEqual(received, reply)
+        self.assertIsNone(self.client['write_watch_id'])
+        self.assertIn(self.ours.fileno(), self.server._clients)
+
+    def test_client_not_reading_is_dropped(self):
+        from admin_socket import MAX_REPLY_BACKLOG_BYTES
+
+        fd = self.ours.fileno()
+        reply = b'x' * (MAX_REPLY_BACKLOG_BYTES // 4)
+        dropped = False
+        for _ in range(8):
+            if not self.server._send(self.client, reply):
+                dropped = True
+                break
+        self.assertTrue(dropped)
+        self.assertNotIn(fd, self.server._clients)
+
+
+if __name__ == '__main__':
+    unittest.main()
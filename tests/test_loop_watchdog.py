@@ -0,0 +1,127 @@
+######################################################
+#
+# LoopWatchdog's systemd side against a fake NOTIFY_SOCKET,
+#   and its stall detection across wall clock steps
+#
+# Needs PyGObject (loop_watchdog imports GObject), but no
+#   main loop: the heartbeat is called directly
+#
+#####################################################
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import loop_watchdog
+    from loop_watchdog import GPIO_STALE_SEC, LoopWatchdog, sd_notify
+except ImportError:
+    loop_watchdog = None
+
+
+class FakeStatus(object):
+
+    def __init__(self):
+        self.heartbeat = time.monotonic()
+        self.backpressure = ()
+
+
+@unittest.skipIf(loop_watchdog is None, 'needs PyGObject')
+class SdNotifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='stp-test-')
+        self.path = os.path.join(self.tmp_dir, 'notify')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1)
+        self.env = mock.patch.dict(os.environ, { 'NOTIFY_SOCKET': self.path,
+                                                 'WATCHDOG_USEC': '2000000',
+                                                 'WATCHDOG_PID': str(os.getpid()) })
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.sock.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def received(self):
+        messages = []
+        self.sock.setblocking(False)
+        try:
+            while True:
+                messages.append(self.sock.recv(4096).decode('utf-8'))
+        except (IOError, OSError):
+            return messages
+        finally:
+            self.sock.settimeout(1)
+
+    def test_sd_notify_sends_to_notify_socket(self):
+        self.assertTrue(sd_notify('READY=1'))
+        self.assertEqual(self.sock.recv(4096), b'READY=1')
+
+    def test_sd_notify_without_systemd(self):
+        del os.environ['NOTIFY_SOCKET']
+        self.assertFalse(sd_notify('READY=1'))
+
+    def test_ready_once_with_status(self):
+        watchdog = LoopWatchdog()
+        watchdog.notify_ready('Advertising')
+        watchdog.notify_ready('Advertising')
+        self.assertEqual(self.received(), ['READY=1\nSTATUS=Advertising'])
+
+    def test_pings_only_while_the_gpio_thread_is_healthy(self):
+        status = FakeStatus()
+        watchdog = LoopWatchdog(gpio_status=status)
+        watchdog._expected_beat = time.monotonic()
+        watchdog._on_heartbeat()
+        self.assertEqual(self.received(), ['WATCHDOG=1'])
+
+        status.heartbeat -= GPIO_STALE_SEC + 1
+        watchdog._last_ping = None
+        watchdog._on_heartbeat()
+        self.assertEqual(self.received(), [])
+        self.assertEqual(watchdog.watchdog_pings, 1)
+
+    def test_backpressure_in_status(self):
+        status = FakeStatus()
+        watchdog = LoopWatchdog(gpio_status=status)
+        watchdog.notify_ready('Advertising')
+        watchdog._expected_beat = time.monotonic()
+        status.backpressure = ('buffer',)
+        watchdog._on_heartbeat()
+        status.backpressure = ()
+        watchdog._on_heartbeat()
+        self.assertEqual(self.received(), ['READY=1\nSTATUS=Advertising',
+                                           'STATUS=Pick pipeline backpressure: buffer',
+                                           'WATCHDOG=1', 'STATUS=Advertising'])
+
+
+@unittest.skipIf(loop_watchdog is None, 'needs PyGObject')
+class WallClockStepTest(unittest.TestCase):
+
+    def test_clock_step_is_not_a_stall(self):
+        status = FakeStatus()
+        watchdog = LoopWatchdog(gpio_status=status)
+        watchdog._expected_beat = time.monotonic()
+        # NTP or fake-hwclock sets the clock an hour ahead, then back
+        for step in (3600, -3600):
+            with mock.patch('time.time', return_value=time.time() + step):
+                watchdog._on_heartbeat()
+                self.assertTrue(watchdog.gpio_healthy())
+        self.assertLess(watchdog.lag.percentiles()['max_ms'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+######################################################
+#
+# Windows of the Pick Export characteristic: read by
+#   cursor, the same window for a repeated read, a cursor
+#   per device, and no resuming into a different snapshot
+#
+# Needs dbus-python and PyGObject (the GATT classes are
+#   dbus.service.Objects), but no bus: nothing is exported
+#
+#####################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import dbus
+    from gi.repository import GObject
+except ImportError:
+    dbus = None
+
+from pick_export import WINDOW_CURSOR, decode_picks, read_window
+from pick_record import PickRecord
+
+
+PHONE_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+OTHER_PHONE_PATH = '/org/bluez/hci0/dev_66_77_88_99_AA_BB'
+
+
+@unittest.skipIf(dbus is None, 'needs dbus-python and PyGObject')
+class PickExportTest(unittest.TestCase):
+
+    def setUp(self):
+        from pick_journal import PickJournal
+        from soak_harness import load_server_module
+
+        self.server = load_server_module()
+        self.tmp_dir = tempfile.mkdtemp(prefix='stp-test-')
+        self.journal = PickJournal(os.path.join(self.tmp_dir, 'picks.db'))
+        app = self.server.SmartTrashPickerApplication(None, self.journal,
+                                                      include_demo_services=False)
+        self.chrc = app.services[-1].characteristics[2]
+        # Small windows, so a few hundred picks take several
+        self.chrc.EXPORT_WINDOW = 64
+        self.add_picks(300)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def add_picks(self, count):
+        for i in range(count):
+            self.journal.append(PickRecord(None, 1600000000.0 + i * 37.5,
+                                           duration_ms=400 + i))
+
+    def write(self, snapshot_id, position, device=PHONE_PATH):
+        self.chrc.write_value(WINDOW_CURSOR.pack(snapshot_id, position),
+                              { 'device': device })
+
+    def read(self, device=PHONE_PATH, mtu=23):
+        # One long read, ATT_MTU - 1 bytes at a time
+        value = b''
+        while True:
+            part = bytes(self.chrc.read_value({ 'device': device, 'offset': len(value) }))
+            value += part
+            if len(part) < mtu - 1:
+                return read_window(value)
+
+    def read_export(self, device=PHONE_PATH):
+        self.write(0, 0, device)
+        export = b''
+        while True:
+            snapshot_id, position, length, data = self.read(device)
+            self.assertEqual(position, len(export))
+            export += data
+            if len(export) == length:
+                return snapshot_id, export
+            self.write(snapshot_id, len(export), device)
+
+    def test_export_read_window_by_window(self):
+        snapshot_id, export = self.read_export()
+        self.assertEqual(len(decode_picks(export)), 300)
+
+    def test_repeated_read_returns_the_same_window(self):
+        self.write(0, 0)
+        first = self.read()
+        # e.g. the first read timed out on the phone's side
+        self.assertEqual(self.read(), first)
+
+    def test_devices_have_cursors_of_their_own(self):
+        self.write(0, 0)
+        snapshot_id, _, _, data = self.read()
+        self.write(snapshot_id, len(data))
+        before = self.read()
+
+        self.read_export(OTHER_PHONE_PATH)
+        self.assertEqual(self.read(), before)
+
+    def test_resume_into_another_snapshot_fails(self):
+        self.write(0, 0)
+        snapshot_id, _, _, data = self.read()
+
+        # Two new snapshots with different picks replace it
+        for _ in range(self.chrc.MAX_SNAPSHOTS):
+            self.add_picks(1)
+            self.read_export(OTHER_PHONE_PATH)
+
+        with self.assertRaises(dbus.exceptions.DBusException):
+            self.write(snapshot_id, len(data))
+        with self.assertRaises(dbus.exceptions.DBusException):
+            self.read()
+
+    def test_resume_after_reconnect_continues_the_same_bytes(self):
+        snapshot_id, export = self.read_export()
+        self.write(snapshot_id, 100)
+        _, position, length, data = self.read()
+        self.assertEqual((position, length), (100, len(export)))
+        self.assertEqual(data, export[100:100 + len(data)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+######################################################
+#
+# The pick journal's group commit when commits fail: the
+#   batch is kept and tried again, and flush()/close() do
+#   not report picks as durable before they are
+#
+#####################################################
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pick_journal import RETRY_INTERVAL_SEC, PickJournal
+from pick_record import PickRecord
+
+
+class FailingConnection(object):
+    """Wraps the journal's connection, failing the next failures COMMITs"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.failures = 0
+
+    def execute(self, sql, *args):
+        if sql == 'COMMIT' and self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('disk I/O error')
+        return self.conn.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class FailedCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='stp-test-')
+        self.journal = PickJournal(os.path.join(self.tmp_dir, 'picks.db'))
+        self.conn = FailingConnection(self.journal._conn)
+        self.journal._conn = self.conn
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def append(self, count):
+        for _ in range(count):
+            self.journal.append(PickRecord(None, 1600000000.0))
+
+    def test_flush_reports_a_failed_commit(self):
+        self.conn.failures = 1
+        self.append(3)
+        self.assertFalse(self.journal.flush(5))
+        self.assertEqual(self.journal.failed_commit_count, 1)
+        self.assertEqual(self.journal.uncommitted_count(), 3)
+        self.assertEqual(len(list(self.journal.iter_picks())), 0)
+
+    def test_failed_ops_are_committed_with_the_next_batch(self):
+        self.conn.failures = 1
+        self.append(3)
+        self.journal.flush(5)
+
+        self.append(2)
+        self.journal.ack(0)
+        self.assertTrue(self.journal.flush(5))
+        self.assertEqual(self.journal.uncommitted_count(), 0)
+        rows = list(self.journal.iter_picks())
+        self.assertEqual([row[0] for row in rows], [0, 1, 2, 3, 4])
+        self.assertEqual(self.journal.inserted_count, 5)
+        self.assertEqual(self.journal.acked_count, 1)
+
+    def test_failed_ops_are_retried_without_new_ones(self):
+        self.conn.failures = 1
+        self.append(2)
+        self.journal.flush(5)
+        deadline = time.time() + RETRY_INTERVAL_SEC * 5
+        while self.journal.uncommitted_count() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(list(self.journal.iter_picks())), 2)
+
+    def test_close_reports_picks_not_committed(self):
+        self.conn.failures = 2
+        self.append(2)
+        self.assertFalse(self.journal.flush(5))
+        self.assertFalse(self.journal.close())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+######################################################
+#
+# The pick pipeline with its queued stages on threads of
+#   their own, the way gpio_poll_thread() runs it
+#
+#####################################################
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pick_pipeline import (BufferStage, ClassifyStage, DeliverStage, EnrichStage,
+                           PickEvent, PickPipeline)
+from pick_record import PickRecord
+from press_coalescer import PressCoalescer
+
+
+# Longest a test waits for the pipeline's threads
+WAIT_SEC = 5.0
+
+
+class ListSource(object):
+    """Source handing out count picks, then stopping the pipeline"""
+
+    def __init__(self, count):
+        self.count = count
+        self.pipeline = None
+
+    def read(self, timeout):
+        if self.count == 0:
+            self.pipeline.stop()
+            return None
+        self.count -= 1
+        return PickEvent(time.monotonic(), duration_ms=100)
+
+
+class PressSource(object):
+    """Source handing out (pressed_at, released_at) presses on a virtual
+        clock, then stopping the pipeline right away
+    """
+
+    def __init__(self, presses):
+        self.presses = list(presses)
+        self.now = 0.0
+        self.pipeline = None
+
+    def clock(self):
+        return self.now
+
+    def read(self, timeout):
+        if not self.presses:
+            self.pipeline.stop()
+            return None
+        pressed_at, released_at = self.presses.pop(0)
+        self.now = released_at
+        return PickEvent(released_at, pressed_at, released_at)
+
+
+class JournalingChrc(object):
+    """Stands in for TrashGrabbedChrc with a journal: every delivery
+        sends everything stored so far, and blocks while gate is clear
+    """
+
+    def __init__(self, store_sec=0.0):
+        self.store_sec = store_sec
+        self.stored = 0
+        self.delivered = 0
+        self.deliveries = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.delivering = threading.Event()
+
+    def new_pick(self, duration_ms, age_sec=0.0):
+        return PickRecord(None, time.time() - age_sec, duration_ms=duration_ms)
+
+    def store_pick(self, record):
+        time.sleep(self.store_sec)
+        record.seq = self.stored
+        self.stored += 1
+
+    def deliver_pick(self, record):
+        stored = self.stored
+        self.delivering.set()
+        self.gate.wait()
+        self.deliveries += 1
+        self.delivered = max(self.delivered, stored)
+
+
+class BackpressureListener(object):
+
+    def __init__(self):
+        self.changes = []
+
+    def pick_backpressure(self, pipeline, stage_name, active):
+        self.changes.append((stage_name, active))
+
+
+def build_pipeline(count, chrc, queue_size=4, coalesce=True):
+    source = ListSource(count)
+    pipeline = PickPipeline(source)
+    source.pipeline = pipeline
+    pipeline.add_stage(EnrichStage(chrc))
+    pipeline.add_stage(BufferStage(chrc), queue_size)
+    pipeline.add_stage(DeliverStage(chrc, coalesce), queue_size)
+    return pipeline
+
+
+def wait_for(condition):
+    deadline = time.time() + WAIT_SEC
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ThreadedPipelineTest(unittest.TestCase):
+
+    def test_every_pick_stored_and_delivered(self):
+        chrc = JournalingChrc()
+        pipeline = build_pipeline(50, chrc, coalesce=False)
+        pipeline.run()
+        self.assertEqual(chrc.stored, 50)
+        self.assertEqual(chrc.deliveries, 50)
+        self.assertEqual(chrc.delivered, 50)
+
+    def test_full_buffer_queue_blocks_instead_of_dropping(self):
+        chrc = JournalingChrc(store_sec=0.005)
+        listener = BackpressureListener()
+        pipeline = build_pipeline(40, chrc, queue_size=2)
+        pipeline.add_listener(listener)
+        pipeline.run()
+        self.assertEqual(chrc.stored, 40)
+        self.assertEqual(chrc.delivered, 40)
+        buffer_stats = pipeline.as_dict()['stages'][1]['queue']
+        self.assertGreater(buffer_stats['blocked_sec'], 0)
+        self.assertEqual(buffer_stats['coalesced'], 0)
+        self.assertIn(('buffer', True), listener.changes)
+        self.assertIn(('buffer', False), listener.changes)
+
+    def test_stuck_delivery_does_not_hold_up_the_journal(self):
+        chrc = JournalingChrc()
+        chrc.gate.clear()
+        pipeline = build_pipeline(100, chrc)
+        runner = threading.Thread(target=pipeline.run)
+        runner.start()
+        try:
+            self.assertTrue(chrc.delivering.wait(WAIT_SEC))
+            # Delivery is stuck, every pick still makes it to the journal
+            self.assertTrue(wait_for(lambda: chrc.stored == 100))
+            self.assertEqual(pipeline.backpressure, ['deliver'])
+        finally:
+            chrc.gate.set()
+        runner.join(WAIT_SEC)
+        self.assertFalse(runner.is_alive())
+
+        deliver_stats = pipeline.as_dict()['stages'][2]['queue']
+        self.assertGreater(deliver_stats['coalesced'], 0)
+        self.assertEqual(deliver_stats['blocked_sec'], 0)
+        # The deliveries that were not dropped covered every pick
+        self.assertEqual(chrc.delivered, 100)
+
+    def test_pick_held_by_the_coalescer_is_passed_on_at_stop(self):
+        chrc = JournalingChrc()
+        # Two presses of one shaky grip, the pipeline stops within the merge gap
+        source = PressSource([(10.0, 10.3), (10.4, 10.9)])
+        pipeline = PickPipeline(source, source.clock)
+        source.pipeline = pipeline
+        picks = []
+        chrc.new_pick = lambda duration_ms, age_sec: picks.append(
+                (duration_ms, age_sec)) or PickRecord(None, 0, duration_ms=duration_ms)
+        pipeline.add_stage(ClassifyStage(PressCoalescer()))
+        pipeline.add_stage(EnrichStage(chrc, source.clock))
+        pipeline.add_stage(BufferStage(chrc), 4)
+        pipeline.run()
+
+        self.assertEqual(chrc.stored, 1)
+        duration_ms, age_sec = picks[0]
+        self.assertEqual(duration_ms, 900)
+        # Stamped at the first press, not when the pipeline let go of it
+        self.assertAlmostEqual(age_sec, 0.9)
+
+    def test_listeners_need_not_define_the_callback(self):
+        chrc = JournalingChrc(store_sec=0.005)
+        pipeline = build_pipeline(20, chrc, queue_size=2)
+        pipeline.add_listener(object())
+        pipeline.run()
+        self.assertEqual(chrc.stored, 20)
+
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class AnalogSourceTest(unittest.TestCase):
+
+    def test_analog_picks_go_through_the_stages(self):
+        from analog_sensing import AnalogPressSource, SyntheticSource
+
+        synthetic = SyntheticSource(picks_per_sec=1.0, realtime=False)
+        source = AnalogPressSource(synthetic, cpu_budget=1.0)
+        pipeline = PickPipeline(source)
+        chrc = JournalingChrc()
+        pipeline.add_stage(EnrichStage(chrc))
+        pipeline.add_stage(BufferStage(chrc), 4)
+        pipeline.add_stage(DeliverStage(chrc, True), 4)
+
+        # A minute of signal, then stop
+        read = source.read
+        def read_a_minute(timeout):
+            if source.detector.samples >= 60 * synthetic.rate_hz:
+                pipeline.stop()
+            return read(timeout)
+        source.read = read_a_minute
+        pipeline.run()
+
+        picks = source.detector.picks
+        self.assertGreater(picks, 0)
+        self.assertEqual(pipeline.source_events, picks)
+        self.assertEqual(chrc.stored, picks)
+        self.assertEqual(chrc.delivered, picks)
+
+
+if __name__ == '__main__':
+    unittest.main()
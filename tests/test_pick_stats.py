@@ -0,0 +1,93 @@
+######################################################
+#
+# The Pick Stats values: the summary fits in one read at
+#   the default MTU, and long reads of the bucket values
+#   are consistent per device
+#
+#####################################################
+
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import dbus
+    from gi.repository import GObject
+except ImportError:
+    dbus = None
+
+from pick_stats import HOUR_BUCKETS, MINUTE_BUCKETS, PickStats
+
+
+# An ATT read response carries ATT_MTU - 1 bytes
+DEFAULT_MTU = 23
+
+NOW = 1600000000.0
+PHONE_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+OTHER_PHONE_PATH = '/org/bluez/hci0/dev_66_77_88_99_AA_BB'
+
+
+class PickStatsFormatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = PickStats(lifetime_total=10, clock=lambda: NOW)
+        for timestamp in (NOW - 30, NOW - 20, NOW - 90, NOW - 7200):
+            self.stats.add(timestamp)
+
+    def test_summary_is_one_read_at_the_default_mtu(self):
+        summary = self.stats.pack_summary()
+        self.assertLessEqual(len(summary), DEFAULT_MTU - 1)
+        session_total, lifetime_total, _, now, peak, _ = struct.unpack('<IIIIHI', summary)
+        self.assertEqual((session_total, lifetime_total, now, peak), (4, 14, int(NOW), 2))
+
+    def test_buckets_end_at_now(self):
+        minutes = struct.unpack('<I%dB' % MINUTE_BUCKETS, self.stats.pack_minutes())
+        self.assertEqual(minutes[0], int(NOW))
+        self.assertEqual(sum(minutes[1:]), 3)
+        hours = struct.unpack('<I%dH' % HOUR_BUCKETS, self.stats.pack_hours())
+        self.assertEqual(hours[0], int(NOW))
+        self.assertEqual(sum(hours[1:]), 4)
+
+
+@unittest.skipIf(dbus is None, 'needs dbus-python and PyGObject')
+class PickStatsReadTest(unittest.TestCase):
+
+    def test_long_reads_are_consistent_per_device(self):
+        from soak_harness import load_server_module
+
+        server = load_server_module()
+        app = server.SmartTrashPickerApplication(None, include_demo_services=False)
+        service = app.services[-1]
+        stats = service.stats
+        # Without a journal: TrashGrabbed, the summary, minutes and hours
+        chrc = service.characteristics[2]
+
+        def read(device, offset):
+            return bytes(chrc.ReadValue({ 'device': device, 'offset': offset }))
+
+        first = read(PHONE_PATH, 0)
+        stats.add(stats.clock())
+        # Another phone's read in between takes a snapshot of its own
+        self.assertNotEqual(read(OTHER_PHONE_PATH, 0), first)
+        self.assertEqual(first[:DEFAULT_MTU - 1] + read(PHONE_PATH, DEFAULT_MTU - 1),
+                         first)
+
+    def test_read_past_the_end_is_an_invalid_offset(self):
+        from soak_harness import load_server_module
+
+        server = load_server_module()
+        app = server.SmartTrashPickerApplication(None, include_demo_services=False)
+        chrc = app.services[-1].characteristics[2]
+
+        value = bytes(chrc.ReadValue({ 'device': PHONE_PATH, 'offset': 0 }))
+        self.assertEqual(bytes(chrc.ReadValue({ 'device': PHONE_PATH,
+                                                'offset': len(value) })), b'')
+        with self.assertRaises(dbus.exceptions.DBusException):
+            chrc.ReadValue({ 'device': PHONE_PATH, 'offset': len(value) + 1 })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+######################################################
+#
+# Presence-aware delivery of TrashGrabbedChrc, against a
+#   mock BlueZ that reports Device1 connects and
+#   disconnects to a DevicePresence and confirms the
+#   indications it was sent
+#
+# Needs dbus-python and PyGObject (the GATT classes are
+#   dbus.service.Objects), but no bus: nothing is exported
+#
+#####################################################
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import dbus
+    from gi.repository import GObject
+except ImportError:
+    dbus = None
+
+
+PHONE_PATH = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+OTHER_PHONE_PATH = '/org/bluez/hci0/dev_66_77_88_99_AA_BB'
+
+
+class MockBlueZ(object):
+    """Plays BlueZ's side: Device1 property changes go to presence, and
+        indications emitted by chrc are kept until confirm() is called
+    """
+
+    def __init__(self, presence, chrc):
+        self.presence = presence
+        self.chrc = chrc
+        # seq of every indication, in the order sent
+        self.indicated = []
+        self._unconfirmed = 0
+        chrc.PropertiesChanged = self._properties_changed
+
+    def _properties_changed(self, interface, changed, invalidated):
+        self.indicated.append(self.chrc_seq(changed['Value']))
+        self._unconfirmed += 1
+
+    @staticmethod
+    def chrc_seq(value):
+        # A packed PickRecord starts with its sequence number
+        return struct.unpack_from('<I', bytes(value))[0]
+
+    def connect(self, path=PHONE_PATH, paired=True):
+        self.presence.update(path, { 'Address': path[-17:].replace('_', ':'),
+                                     'Paired': paired, 'Connected': True })
+        self.presence.update(path, { 'ServicesResolved': True })
+
+    def disconnect(self, path=PHONE_PATH):
+        # The link is lost: BlueZ drops what it had not confirmed yet
+        self._unconfirmed = 0
+        self.presence.update(path, { 'ServicesResolved': False })
+        self.presence.update(path, { 'Connected': False })
+
+    def confirm(self):
+        """Confirm every indication sent so far, refills included"""
+        while self._unconfirmed:
+            self._unconfirmed -= 1
+            self.chrc.Confirm()
+
+
+@unittest.skipIf(dbus is None, 'needs dbus-python and PyGObject')
+class PresenceDeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        from device_presence import DevicePresence
+        from pick_journal import PickJournal
+        from soak_harness import load_server_module
+
+        server = self.server = load_server_module()
+        self.tmp_dir = tempfile.mkdtemp(prefix='stp-test-')
+        self.journal = PickJournal(os.path.join(self.tmp_dir, 'picks.db'))
+        self.presence = DevicePresence(None)
+        app = server.SmartTrashPickerApplication(None, self.journal, self.presence,
+                                                 include_demo_services=False)
+        self.chrc = app.services[-1].characteristics[0]
+        self.bluez = MockBlueZ(self.presence, self.chrc)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def pick(self, count=1):
+        for _ in range(count):
+            self.chrc.notify_trash_grabbed()
+
+    def test_backlog_flushed_on_reconnect_without_start_notify(self):
+        self.bluez.connect()
+        self.chrc.StartNotify()
+        self.pick()
+        self.bluez.confirm()
+        self.assertEqual(self.bluez.indicated, [0])
+        self.assertEqual(self.journal.pending_count(), 0)
+
+        self.bluez.disconnect()
+        self.pick(3)
+        self.assertEqual(self.bluez.indicated, [0])
+        self.assertEqual(self.journal.pending_count(), 3)
+
+        # A bonded phone comes back subscribed, BlueZ sends no StartNotify
+        self.bluez.connect()
+        self.assertEqual(self.bluez.indicated, [0, 1, 2, 3])
+        self.bluez.confirm()
+        self.assertEqual(self.journal.pending_count(), 0)
+        self.assertEqual(self.chrc.delivered_count, 4)
+
+    def test_unconfirmed_picks_resent_after_reconnect(self):
+        self.bluez.connect()
+        self.chrc.StartNotify()
+        self.pick(2)
+        # The link drops before the phone confirmed anything
+        self.bluez.disconnect()
+        self.assertEqual(self.journal.pending_count(), 2)
+
+        self.bluez.connect()
+        self.assertEqual(self.bluez.indicated, [0, 1, 0, 1])
+        self.bluez.confirm()
+        self.assertEqual(self.journal.pending_count(), 0)
+
+    def test_nothing_runs_while_away(self):
+        self.bluez.connect()
+        self.chrc.StartNotify()
+        self.pick()
+        self.assertIsNotNone(self.chrc._timeout_source)
+
+        self.bluez.disconnect()
+        self.assertTrue(self.chrc.delivery_stats()['paused'])
+        self.assertIsNone(self.chrc._timeout_source)
+        self.pick(2)
+        self.chrc.flush_backlog()
+        self.assertEqual(self.bluez.indicated, [0])
+        self.assertEqual(self.chrc.delivery_stats()['in_flight'], 0)
+
+    def test_other_subscribed_phone_keeps_delivery_going(self):
+        self.bluez.connect()
+        self.bluez.connect(OTHER_PHONE_PATH)
+        self.chrc.StartNotify()
+        self.bluez.disconnect()
+        self.assertFalse(self.chrc.delivery_stats()['paused'])
+        self.pick()
+        self.assertEqual(self.bluez.indicated, [0])
+
+    def test_unknown_device_does_not_resume(self):
+        self.bluez.connect()
+        self.chrc.StartNotify()
+        self.bluez.disconnect()
+        self.pick()
+
+        # Neither bonded nor subscribed before
+        self.bluez.connect(OTHER_PHONE_PATH, paired=False)
+        self.assertEqual(self.bluez.indicated, [])
+        self.bluez.connect()
+        self.assertEqual(self.bluez.indicated, [0])
+
+    def test_stop_notify_ends_the_subscription(self):
+        self.bluez.connect()
+        self.chrc.StartNotify()
+        self.chrc.StopNotify()
+        self.bluez.disconnect()
+        self.pick()
+        self.bluez.connect()
+        self.assertEqual(self.bluez.indicated, [])
+
+        self.chrc.StartNotify()
+        self.assertEqual(self.bluez.indicated, [0])
+
+    def test_unconfirmed_picks_requeued_and_sent_again(self):
+        self.bluez.connect()
+        self.chrc.StartNotify()
+        self.pick(6)
+        self.assertEqual(self.bluez.indicated, [0, 1, 2, 3])
+
+        # The phone confirms nothing: the oldest is retried, then the
+        #   window goes back to the backlog
+        idle = []
+        with mock.patch.object(self.server.GObject, 'idle_add',
+                               lambda callback: idle.append(callback)):
+            for _ in range(self.chrc.MAX_SEND_ATTEMPTS):
+                for entry in self.chrc._in_flight.values():
+                    entry[1] -= self.chrc.CONFIRM_TIMEOUT_MS / 1000.0
+                self.chrc._check_confirm_timeouts()
+        self.assertEqual(self.bluez.indicated, [0, 1, 2, 3, 0, 0])
+        self.assertEqual(self.chrc.delivery_stats()['in_flight'], 0)
+
+        for callback in idle:
+            callback()
+        self.assertEqual(self.bluez.indicated, [0, 1, 2, 3, 0, 0, 0, 1, 2, 3])
+        self.pick()
+        self.assertEqual(len(self.bluez.indicated), 10)
+
+        self.bluez.confirm()
+        self.assertEqual(self.journal.pending_count(), 0)
+        self.assertEqual(self.chrc.delivered_count, 7)
+        self.assertEqual(self.chrc.delivery_stats()['unconfirmed_sent'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+######################################################
+#
+# The sampling profiler's D-Bus method timings: taken where
+#   dbus-python dispatches the call, and for async_callbacks
+#   methods only once they reply
+#
+# Needs dbus-python, but no bus: the method is looked up
+#   and called the way dbus.service.Object dispatches it
+#
+#####################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import dbus
+    import dbus.service
+    import dbus_cache
+except ImportError:
+    dbus = None
+
+from sampling_profiler import SamplingProfiler
+
+
+EXAMPLE_IFACE = 'org.example.Slow'
+
+
+def _slow_object():
+    class SlowObject(dbus_cache.CachedDispatchObject):
+
+        @dbus.service.method(EXAMPLE_IFACE, in_signature='', out_signature='s',
+                             async_callbacks=('reply_handler', 'error_handler'))
+        def ReadValue(self, reply_handler, error_handler):
+            # Replied to later, as if from a worker thread
+            self.reply_handler = reply_handler
+
+        @dbus.service.method(EXAMPLE_IFACE, in_signature='', out_signature='s')
+        def Ping(self):
+            return 'pong'
+
+    return SlowObject()
+
+
+@unittest.skipIf(dbus is None, 'needs dbus-python')
+class MethodTimingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='stp-test-')
+        self.profiler = SamplingProfiler(self.tmp_dir)
+        self.obj = _slow_object()
+
+    def tearDown(self):
+        if self.profiler.running:
+            self.profiler.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def dispatch(self, method_name, **keywords):
+        candidate, parent = dbus.service._method_lookup(self.obj, method_name,
+                                                        EXAMPLE_IFACE)
+        return candidate(self.obj, **keywords)
+
+    def test_async_method_timed_until_its_reply(self):
+        self.profiler.start()
+        replies = []
+        self.dispatch('ReadValue', reply_handler=replies.append,
+                      error_handler=self.fail)
+        self.assertNotIn('ReadValue', self.profiler._method_times)
+
+        time.sleep(0.05)
+        self.obj.reply_handler('value')
+        self.assertEqual(replies, ['value'])
+        calls, total, _ = self.profiler._method_times['ReadValue']
+        self.assertEqual(calls, 1)
+        self.assertGreaterEqual(total, 0.05)
+
+    def test_only_timed_methods_while_profiling(self):
+        self.assertEqual(self.dispatch('Ping'), 'pong')
+        self.profiler.start()
+        self.assertEqual(self.dispatch('Ping'), 'pong')
+        prefix = self.profiler.stop()
+
+        self.assertIsNone(dbus_cache.method_timer)
+        self.assertEqual(self.profiler._method_times, {})
+        self.assertTrue(os.path.exists(prefix + '.methods'))
+
+
+if __name__ == '__main__':
+    unittest.main()